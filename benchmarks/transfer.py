@@ -0,0 +1,265 @@
+"""
+Transfer benchmarks against the fake Drive server (gcapi.fakedrive)
+
+Throughput (MB/s), HTTP requests per operation and peak RSS of uploads,
+downloads, listing, batch deletes and the backup / restore pipelines, so a
+performance change can be accepted by numbers:
+
+    pip install py-googledrive[bench]
+    python -m pytest benchmarks/transfer.py --benchmark-json=result.json
+
+The extra numbers are in the extra_info of every benchmark in the json
+(and in --benchmark-verbose output), they are not recorded with
+--benchmark-disable. The link is simulated by the server:
+    GCAPI_BENCH_LATENCY     -> seconds added to every response (default 0)
+    GCAPI_BENCH_BANDWIDTH   -> bytes per second, e.g. 50M (default unlimited)
+    GCAPI_BENCH_SIZE        -> size of transferred files (default 32M)
+    GCAPI_BENCH_ROUNDS      -> rounds of every benchmark (default 3)
+
+The server runs in the same process and keeps files in memory, so
+rss_growth_MB includes the stored files of an upload.
+"""
+import os
+import resource
+import threading
+import pytest
+
+pytest.importorskip('pytest_benchmark')
+
+from gcapi.drive import GCDrive
+from gcapi.fakedrive import FakeDrive
+from gcapi.throttle import parse_rate
+from gcapi.compress import compress_writer, uncompress_reader
+from gcapi.archive import write_tar, extract_tar
+
+
+LATENCY = float(os.environ.get('GCAPI_BENCH_LATENCY', 0))
+BANDWIDTH = os.environ.get('GCAPI_BENCH_BANDWIDTH', '0')
+SIZE = int(parse_rate(os.environ.get('GCAPI_BENCH_SIZE', '32M')))
+ROUNDS = int(os.environ.get('GCAPI_BENCH_ROUNDS', 3))
+# files of list and bulk_delete benchmarks
+FILES = 1000
+# files of the media tree of pipeline benchmarks
+MEDIA_FILES = 200
+
+
+class PeakRSS:
+    """Sample resident memory of the process in a thread and keep the peak"""
+    def __init__(self, interval: float=0.005) -> None:
+        self.interval = interval
+        self.start = self.peak = self.rss()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self.__sample, daemon=True)
+
+    @staticmethod
+    def rss() -> int:
+        try:
+            with open('/proc/self/statm') as f:
+                return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+        except OSError:
+            # peak of the process lifetime where /proc is missing (kilobytes on linux, bytes on macOS)
+            return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+    def __sample(self) -> None:
+        while not self._stop.wait(self.interval):
+            self.peak = max(self.peak, self.rss())
+
+    def __enter__(self) -> 'PeakRSS':
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self._stop.set()
+        self._thread.join()
+        self.peak = max(self.peak, self.rss())
+
+
+class _Discard:
+    """Writable stream which drops everything"""
+    def write(self, data) -> int:
+        return len(data)
+
+
+def measure(benchmark, fake: FakeDrive, target, size: int=0, setup=None, teardown=None):
+    """
+    Run target ROUNDS times and report MB/s, requests per operation and memory
+
+    Params:
+        benchmark:  fixture     -> pytest-benchmark fixture
+        fake:       FakeDrive   -> server whose requests are counted
+        target:     callable    -> operation
+        size:       int         -> bytes transferred by one operation
+        setup:      callable    -> runs before every round, returns (args, kwargs)
+        teardown:   callable    -> runs after every round
+    """
+    fake.reset_stats()
+    with PeakRSS() as rss:
+        result = benchmark.pedantic(target, setup=setup, teardown=teardown,
+                                    rounds=ROUNDS, iterations=1)
+    if benchmark.disabled:
+        # target ran once as a plain test, there are no stats
+        return result
+    benchmark.extra_info.update({
+        'MB/s': round(size / benchmark.stats.stats.mean / 10 ** 6, 2) if size else None,
+        'requests/op': len(fake.requests) / ROUNDS,
+        'peak_rss_MB': round(rss.peak / 2 ** 20, 1),
+        'rss_growth_MB': round((rss.peak - rss.start) / 2 ** 20, 1),
+    })
+    return result
+
+
+@pytest.fixture(scope='module')
+def fake():
+    with FakeDrive(latency=LATENCY, bandwidth=BANDWIDTH) as server:
+        yield server
+
+
+@pytest.fixture
+def drive(fake, tmp_path, monkeypatch):
+    monkeypatch.setattr('gcapi.drive.BACKUP_FOLDER', str(tmp_path))
+    fake.clear()
+    return GCDrive(pool=fake.pool())
+
+
+@pytest.fixture(scope='module')
+def source(tmp_path_factory) -> str:
+    path = tmp_path_factory.mktemp('source') / 'backup.bin'
+    path.write_bytes(os.urandom(SIZE))
+    return str(path)
+
+
+@pytest.fixture(scope='module')
+def media(tmp_path_factory) -> str:
+    """Media tree of MEDIA_FILES files, SIZE bytes in total (half compressible)"""
+    root = tmp_path_factory.mktemp('media')
+    size = SIZE // MEDIA_FILES
+    for index in range(MEDIA_FILES):
+        folder = root / f"{index // 50:02d}"
+        folder.mkdir(exist_ok=True)
+        (folder / f"{index}.bin").write_bytes(os.urandom(size // 2) + bytes(size - size // 2))
+    return str(root)
+
+
+def test_upload(benchmark, fake, drive, source):
+    measure(benchmark, fake, lambda: drive.upload(source, folder_id='bench'),
+            size=SIZE, teardown=fake.clear)
+
+
+def test_upload_stream(benchmark, fake, drive, source):
+    streams = []
+
+    def setup():
+        streams.append(open(source, 'rb'))
+        return (streams[-1],), {}
+
+    measure(benchmark, fake, lambda stream: drive.upload_stream(stream, 'stream.bin', folder_id='bench'),
+            size=SIZE, setup=setup, teardown=lambda *args: streams.pop().close() or fake.clear())
+
+
+def test_download(benchmark, fake, drive):
+    file = fake.add_file('backup.bin', os.urandom(SIZE))
+    measure(benchmark, fake, lambda: drive.download(file['id']), size=SIZE)
+
+
+def test_download_ranges(benchmark, fake, drive):
+    file = fake.add_file('backup.bin', os.urandom(SIZE))
+    measure(benchmark, fake, lambda: drive.download_ranges(file['id'], range_size=4 * 1024 * 1024),
+            size=SIZE)
+
+
+def test_download_stream(benchmark, fake, drive):
+    file = fake.add_file('backup.bin', os.urandom(SIZE))
+    measure(benchmark, fake, lambda: drive.download_stream(file['id'], _Discard()), size=SIZE)
+
+
+def test_list(benchmark, fake, drive):
+    for index in range(FILES):
+        fake.add_file(f"default_db_{index}.dump", b'', parents=['bench'])
+    files = measure(benchmark, fake,
+                    lambda: list(drive.iter_files(query="'bench' in parents", page_size=100)))
+    assert len(files) == FILES
+
+
+def test_bulk_delete(benchmark, fake, drive):
+    def setup():
+        ids = [fake.add_file(f"media_{index}.tar.gz", b'', parents=['bench'])['id']
+               for index in range(FILES)]
+        return (ids,), {}
+
+    measure(benchmark, fake, drive.bulk_delete, setup=setup)
+
+
+def _pipe(write) -> tuple:
+    """
+    Readable end of a pipe which is filled by write(fileobj) in a thread
+
+    Return:
+        reader, thread, errors
+    """
+    read_fd, write_fd = os.pipe()
+    errors = []
+
+    def run():
+        try:
+            with open(write_fd, 'wb') as writer:
+                write(writer)
+        except Exception as exc:
+            errors.append(exc)
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    return open(read_fd, 'rb'), thread, errors
+
+
+def _archive(folder: str):
+    """Writer of compressed tar of folder for _pipe"""
+    def write(fileobj):
+        with compress_writer(fileobj) as compressed:
+            write_tar(folder, compressed)
+    return write
+
+
+def test_backup_pipeline(benchmark, fake, drive, media):
+    """tar + compress media tree into upload_stream, like pymedia_backup"""
+    def backup():
+        reader, thread, errors = _pipe(_archive(media))
+        with reader:
+            response = drive.upload_stream(reader, 'media.tar.gz', folder_id='bench')
+        thread.join()
+        if errors:
+            raise errors[0]
+        return response
+
+    measure(benchmark, fake, backup, size=SIZE, teardown=fake.clear)
+
+
+def test_restore_pipeline(benchmark, fake, drive, media, tmp_path):
+    """download_stream into uncompress + extract of media tree, like pymedia_restore"""
+    reader, thread, _ = _pipe(_archive(media))
+    with reader:
+        archive = reader.read()
+    thread.join()
+    file = fake.add_file('media.tar.gz', archive)
+    rounds = iter(range(ROUNDS + 1))
+
+    def restore():
+        target = tmp_path / f"restore_{next(rounds)}"
+        read_fd, write_fd = os.pipe()
+        errors = []
+
+        def extract():
+            try:
+                with open(read_fd, 'rb') as pipe:
+                    extract_tar(uncompress_reader(pipe), str(target))
+            except Exception as exc:
+                errors.append(exc)
+
+        extractor = threading.Thread(target=extract, daemon=True)
+        extractor.start()
+        with open(write_fd, 'wb') as pipe:
+            drive.download_stream(file['id'], pipe)
+        extractor.join()
+        if errors:
+            raise errors[0]
+
+    measure(benchmark, fake, restore, size=SIZE)
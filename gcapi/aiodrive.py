@@ -0,0 +1,449 @@
+"""
+Asyncio Google Drive client
+
+AsyncGCDrive offers the main GCDrive operations as coroutines, so async
+Django views can query metadata and trigger backups without blocking the
+event loop:
+    - get()         -> Get specific file details
+    - iter_files()  -> Iterate all files of a query page by page (async for)
+    - upload()      -> Resumable upload of a file
+    - download()    -> Download a file to GCAPI_BACKUP_FOLDER
+    - delete()      -> Delete a file
+
+Requests go through one aiohttp session, whose connection pool is shared by
+all calls. Concurrent requests are bounded by an adaptive limit, which is
+halved on Drive rate limits like the one of GCDrive (gcapi.throttle).
+Authorization uses the same service account Credentials as GCDrive. Errors
+are raised as googleapiclient HttpError, so callers handle both clients the
+same way.
+
+Transfers are shaped by the same bandwidth limits as GCDrive (gcapi.throttle),
+transient errors are retried with the backoff of gcapi.retry and transfers are
+verified with Drive checksums (gcapi.checksum), like GCDrive does. Blocking
+file and upload session I/O runs in threads (asyncio.to_thread).
+
+Needs aiohttp: pip install py-googledrive[async]
+"""
+import os
+import json
+import asyncio
+import httplib2
+from google.auth.transport.requests import Request
+from google.oauth2.service_account import Credentials
+from googleapiclient.errors import HttpError
+from gcapi.session import UploadSession
+from gcapi.throttle import upload_limit, download_limit, AsyncAdaptiveConcurrency
+from gcapi.checksum import Checksums, ChecksumError
+from gcapi.retry import is_transient, backoff, retry_after, RETRIES
+
+try:
+    import aiohttp
+except ImportError:  # optional, pip install py-googledrive[async]
+    aiohttp = None
+
+
+BACKUP_FOLDER = os.environ.get('GCAPI_BACKUP_FOLDER')
+CREDENTIALS_PATH = os.environ.get('GCAPI_CREDENTIALS_PATH')
+FOLDER_ID = os.environ.get('GCAPI_FOLDER_ID', None)
+CHUNK_SIZE = int(os.environ.get('GCAPI_CHUNK_SIZE', 8 * 1024 * 1024))
+# max concurrent requests (and pooled connections) of one client
+MAX_CONNECTIONS = int(os.environ.get('GCAPI_MAX_CONNECTIONS', 10))
+VERIFY_CHECKSUM = os.environ.get('GCAPI_VERIFY_CHECKSUM', 'true').lower() in ('1', 'true', 'yes')
+
+ROOT_URL = 'https://www.googleapis.com'
+SCOPES = ['https://www.googleapis.com/auth/drive']
+FILE_FIELDS = 'id, name, createdTime'
+GET_FIELDS = 'id, name, createdTime, mimeType, kind, owners, size'
+CHECKSUM_FIELDS = 'id, name, md5Checksum, sha256Checksum'
+READ_SIZE = 1024 * 1024
+
+
+def _is_transient(error: Exception) -> bool:
+    """Transient error of gcapi.retry, or a dropped aiohttp connection"""
+    if aiohttp is not None and isinstance(error, (aiohttp.ClientConnectionError,
+                                                  aiohttp.ClientPayloadError)):
+        return True
+    return is_transient(error)
+
+
+async def _sleep_before_retry(attempt: int, error: Exception) -> None:
+    """Backoff with full jitter, Retry-After of the error response is respected"""
+    await asyncio.sleep(max(backoff(attempt), retry_after(error)))
+
+
+def _read_at(f, offset: int, size: int) -> bytes:
+    f.seek(offset)
+    return f.read(size)
+
+
+def _hash_until(f, checksums: Checksums, end: int) -> None:
+    """Hash bytes of f up to end which were sent by an earlier run"""
+    f.seek(checksums.size)
+    while checksums.size < end:
+        data = f.read(min(READ_SIZE, end - checksums.size))
+        if not data:
+            break
+        checksums.update(data)
+
+
+class AsyncGCDrive:
+    def __init__(self,
+                 credentials: Credentials=None,
+                 max_connections: int=MAX_CONNECTIONS,
+                 root_url: str=ROOT_URL
+        ) -> None:
+        """
+        Params:
+            credentials:        Credentials -> service account credentials
+                                               (from GCAPI_CREDENTIALS_PATH by default)
+            max_connections:    int         -> max concurrent requests, fewer while
+                                               Drive answers rate limit errors
+            root_url:           str         -> Google APIs root url
+        """
+        if aiohttp is None:
+            raise ImportError("AsyncGCDrive needs aiohttp package: pip install aiohttp")
+        if credentials is None:
+            credentials = Credentials.from_service_account_file(CREDENTIALS_PATH)
+        if credentials.requires_scopes:
+            credentials = credentials.with_scopes(SCOPES)
+        self.__credentials = credentials
+        self.max_connections = max_connections
+        self.api_url = f"{root_url}/drive/v3"
+        self.upload_url = f"{root_url}/upload/drive/v3/files"
+        # created in the running event loop, see get_session()
+        self.__session = None
+        self.__concurrency = None
+        self.__token_lock = None
+
+    def get_credentials(self) -> Credentials:
+        return self.__credentials
+
+    def get_session(self):
+        """Shared aiohttp session, its connector is the connection pool"""
+        if self.__session is None or self.__session.closed:
+            connector = aiohttp.TCPConnector(limit=self.max_connections)
+            self.__session = aiohttp.ClientSession(connector=connector)
+            self.__concurrency = AsyncAdaptiveConcurrency(max_limit=self.max_connections)
+            self.__token_lock = asyncio.Lock()
+        return self.__session
+
+    async def close(self) -> None:
+        """Close connection pool"""
+        if self.__session is not None:
+            await self.__session.close()
+            self.__session = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc) -> None:
+        await self.close()
+
+    async def __headers(self) -> dict:
+        """Authorization header, token is refreshed in a thread when it expired"""
+        self.get_session()
+        credentials = self.get_credentials()
+        async with self.__token_lock:
+            if not credentials.valid:
+                await asyncio.to_thread(credentials.refresh, Request())
+        return {'Authorization': f"Bearer {credentials.token}"}
+
+    @staticmethod
+    async def __raise_for_status(response, url: str, expect=(200,)) -> None:
+        """Raise HttpError (with response headers, e.g. Retry-After) for an unexpected status"""
+        if response.status not in expect:
+            resp = httplib2.Response(dict(response.headers, status=response.status,
+                                          reason=response.reason))
+            raise HttpError(resp, await response.read(), uri=url)
+
+    async def __request(self, method: str, url: str, expect=(200,), as_json: bool=False,
+                        retries: int=RETRIES, missing_ok: bool=False, **kwargs):
+        """
+        Send a request and read its response, transient errors are retried
+
+        Params:
+            method:     str   -> http method
+            url:        str   -> request url
+            expect:     tuple -> status codes which are not an error
+            as_json:    bool  -> decode response body as json
+            retries:    int   -> max retries
+            missing_ok: bool  -> 404 of a retried request is not an error, the failed
+                                 attempt did it (delete)
+            kwargs:           -> arguments of aiohttp request (params, json, data, headers)
+
+        Return:
+            status, headers, body
+        """
+        session = self.get_session()
+        extra_headers = kwargs.pop('headers', {})
+        for attempt in range(retries + 1):
+            headers = await self.__headers()
+            headers.update(extra_headers)
+            try:
+                async with self.__concurrency.slot():
+                    async with session.request(method, url, headers=headers, **kwargs) as response:
+                        await self.__raise_for_status(response, url, 
+                                                      expect + (404,) if attempt and missing_ok else expect)
+                        content = await response.read()
+                        if as_json:
+                            content = json.loads(content) if content else {}
+                        return response.status, response.headers, content
+            except Exception as error:
+                if attempt == retries or not _is_transient(error):
+                    raise
+                await _sleep_before_retry(attempt, error)
+
+    async def get(self,
+                  file_id: str,
+                  shared_drive: bool=None
+        ) -> dict:
+        """
+        Get specific file or folder information
+
+        Params:
+            file_id:        string  ->  file id which you want to see detail of file
+            shared_drive:   boolean ->  support all drives. Include shared drives
+
+        Return:
+            File: id, name, createdTime, mimeType, kind, owners, size
+        """
+        params = {'fields': GET_FIELDS}
+        if shared_drive:
+            params['supportsAllDrives'] = 'true'
+        _, _, result = await self.__request('GET', f"{self.api_url}/files/{file_id}",
+                                            params=params, as_json=True)
+        return result
+
+    async def iter_files(self,
+                         query: str=None,
+                         fields: str=FILE_FIELDS,
+                         page_size: int=1000,
+                         order_by: str=None,
+                         shared_drive: bool=None
+        ):
+        """
+        Iterate all files which match the query, page by page
+
+        Params:
+            query:          str     -> Drive search query (q parameter)
+            fields:         str     -> file fields, only these are returned. e.g. "id, name"
+            page_size:      int     -> files per request (max 1000)
+            order_by:       str     -> sort order. e.g. "createdTime desc"
+            shared_drive:   bool    -> whether to include shared drives
+
+        Return:
+            async generator of file dictionaries
+        """
+        params = {
+            'q': query or "",
+            'pageSize': page_size,
+            'fields': f"nextPageToken, files({fields})",
+        }
+        if order_by:
+            params['orderBy'] = order_by
+        if shared_drive:
+            params['supportsAllDrives'] = 'true'
+            params['includeItemsFromAllDrives'] = 'true'
+        while True:
+            _, _, results = await self.__request('GET', f"{self.api_url}/files",
+                                                 params=params, as_json=True)
+            for file in results.get("files", []):
+                yield file
+            page_token = results.get("nextPageToken")
+            if not page_token:
+                return
+            params['pageToken'] = page_token
+
+    async def __committed_offset(self, uri: str, size: int) -> int:
+        """Ask Drive how many bytes of a resumable session are stored"""
+        status, headers, _ = await self.__request('PUT', uri, expect=(200, 201, 308),
+                                                  headers={'Content-Range': f"bytes */{size}"})
+        if status != 308:
+            # every byte is stored, the response of the last chunk was lost
+            return size
+        # Range: bytes=0-N, missing if nothing is stored yet
+        committed = headers.get('Range')
+        return int(committed.rsplit('-', 1)[1]) + 1 if committed else 0
+
+    async def __verify_upload(self, response: dict, checksums: Checksums) -> dict:
+        """Compare checksums of sent bytes with Drive, a corrupt copy is deleted"""
+        try:
+            checksums.verify(response)
+        except ChecksumError:
+            await self.delete(response['id'])
+            raise
+        return response
+
+    async def upload(self,
+                     file: str,
+                     folder_id: str=None,
+                     chunk_size: int=CHUNK_SIZE,
+                     progress=None,
+                     verify: bool=VERIFY_CHECKSUM
+        ) -> dict:
+        """Create new file with a resumable upload
+
+        Params:
+            file :       string     -> path of file
+            folder_id:   string     -> parent folder id (GCAPI_FOLDER_ID by default)
+            chunk_size:  int        -> upload chunk size (multiple of 256 KiB)
+            progress:    callable   -> progress(file, uploaded_bytes, total_bytes)
+            verify:      bool       -> compare md5/sha256 of sent bytes with Drive,
+                                       the uploaded file is deleted on mismatch
+
+        Session uri and committed offset are kept like GCDrive.upload does,
+        so an interrupted upload continues from the last committed chunk.
+        A chunk which fails with a transient error is sent again from the
+        offset which Drive committed.
+
+        Return:
+            json : proivde id of uploaded file and name of file
+        """
+        size = await asyncio.to_thread(os.path.getsize, file)
+        session = UploadSession(file)
+        uri, offset = None, 0
+        if await asyncio.to_thread(session.load):
+            try:
+                offset = await self.__committed_offset(session.uri, size)
+                uri = session.uri
+            except HttpError as e:
+                if e.resp.status not in (404, 410):
+                    raise
+                # session is expired, start from zero
+                await asyncio.to_thread(session.remove)
+                session = UploadSession(file)
+        if uri is None:
+            body = {
+                'name': os.path.basename(file),
+                'parents': [folder_id or FOLDER_ID]
+            }
+            _, headers, _ = await self.__request(
+                'POST', self.upload_url,
+                params={'uploadType': 'resumable', 'fields': CHECKSUM_FIELDS},
+                headers={'X-Upload-Content-Type': 'application/octet-stream',
+                         'X-Upload-Content-Length': str(size)},
+                json=body)
+            uri = headers['Location']
+            await asyncio.to_thread(session.save, uri=uri, offset=0, name=body['name'],
+                                    folder_id=body['parents'][0])
+
+        checksums = Checksums()
+        attempt = 0
+        f = await asyncio.to_thread(open, file, 'rb')
+        try:
+            while True:
+                if verify and offset > checksums.size:
+                    # resumed upload, bytes of an earlier run are hashed first
+                    await asyncio.to_thread(_hash_until, f, checksums, offset)
+                chunk = await asyncio.to_thread(_read_at, f, offset, chunk_size)
+                end = offset + len(chunk)
+                if verify and offset <= checksums.size < end:
+                    checksums.update(chunk[checksums.size - offset:])
+                await asyncio.sleep(upload_limit.reserve(len(chunk)))
+                content_range = f"bytes {offset}-{end - 1}/{size}" if chunk else f"bytes */{size}"
+                try:
+                    status, headers, result = await self.__request(
+                        'PUT', uri, expect=(200, 201, 308), as_json=True, retries=0,
+                        headers={'Content-Range': content_range}, data=chunk)
+                except Exception as error:
+                    if attempt == RETRIES or not _is_transient(error):
+                        raise
+                    await _sleep_before_retry(attempt, error)
+                    attempt += 1
+                    # part of the chunk may be stored, continue where Drive is
+                    offset = await self.__committed_offset(uri, size)
+                    continue
+                attempt = 0
+                if status != 308:
+                    await asyncio.to_thread(session.remove)
+                    if progress:
+                        progress(file, size, size)
+                    if verify:
+                        await self.__verify_upload(result, checksums)
+                    return result
+                committed = headers.get('Range')
+                offset = int(committed.rsplit('-', 1)[1]) + 1 if committed else 0
+                await asyncio.to_thread(session.save, uri=uri, offset=offset)
+                if progress:
+                    progress(file, offset, size)
+        finally:
+            await asyncio.to_thread(f.close)
+
+    async def __download_into(self, url: str, f, checksums: Checksums, chunk_size: int) -> None:
+        """Append content of url to f from its current size, hash what is written"""
+        session = self.get_session()
+        headers = await self.__headers()
+        written = await asyncio.to_thread(f.tell)
+        if written:
+            # continue a download which failed with a transient error
+            headers['Range'] = f"bytes={written}-"
+        async with self.__concurrency.slot():
+            async with session.get(url, params={'alt': 'media'}, headers=headers) as response:
+                await self.__raise_for_status(response, url, expect=(206,) if written else (200,))
+                async for chunk in response.content.iter_chunked(chunk_size):
+                    await asyncio.sleep(download_limit.reserve(len(chunk)))
+                    # disk writes do not block the event loop
+                    await asyncio.to_thread(f.write, chunk)
+                    if checksums is not None:
+                        checksums.update(chunk)
+
+    async def download(self,
+                       file_id: str,
+                       file_name: str=None,
+                       chunk_size: int=CHUNK_SIZE,
+                       verify: bool=VERIFY_CHECKSUM
+        ):
+        """
+        Download specific file on your Google Drive to GCAPI_BACKUP_FOLDER
+
+        Params:
+            file_id:    string -> item id
+            file_name:  string -> local file name (file id by default)
+            chunk_size: int    -> bytes written to disk at once
+            verify:     bool   -> compare md5/sha256 of written bytes with Drive,
+                                  the file is removed on mismatch
+
+        Return:
+            status:     boolean -> download proccess status
+            file:       string  -> downloaded file path
+        """
+        url = f"{self.api_url}/files/{file_id}"
+        file = os.path.join(BACKUP_FOLDER, file_name if file_name else file_id)
+        checksums = Checksums() if verify else None
+        f = await asyncio.to_thread(open, file, 'wb')
+        try:
+            for attempt in range(RETRIES + 1):
+                try:
+                    await self.__download_into(url, f, checksums, chunk_size)
+                    break
+                except Exception as error:
+                    if attempt == RETRIES or not _is_transient(error):
+                        raise
+                    await _sleep_before_retry(attempt, error)
+        finally:
+            await asyncio.to_thread(f.close)
+        if verify:
+            _, _, metadata = await self.__request('GET', url, params={'fields': CHECKSUM_FIELDS},
+                                                  as_json=True)
+            try:
+                checksums.verify(metadata)
+            except ChecksumError:
+                await asyncio.to_thread(os.remove, file)
+                raise
+        return True, file
+
+    async def delete(self,
+                     file_id: str
+        ) -> bool:
+        """Delete specific file
+
+        Params:
+            file_id :   string -> item id
+
+        Return:
+            True/False : boolean
+        """
+        # a retried delete finds the file deleted by the failed attempt, same as GCDrive
+        status, _, _ = await self.__request('DELETE', f"{self.api_url}/files/{file_id}",
+                                            expect=(200, 204), missing_ok=True)
+        return status in (200, 204, 404)
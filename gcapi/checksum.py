@@ -0,0 +1,59 @@
+"""
+End-to-end checksums
+
+Drive stores md5Checksum (and sha256Checksum) of every binary file. Hashes
+are computed while bytes go through the upload and download paths, so a
+file is never read a second time just to be verified:
+
+    checksums = Checksums()
+    checksums.update(chunk)        # for every chunk, in order
+    checksums.verify(drive_file)   # raises ChecksumError on mismatch
+"""
+import hashlib
+
+
+class ChecksumError(Exception):
+    """Local and Drive checksums of a file are different"""
+
+
+class Checksums:
+    """md5 and sha256 of data which is fed in order"""
+    def __init__(self) -> None:
+        self.md5 = hashlib.md5()
+        self.sha256 = hashlib.sha256()
+        self.size = 0
+
+    def update(self, data) -> None:
+        self.md5.update(data)
+        self.sha256.update(data)
+        self.size += len(data)
+
+    def verify(self, file: dict) -> None:
+        """
+        Compare with checksums of a Drive file
+
+        Params:
+            file: dict -> drive file with md5Checksum and/or sha256Checksum.
+                          Checksums which Drive did not return are skipped
+                          (e.g. Google Docs do not have any).
+        """
+        expected = {
+            'md5Checksum': self.md5.hexdigest(),
+            'sha256Checksum': self.sha256.hexdigest(),
+        }
+        for field, local in expected.items():
+            remote = file.get(field)
+            if remote and remote != local:
+                raise ChecksumError(f"{field} of {file.get('name') or file.get('id')} "
+                                    f"is {remote} on Drive, {local} locally")
+
+
+class HashingWriter:
+    """Writable file object which hashes everything written to fileobj"""
+    def __init__(self, fileobj, checksums: Checksums=None) -> None:
+        self._fileobj = fileobj
+        self.checksums = checksums or Checksums()
+
+    def write(self, data) -> int:
+        self.checksums.update(data)
+        return self._fileobj.write(data)
@@ -1,14 +1,32 @@
-from gcapi.cryption import Cryption
-from gcapi.drive import GCDrive
+"""
+gcapi command line interface
+
+Only click is imported at startup. Drive client, googleapiclient and
+cryptography are imported inside the commands which use them, so
+`gcapi --help` and argument errors return immediately.
+
+Startup time:
+    python -X importtime -m gcapi.cli --help
+"""
 import click
 import os
 
 
-__cls = GCDrive()
-__cryption = Cryption()
-
 FOLDER_ID = os.environ.get('GCAPI_FOLDER_ID', None)
 
+
+def get_drive():
+    """Drive client, created on first use"""
+    from gcapi.drive import GCDrive
+    return GCDrive()
+
+
+def get_cryption():
+    """Cryption, created on first use"""
+    from gcapi.cryption import Cryption
+    return Cryption()
+
+
 @click.group()
 def main():
     pass
@@ -18,44 +36,57 @@ def main():
 @click.option('-f', '--file', type=str, help='GPG Key file or file path')
 def import_key(file):
     if file:
-        status = __cryption.import_keys(file)
+        status = get_cryption().import_keys(file)
         click.echo(message=status)
 
 @main.command()
 @click.option("-e", "--encrypt", is_flag=True , help="Encrypt file with GPG")
 @click.option("-f", "--file", type=str, help="Specific file path")
-def upload(encrypt, file=None):
+@click.option("--dedup", is_flag=True, help="Copy the file on Drive if its content is already there")
+def upload(encrypt, dedup, file=None):
     if file:
         if encrypt:
-            status, encrypt_file = __cryption.encrypt_file(
+            status, encrypt_file = get_cryption().encrypt_file(
                 file=file
             )
-            return ... if status else click.echo("Fail: Encryption error!")
+            if not status:
+                return click.echo("Fail: Encryption error!")
+            file = encrypt_file
         
-        response = __cls.upload(
-            file=encrypt_file if status else file,
-            folder_id=FOLDER_ID)
+        from gcapi.drive import DEDUP
+        response = get_drive().upload(
+            file=file,
+            folder_id=FOLDER_ID,
+            dedup=dedup or DEDUP)
         
         click.echo(response)
     
 @main.command()
 @click.option("-d", "--decrypt", is_flag=True, help="Decrypt downloaded file")
-@click.option("-f", "--file", type=str, help="File name")
+@click.option("-f", "--file", "file_name", type=str, help="File name")
 def download(decrypt, file_name=None):
     if file_name:
+        _drive = get_drive()
         # get file id according to file name from google drive
-        file_id = __cls.get_by_name(
-            file_name=file_name).get('id')
+        found = _drive.get_by_name(file_name=file_name)
+        if not found:
+            return click.echo(f"{file_name} is not found on google drive")
         
         # download file
-        status, file = __cls.download(file_id=file_id)
+        status, file = _drive.download(file_id=found.get('id'), file_name=file_name)
         if status:
             if decrypt:
-                decrypt_status, decrypt_file = __cryption.decrypt_file(file=file)
+                decrypt_status, decrypt_file = get_cryption().decrypt_file(file=file)
+                if not decrypt_status:
+                    return click.echo("Fail: Decryption error!")
                 # remove .gpg file if decrypt proccess success
-                os.remove(file) if decrypt_status else ...
+                os.remove(file)
+                file = decrypt_file
                 
-            click.echo(f"File save to {decrypt_file if decrypt else file} path")
+            click.echo(f"File save to {file} path")
         else:
             click.echo("There is a problem while downloding file from google drive")
-             
\ No newline at end of file
+
+
+if __name__ == '__main__':
+    main()
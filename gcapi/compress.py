@@ -1,64 +1,249 @@
 import gzip
 import shutil
-import tarfile
 import os
+import collections
+from concurrent.futures import ThreadPoolExecutor
+from gcapi.archive import write_tar, extract_tar
 
-def compress_file(filepath: str) -> str:
+try:
+    import zstandard
+except ImportError:  # optional, pip install py-googledrive[zstd]
+    zstandard = None
+
+
+# default codec: gzip, pgzip (multi-threaded block gzip) or zstd
+COMPRESS_CODEC = os.environ.get('GCAPI_COMPRESS_CODEC', 'gzip')
+COMPRESS_LEVEL = int(os.environ.get('GCAPI_COMPRESS_LEVEL', 6))
+COMPRESS_THREADS = int(os.environ.get('GCAPI_COMPRESS_THREADS', os.cpu_count() or 1))
+BUFFER_SIZE = int(os.environ.get('GCAPI_BUFFER_SIZE', 1024 * 1024))
+
+GZIP_MAGIC = b'\x1f\x8b'
+ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+
+
+class ParallelGzipWriter:
+    """
+    pigz-style gzip writer
+
+    Input is cut into blocks which are compressed by a thread pool
+    (zlib releases the GIL) and written in order as separate gzip members.
+    Multi-member gzip is a valid gzip file, any gzip reader can read it.
+    """
+    def __init__(self, fileobj, level: int=COMPRESS_LEVEL,
+                 threads: int=COMPRESS_THREADS, block_size: int=BUFFER_SIZE) -> None:
+        self._fileobj = fileobj
+        self._level = level
+        self._block_size = block_size
+        self._buffer = bytearray()
+        self._pool = ThreadPoolExecutor(max_workers=threads)
+        # compressed blocks in input order, bounded to keep memory low
+        self._pending = collections.deque()
+        self._max_pending = threads * 2
+
+    def __submit(self, block: bytes) -> None:
+        self._pending.append(self._pool.submit(gzip.compress, block, self._level, mtime=0))
+        while len(self._pending) > self._max_pending:
+            self._fileobj.write(self._pending.popleft().result())
+
+    def write(self, data) -> int:
+        self._buffer += data
+        while len(self._buffer) >= self._block_size:
+            self.__submit(bytes(self._buffer[:self._block_size]))
+            del self._buffer[:self._block_size]
+        return len(data)
+
+    def close(self) -> None:
+        if self._buffer or not self._pending:
+            self.__submit(bytes(self._buffer))
+            self._buffer.clear()
+        while self._pending:
+            self._fileobj.write(self._pending.popleft().result())
+        self._pool.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+
+def compress_writer(fileobj,
+                    codec: str=COMPRESS_CODEC,
+                    level: int=COMPRESS_LEVEL,
+                    threads: int=COMPRESS_THREADS,
+                    buffer_size: int=BUFFER_SIZE):
+    """Writable file object which compresses into fileobj"""
+    if codec == 'gzip':
+        # no name and time in header, same input gives same output (upload dedup)
+        return gzip.GzipFile(filename='', fileobj=fileobj, mode='wb',
+                             compresslevel=level, mtime=0)
+    if codec == 'pgzip':
+        return ParallelGzipWriter(fileobj, level=level, threads=threads,
+                                  block_size=buffer_size)
+    if codec == 'zstd':
+        if zstandard is None:
+            raise ImportError("zstd codec needs zstandard package: pip install zstandard")
+        compressor = zstandard.ZstdCompressor(level=level, threads=threads)
+        return compressor.stream_writer(fileobj, closefd=False)
+    raise ValueError(f"Unknown compression codec: {codec}")
+
+
+def uncompress_reader(fileobj):
+    """Readable file object which uncompresses fileobj, codec is detected by magic bytes"""
+    if hasattr(fileobj, 'peek'):
+        # buffered streams (e.g. process stdout) do not have to be seekable
+        magic = fileobj.peek(4)[:4]
+    else:
+        magic = fileobj.read(4)
+        fileobj.seek(-len(magic), os.SEEK_CUR)
+    if magic.startswith(GZIP_MAGIC):
+        return gzip.GzipFile(fileobj=fileobj, mode='rb')
+    if magic.startswith(ZSTD_MAGIC):
+        if zstandard is None:
+            raise ImportError("zstd codec needs zstandard package: pip install zstandard")
+        return zstandard.ZstdDecompressor().stream_reader(fileobj, closefd=False)
+    raise ValueError("Unknown compression format")
+
+
+def extension(codec: str=COMPRESS_CODEC) -> str:
+    """File extension of codec"""
+    return '.zst' if codec == 'zstd' else '.gz'
+
+
+def compress_stream(src, dst,
+                    codec: str=COMPRESS_CODEC,
+                    level: int=COMPRESS_LEVEL,
+                    threads: int=COMPRESS_THREADS,
+                    buffer_size: int=BUFFER_SIZE) -> None:
+    """
+    Compress readable stream src into writable stream dst.
+
+    Params:
+        codec: str -> gzip, pgzip (parallel gzip) or zstd
+        level: int -> Compression level
+        threads: int -> Worker threads of pgzip and zstd
+        buffer_size: int -> Read size and pgzip block size
+    """
+    writer = compress_writer(dst, codec, level, threads, buffer_size)
+    try:
+        shutil.copyfileobj(src, writer, buffer_size)
+    finally:
+        writer.close()
+
+
+def uncompress_stream(src, dst, buffer_size: int=BUFFER_SIZE) -> None:
+    """
+    Uncompress readable stream src (seekable or buffered) into writable stream dst.
+    Codec is detected by magic bytes.
+    """
+    reader = uncompress_reader(src)
+    try:
+        shutil.copyfileobj(reader, dst, buffer_size)
+    finally:
+        reader.close()
+
+
+def compress_file(filepath: str,
+                  codec: str=COMPRESS_CODEC,
+                  level: int=COMPRESS_LEVEL,
+                  threads: int=COMPRESS_THREADS,
+                  buffer_size: int=BUFFER_SIZE) -> str:
     """
-    Compress file with gzip.
-    
+    Compress file with gzip, parallel gzip or zstd.
+
     Params:
         filepath: str -> File path
-        
+        codec: str -> gzip, pgzip (parallel gzip) or zstd
+        level: int -> Compression level
+        threads: int -> Worker threads of pgzip and zstd
+        buffer_size: int -> Read size and pgzip block size
+
     Return:
         zipped file path
     """
-    newfile = f'{filepath}.gz'
+    newfile = f'{filepath}{extension(codec)}'
     # open file which is do you want to zip
     with open(filepath, 'rb') as f_in:
-        # open new file with gzip
-        # and write old datas to here
-        with gzip.open(newfile, 'wb') as f_out:
-            shutil.copyfileobj(f_in, f_out)
-            
+        # open new file and write compressed datas to here
+        with open(newfile, 'wb') as f_out:
+            compress_stream(f_in, f_out, codec=codec, level=level,
+                            threads=threads, buffer_size=buffer_size)
+
     return newfile
 
 
-def uncompress_file(filepath: str) -> str:
+def compress_command(level: int=COMPRESS_LEVEL,
+                     codec: str=COMPRESS_CODEC,
+                     threads: int=COMPRESS_THREADS) -> list:
+    """
+    Compress command which compresses stdin to stdout.
+
+    Params:
+        level: int -> Compression level
+        codec: str -> gzip, pgzip (pigz) or zstd
+        threads: int -> Threads of pigz and zstd
+
+    Return:
+        command as argument list
+    """
+    if codec == 'pgzip':
+        return ["pigz", "-c", "-p", str(threads), f"-{level}"]
+    if codec == 'zstd':
+        return ["zstd", "-c", "-q", f"-T{threads}", f"-{level}"]
+    return ["gzip", "-c", f"-{level}"]
+
+
+def uncompress_command(codec: str='gzip') -> list:
+    """
+    Uncompress command which uncompresses stdin to stdout.
+
+    Params:
+        codec: str -> gzip (also for pgzip output) or zstd
+
+    Return:
+        command as argument list
+    """
+    if codec == 'zstd':
+        return ["zstd", "-d", "-c", "-q"]
+    return ["gzip", "-d", "-c"]
+
+
+def uncompress_file(filepath: str, buffer_size: int=BUFFER_SIZE) -> str:
     """
-    Uncompress gzipped file with gzip.
-    
+    Uncompress gzipped or zstd compressed file, codec is detected by magic bytes.
+
     Params:
         filepath: str -> File path
-        
+
     Return:
         unzipped file path
     """
-    # open gzipped file
-    with gzip.open(filepath, 'rb') as f_in:
-        # remove .gz extantion
-        extracted_file = filepath[:-3]
-        # create new file and copy file
+    # remove .gz / .zst extantion, other names would overwrite a sibling file
+    extracted_file, suffix = os.path.splitext(filepath)
+    if suffix not in ('.gz', '.zst'):
+        raise ValueError(f"{filepath} has no .gz or .zst extension")
+    # open compressed file, create new file and copy file
+    with open(filepath, 'rb') as f_in:
         with open(extracted_file, 'wb') as f_out:
-            shutil.copyfileobj(f_in, f_out)
-    
+            uncompress_stream(f_in, f_out, buffer_size=buffer_size)
+
     return extracted_file
 
 
 def compress_folder(folder_path, tar_path):
     """
     Compresses a folder into a tar archive asynchronously.
-    
+
     Args:
         folder_path (str): Path to the folder to compress.
         tar_path (str): Path to save the compressed tar archive.
-        
+
     Returns:
         tuple: A tuple containing a boolean indicating success or failure and the path to the compressed tar archive.
     """
     try:
-        with tarfile.open(tar_path, 'w') as tar:
-            tar.add(folder_path, os.path.basename(folder_path))
+        with open(tar_path, 'wb') as f:
+            write_tar(folder_path, f, arcroot=os.path.basename(folder_path))
         return True, tar_path
     except Exception as e:
         return False, str(e)
@@ -66,15 +251,18 @@ def compress_folder(folder_path, tar_path):
 def uncompress_folder(tar_path, extract_dir):
     """
     Uncompresses a tar archive into a directory.
-    
+
     Args:
         tar_path (str): Path to the tar archive to uncompress.
         extract_dir (str): Directory to extract the contents into.
     """
     try:
-        with tarfile.open(tar_path, 'r') as tar:
-            tar.extractall(path=extract_dir)
+        with open(tar_path, 'rb') as f:
+            magic = f.read(4)
+            f.seek(0)
+            # plain tar or tar compressed with one of the codecs
+            fileobj = uncompress_reader(f) if magic.startswith((GZIP_MAGIC, ZSTD_MAGIC)) else f
+            extract_tar(fileobj, extract_dir)
         return True, extract_dir
     except Exception as e:
         return False, str(e)
-
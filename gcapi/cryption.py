@@ -1,12 +1,725 @@
 import os
+import struct
+import shutil
+import tempfile
+import threading
 import subprocess
-from dotenv import load_dotenv
-load_dotenv()
+import collections
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from cryptography.exceptions import InvalidTag
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM, ChaCha20Poly1305
+
 
 BACKUP_FOLDER = os.environ.get('GCAPI_BACKUP_FOLDER')
 GPG_RECIPIENT = os.environ.get('GCAPI_GPG_RECIPIENT')
+# gpg: whole stream through gpg, aead: chunked AEAD with gpg wrapped data key
+CRYPTION_MODE = os.environ.get('GCAPI_CRYPTION_MODE', 'gpg')
+AEAD_CIPHER = os.environ.get('GCAPI_AEAD_CIPHER', 'aes-gcm')
+AEAD_CHUNK_SIZE = int(os.environ.get('GCAPI_AEAD_CHUNK_SIZE', 1024 * 1024))
+CRYPTION_THREADS = int(os.environ.get('GCAPI_CRYPTION_THREADS', os.cpu_count() or 1))
+BUFFER_SIZE = 1024 * 1024
+
+# processes which seal or open chunks of a file (encrypt_file / decrypt_file)
+CRYPTION_PROCESSES = int(os.environ.get('GCAPI_CRYPTION_PROCESSES', os.cpu_count() or 1))
+# chunks which one pool task seals or opens
+BATCH_CHUNKS = 16
+
+# AEAD envelope:
+#   header: magic | cipher id (1) | chunk size (4) | nonce prefix (4) | key length (4) | wrapped key
+#   chunks: independently sealed chunks of chunk size plaintext, last one may be shorter
+#   index:  sealed chunk count (8) and plaintext size (8), always INDEX_SIZE bytes
+# Nonce of chunk N is nonce prefix + N (8), header is the associated data of
+# every chunk. Chunk N starts at header size + N * (chunk size + TAG_SIZE), so
+# any byte range can be decrypted without the chunks before it. The index
+# rejects reordered, truncated or extended envelopes.
+AEAD_MAGIC = b'GCAPIAE\x01'
+AEAD_CIPHERS = {
+    'aes-gcm': (1, AESGCM),
+    'chacha20': (2, ChaCha20Poly1305),
+}
+TAG_SIZE = 16
+_HEADER = struct.Struct('>BI4sI')
+_INDEX = struct.Struct('>QQ')
+INDEX_SIZE = _INDEX.size + TAG_SIZE
+INDEX_NONCE = b'\xff' * 8
+
+
+class _ProcessStream:
+    """Base of file objects which run data through a command"""
+    def _start(self, command: list) -> None:
+        self._command = command
+        # a temporary file, not a pipe: nobody reads stderr before the command
+        # exits, so a full stderr pipe would block it forever
+        self._stderr = tempfile.TemporaryFile()
+        self._process = subprocess.Popen(command, stdin=subprocess.PIPE,
+                                         stdout=subprocess.PIPE, stderr=self._stderr)
+
+    def _wait(self) -> None:
+        self._process.wait()
+        if self._thread is not None:
+            self._thread.join()
+        try:
+            if self._error is not None:
+                raise self._error
+            if self._process.returncode != 0:
+                self._stderr.seek(0)
+                error = self._stderr.read().decode(errors='replace').strip()
+                raise RuntimeError(f"{self._command[0]} failed: {error}")
+        finally:
+            self._stderr.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc) -> None:
+        if exc_type is None:
+            self.close()
+            return
+        self._process.kill()
+        try:
+            self.close()
+        except Exception:
+            # error of the killed command would hide the original one
+            pass
+
+
+class ProcessWriter(_ProcessStream):
+    """
+    Writable file object, written data goes through a command (e.g. gpg)
+    and its output is written to fileobj by a background thread.
+    """
+    def __init__(self, fileobj, command: list) -> None:
+        self._error = None
+        self._start(command)
+        self._thread = threading.Thread(target=self.__copy, args=(fileobj,), daemon=True)
+        self._thread.start()
+
+    def __copy(self, fileobj) -> None:
+        try:
+            shutil.copyfileobj(self._process.stdout, fileobj, BUFFER_SIZE)
+        except Exception as e:
+            self._error = e
+            self._process.kill()
+
+    def write(self, data) -> int:
+        self._process.stdin.write(data)
+        return len(data)
+
+    def close(self) -> None:
+        if not self._process.stdin.closed:
+            try:
+                self._process.stdin.close()
+            except BrokenPipeError:
+                pass
+            self._wait()
+
+
+class ProcessReader(_ProcessStream):
+    """
+    Readable file object, fileobj is fed to a command (e.g. gpg)
+    by a background thread and its output is read.
+    """
+    def __init__(self, fileobj, command: list) -> None:
+        self._error = None
+        self._closed = False
+        self._start(command)
+        self._thread = threading.Thread(target=self.__feed, args=(fileobj,), daemon=True)
+        self._thread.start()
+
+    def __feed(self, fileobj) -> None:
+        try:
+            shutil.copyfileobj(fileobj, self._process.stdin, BUFFER_SIZE)
+        except BrokenPipeError:
+            # command exited early, its exit code tells why
+            pass
+        except Exception as e:
+            self._error = e
+            self._process.kill()
+        finally:
+            try:
+                self._process.stdin.close()
+            except BrokenPipeError:
+                pass
+
+    def read(self, size: int=-1) -> bytes:
+        data = self._process.stdout.read(size)
+        if not data and size != 0:
+            # end of output, make sure it is complete
+            self.close()
+        return data
+
+    def close(self) -> None:
+        if not self._closed:
+            self._closed = True
+            self._wait()
+
+
+class _ThreadStream:
+    """
+    File object of one end of a pipe whose other end is served by a thread.
+    Errors of the thread are raised at the end of the stream or on close.
+    """
+    def __init__(self, fileobj, target) -> None:
+        self._fileobj = fileobj
+        self._error = None
+        self._closed = False
+        self._thread = threading.Thread(target=self.__run, args=(target,), daemon=True)
+        self._thread.start()
+
+    def __run(self, target) -> None:
+        try:
+            target()
+        except Exception as e:
+            self._error = e
+
+    def read(self, size: int=-1) -> bytes:
+        data = self._fileobj.read(size)
+        if not data and size != 0:
+            self.close()
+        return data
+
+    def write(self, data) -> int:
+        try:
+            return self._fileobj.write(data)
+        except BrokenPipeError:
+            # thread stopped reading, its error is the real one
+            self.close()
+            raise
+
+    def close(self) -> None:
+        if self._closed:
+            return
+        self._closed = True
+        try:
+            self._fileobj.close()
+        except BrokenPipeError:
+            pass
+        self._thread.join()
+        if self._error is not None:
+            raise self._error
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc) -> None:
+        if exc_type is None:
+            self.close()
+            return
+        try:
+            self.close()
+        except Exception:
+            # keep the original error
+            pass
+
+
+class Envelope:
+    """Header of an AEAD envelope and layout of its chunks"""
+    def __init__(self, cipher_id: int, chunk_size: int, nonce_prefix: bytes,
+                 wrapped_key: bytes) -> None:
+        self.cipher_class = {cid: cls for cid, cls in AEAD_CIPHERS.values()}.get(cipher_id)
+        if self.cipher_class is None:
+            raise ValueError(f"Unknown AEAD cipher: {cipher_id}")
+        self.cipher_id = cipher_id
+        self.chunk_size = chunk_size
+        self.nonce_prefix = nonce_prefix
+        self.wrapped_key = wrapped_key
+        self.header = AEAD_MAGIC + _HEADER.pack(cipher_id, chunk_size, nonce_prefix,
+                                                len(wrapped_key)) + wrapped_key
+        self.sealed_size = chunk_size + TAG_SIZE
+
+    @classmethod
+    def new(cls, wrapped_key: bytes, cipher: str=AEAD_CIPHER,
+            chunk_size: int=AEAD_CHUNK_SIZE) -> 'Envelope':
+        """Envelope with a random nonce prefix"""
+        return cls(AEAD_CIPHERS[cipher][0], chunk_size, os.urandom(4), wrapped_key)
+
+    @classmethod
+    def read(cls, read) -> 'Envelope':
+        """
+        Parse header of an envelope
+
+        Params:
+            read: callable -> read(size) returns next bytes of the envelope
+        """
+        fixed = read(len(AEAD_MAGIC) + _HEADER.size)
+        if len(fixed) < len(AEAD_MAGIC) + _HEADER.size or not fixed.startswith(AEAD_MAGIC):
+            raise ValueError("Not an AEAD envelope")
+        cipher_id, chunk_size, nonce_prefix, key_length = _HEADER.unpack(fixed[len(AEAD_MAGIC):])
+        wrapped_key = read(key_length)
+        if len(wrapped_key) != key_length:
+            raise ValueError("AEAD envelope is truncated")
+        return cls(cipher_id, chunk_size, nonce_prefix, wrapped_key)
+
+    def aead(self, key: bytes):
+        return self.cipher_class(key)
+
+    def chunk_count(self, size: int) -> int:
+        """Number of chunks of size bytes of plaintext"""
+        return -(-size // self.chunk_size)
+
+    def chunk_offset(self, index: int) -> int:
+        """Position of a sealed chunk in the envelope"""
+        return len(self.header) + index * self.sealed_size
+
+    def index_offset(self, size: int) -> int:
+        """Position of the index in an envelope of size bytes of plaintext"""
+        return len(self.header) + size + self.chunk_count(size) * TAG_SIZE
+
+    def seal_chunk(self, aead, index: int, data: bytes) -> bytes:
+        return aead.encrypt(self.nonce_prefix + struct.pack('>Q', index), data, self.header)
+
+    def open_chunk(self, aead, index: int, sealed: bytes) -> bytes:
+        return aead.decrypt(self.nonce_prefix + struct.pack('>Q', index), sealed, self.header)
+
+    def seal_index(self, aead, count: int, size: int) -> bytes:
+        return aead.encrypt(self.nonce_prefix + INDEX_NONCE, _INDEX.pack(count, size),
+                            self.header + b'index')
+
+    def open_index(self, aead, sealed: bytes) -> tuple:
+        """
+        Return:
+            count:  int -> number of chunks
+            size:   int -> plaintext size
+        """
+        count, size = _INDEX.unpack(aead.decrypt(self.nonce_prefix + INDEX_NONCE, sealed,
+                                                 self.header + b'index'))
+        if count != self.chunk_count(size):
+            raise ValueError("AEAD envelope index is invalid")
+        return count, size
+
+
+class AEADWriter:
+    """
+    Writable file object which encrypts into fileobj as AEAD envelope.
+    Chunks are sealed by a thread pool and written in order.
+    """
+    def __init__(self, fileobj, key: bytes, wrapped_key: bytes,
+                 cipher: str=AEAD_CIPHER, chunk_size: int=AEAD_CHUNK_SIZE,
+                 threads: int=CRYPTION_THREADS) -> None:
+        self._fileobj = fileobj
+        self._envelope = Envelope.new(wrapped_key, cipher=cipher, chunk_size=chunk_size)
+        self._aead = self._envelope.aead(key)
+        self._fileobj.write(self._envelope.header)
+        self._count = 0
+        self._size = 0
+        self._buffer = bytearray()
+        self._pool = ThreadPoolExecutor(max_workers=threads)
+        self._pending = collections.deque()
+        self._max_pending = threads * 2
+        self._closed = False
+
+    def __seal(self, chunk: bytes) -> None:
+        self._pending.append(self._pool.submit(self._envelope.seal_chunk,
+                                               self._aead, self._count, chunk))
+        self._count += 1
+        self._size += len(chunk)
+        while len(self._pending) > self._max_pending:
+            self._fileobj.write(self._pending.popleft().result())
+
+    def write(self, data) -> int:
+        self._buffer += data
+        chunk_size = self._envelope.chunk_size
+        while len(self._buffer) >= chunk_size:
+            self.__seal(bytes(self._buffer[:chunk_size]))
+            del self._buffer[:chunk_size]
+        return len(data)
+
+    def close(self) -> None:
+        if self._closed:
+            return
+        self._closed = True
+        if self._buffer:
+            self.__seal(bytes(self._buffer))
+            self._buffer.clear()
+        while self._pending:
+            self._fileobj.write(self._pending.popleft().result())
+        self._fileobj.write(self._envelope.seal_index(self._aead, self._count, self._size))
+        self._pool.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+
+class AEADReader:
+    """
+    Readable file object which decrypts an AEAD envelope from fileobj.
+    unwrap_key gets the wrapped data key of the header and returns the key.
+    """
+    def __init__(self, fileobj, unwrap_key, threads: int=CRYPTION_THREADS) -> None:
+        self._fileobj = fileobj
+        self._envelope = Envelope.read(self.__read_exact)
+        self._aead = self._envelope.aead(unwrap_key(self._envelope.wrapped_key))
+        self._count = 0
+        self._size = 0
+        self._final = False
+        # bytes read ahead, the index is only known at the end of the stream
+        self._tail = b''
+        self._buffer = b''
+        self._pool = ThreadPoolExecutor(max_workers=threads)
+        self._pending = collections.deque()
+        self._max_pending = threads * 2
+
+    def __read_exact(self, size: int) -> bytes:
+        data = b''
+        while len(data) < size:
+            block = self._fileobj.read(size - len(data))
+            if not block:
+                break
+            data += block
+        return data
+
+    def __submit(self) -> bool:
+        """Queue next chunk for decryption, False after the index"""
+        if self._final:
+            return False
+        sealed_size = self._envelope.sealed_size
+        need = sealed_size + INDEX_SIZE
+        data = self._tail + self.__read_exact(need - len(self._tail))
+        if len(data) == need:
+            # a full chunk, index is still ahead
+            sealed, self._tail = data[:sealed_size], data[sealed_size:]
+        else:
+            # end of stream: last chunk (may be none) and index
+            if len(data) < INDEX_SIZE or 0 < len(data) - INDEX_SIZE <= TAG_SIZE:
+                raise ValueError("AEAD envelope is truncated")
+            sealed, index = data[:-INDEX_SIZE], data[-INDEX_SIZE:]
+            self._final = True
+            self._tail = b''
+            count, size = self._envelope.open_index(self._aead, index)
+            last = len(sealed) - TAG_SIZE if sealed else 0
+            if (count, size) != (self._count + bool(sealed), self._size + last):
+                raise ValueError("AEAD envelope is truncated")
+            if not sealed:
+                return True
+        self._pending.append(self._pool.submit(self._envelope.open_chunk,
+                                               self._aead, self._count, sealed))
+        self._count += 1
+        self._size += len(sealed) - TAG_SIZE
+        return True
+
+    def read(self, size: int=-1) -> bytes:
+        while size < 0 or len(self._buffer) < size:
+            while len(self._pending) < self._max_pending and self.__submit():
+                pass
+            if not self._pending:
+                break
+            self._buffer += self._pending.popleft().result()
+        if size < 0:
+            size = len(self._buffer)
+        data, self._buffer = self._buffer[:size], self._buffer[size:]
+        return data
+
+    def close(self) -> None:
+        self._pool.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+
+class EnvelopeFile:
+    """
+    Random access to an AEAD envelope. read_at(offset, size) returns bytes of
+    the envelope, e.g. a range request to Google Drive, so only the chunks
+    of a requested range are fetched and decrypted.
+    """
+    def __init__(self, read_at, size: int, unwrap_key) -> None:
+        """
+        Params:
+            read_at:    callable -> read_at(offset, size) returns bytes of the envelope
+            size:       int      -> size of the envelope
+            unwrap_key: callable -> returns data key of the wrapped key in the header
+        """
+        self._read_at = read_at
+        position = 0
+
+        def read(length: int) -> bytes:
+            nonlocal position
+            data = read_at(position, length)
+            position += len(data)
+            return data
+
+        self.envelope = Envelope.read(read)
+        self.key = unwrap_key(self.envelope.wrapped_key)
+        self._aead = self.envelope.aead(self.key)
+        if size < len(self.envelope.header) + INDEX_SIZE:
+            raise ValueError("AEAD envelope is truncated")
+        self.count, self.size = self.envelope.open_index(
+            self._aead, read_at(size - INDEX_SIZE, INDEX_SIZE))
+        if self.envelope.index_offset(self.size) != size - INDEX_SIZE:
+            raise ValueError("AEAD envelope is truncated")
+
+    def read_range(self, start: int, end: int) -> bytes:
+        """
+        Decrypt plaintext bytes [start, end)
+
+        Params:
+            start:  int -> first byte
+            end:    int -> byte after the last one
+        """
+        end = min(end, self.size)
+        if start >= end:
+            return b''
+        envelope = self.envelope
+        first = start // envelope.chunk_size
+        last = (end - 1) // envelope.chunk_size
+        offset = envelope.chunk_offset(first)
+        sealed = self._read_at(offset, min(envelope.chunk_offset(last + 1),
+                                           envelope.index_offset(self.size)) - offset)
+        plain = b''.join(
+            envelope.open_chunk(self._aead, index,
+                                sealed[(index - first) * envelope.sealed_size:
+                                       (index - first + 1) * envelope.sealed_size])
+            for index in range(first, last + 1))
+        skip = start - first * envelope.chunk_size
+        return plain[skip:skip + end - start]
+
+    def decrypt_to(self, file: str, range_size: int=16 * 1024 * 1024,
+                   max_workers: int=CRYPTION_THREADS) -> str:
+        """
+        Fetch chunk aligned ranges in parallel, decrypt every range as it
+        arrives and write it to its place in file
+
+        Params:
+            file:           str -> output path
+            range_size:     int -> plaintext bytes of one range
+            max_workers:    int -> ranges fetched at the same time
+
+        Return:
+            file
+        """
+        span = max(1, range_size // self.envelope.chunk_size) * self.envelope.chunk_size
+        fd = os.open(file, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            os.ftruncate(fd, self.size)
+
+            def fetch(start: int) -> None:
+                os.pwrite(fd, self.read_range(start, start + span), start)
+
+            with ThreadPoolExecutor(max_workers=max_workers) as pool:
+                for future in [pool.submit(fetch, start) for start in range(0, self.size, span)]:
+                    future.result()
+        finally:
+            os.close(fd)
+        return file
+
+
+def _seal_chunks(envelope: Envelope, aead, source: str, target: str, size: int,
+                 first: int, last: int) -> None:
+    """Seal chunks [first, last) of source (size bytes) into their place in target"""
+    source_fd = os.open(source, os.O_RDONLY)
+    target_fd = os.open(target, os.O_WRONLY)
+    try:
+        for index in range(first, last):
+            start = index * envelope.chunk_size
+            data = os.pread(source_fd, min(envelope.chunk_size, size - start), start)
+            if len(data) != min(envelope.chunk_size, size - start):
+                raise RuntimeError(f"{source} changed while it was encrypted")
+            os.pwrite(target_fd, envelope.seal_chunk(aead, index, data),
+                      envelope.chunk_offset(index))
+    finally:
+        os.close(source_fd)
+        os.close(target_fd)
+
+
+def _open_chunks(envelope: Envelope, aead, source: str, target: str, size: int,
+                 first: int, last: int) -> None:
+    """Open chunks [first, last) of source (size bytes of plaintext) into their place in target"""
+    source_fd = os.open(source, os.O_RDONLY)
+    target_fd = os.open(target, os.O_WRONLY)
+    try:
+        for index in range(first, last):
+            start = index * envelope.chunk_size
+            sealed = os.pread(source_fd, min(envelope.chunk_size, size - start) + TAG_SIZE,
+                              envelope.chunk_offset(index))
+            os.pwrite(target_fd, envelope.open_chunk(aead, index, sealed),
+                      index * envelope.chunk_size)
+    finally:
+        os.close(source_fd)
+        os.close(target_fd)
+
+
+# envelope and cipher of a pool worker process, see _run_chunks
+_worker = {}
+
+
+def _init_worker(cipher_id: int, chunk_size: int, nonce_prefix: bytes,
+                 wrapped_key: bytes, key: bytes) -> None:
+    _worker['envelope'] = Envelope(cipher_id, chunk_size, nonce_prefix, wrapped_key)
+    _worker['aead'] = _worker['envelope'].aead(key)
+
+
+def _in_worker(func, *args) -> None:
+    func(_worker['envelope'], _worker['aead'], *args)
+
+
+def _run_chunks(func, envelope: Envelope, key: bytes, size: int,
+                source: str, target: str, processes: int) -> None:
+    """Run func on batches of chunks, in a process pool if there is more than one batch"""
+    count = envelope.chunk_count(size)
+    batches = [(first, min(first + BATCH_CHUNKS, count))
+               for first in range(0, count, BATCH_CHUNKS)]
+    if processes <= 1 or len(batches) <= 1:
+        aead = envelope.aead(key)
+        for first, last in batches:
+            func(envelope, aead, source, target, size, first, last)
+        return
+    initargs = (envelope.cipher_id, envelope.chunk_size, envelope.nonce_prefix,
+                envelope.wrapped_key, key)
+    # spawn, not fork: the caller runs thread pools (service pool, upload_many)
+    # and a forked child can inherit their locks in a held state
+    with ProcessPoolExecutor(max_workers=processes, initializer=_init_worker,
+                             initargs=initargs,
+                             mp_context=multiprocessing.get_context('spawn')) as pool:
+        futures = [pool.submit(_in_worker, func, source, target, size, first, last)
+                   for first, last in batches]
+        for future in futures:
+            future.result()
+
+
+def seal_file(source: str, target: str, key: bytes, wrapped_key: bytes,
+              cipher: str=AEAD_CIPHER, chunk_size: int=AEAD_CHUNK_SIZE,
+              processes: int=CRYPTION_PROCESSES) -> str:
+    """
+    Encrypt source file into target as AEAD envelope, chunks are sealed
+    in parallel by a process pool and written to their place in target
+
+    Return:
+        target
+    """
+    size = os.path.getsize(source)
+    envelope = Envelope.new(wrapped_key, cipher=cipher, chunk_size=chunk_size)
+    count = envelope.chunk_count(size)
+    with open(target, 'wb') as f:
+        f.write(envelope.header)
+        f.truncate(envelope.index_offset(size))
+    _run_chunks(_seal_chunks, envelope, key, size, source, target, processes)
+    with open(target, 'r+b') as f:
+        f.seek(envelope.index_offset(size))
+        f.write(envelope.seal_index(envelope.aead(key), count, size))
+    return target
+
+
+def open_file(source: str, target: str, unwrap_key,
+              processes: int=CRYPTION_PROCESSES) -> str:
+    """
+    Decrypt AEAD envelope source into target, chunks are opened in
+    parallel by a process pool and written to their place in target
+
+    Return:
+        target
+    """
+    with open(source, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        file = EnvelopeFile(read_at=lambda offset, length: os.pread(f.fileno(), length, offset),
+                            size=size, unwrap_key=unwrap_key)
+    with open(target, 'wb') as f:
+        f.truncate(file.size)
+    _run_chunks(_open_chunks, file.envelope, file.key, file.size, source, target, processes)
+    return target
+
 
 class Cryption:
+    def __init__(self, mode: str=CRYPTION_MODE, cipher: str=AEAD_CIPHER) -> None:
+        """
+        Params:
+            mode:   str -> gpg or aead (chunked AES-GCM / ChaCha20-Poly1305, 
+                           data key is encrypted with GPG recipient)
+            cipher: str -> aes-gcm or chacha20, used by aead mode
+        """
+        self.mode = mode
+        self.cipher = cipher
+
+    def wrap_key(self, key: bytes) -> bytes:
+        """Encrypt data key for GPG recipient"""
+        result = subprocess.run(self.encrypt_command(), input=key,
+                                capture_output=True, check=True)
+        return result.stdout
+
+    def unwrap_key(self, wrapped_key: bytes) -> bytes:
+        """Decrypt data key with GPG"""
+        result = subprocess.run(self.decrypt_command(), input=wrapped_key,
+                                capture_output=True, check=True)
+        return result.stdout
+
+    def encrypt_writer(self, fileobj):
+        """Writable file object which encrypts into fileobj
+        
+        Close it to flush the encrypted stream, fileobj stays open.
+        
+        Params:
+            fileobj: file object -> destination of encrypted data
+        """
+        if self.mode == 'aead':
+            key = os.urandom(32)
+            return AEADWriter(fileobj, key=key, wrapped_key=self.wrap_key(key),
+                              cipher=self.cipher)
+        return ProcessWriter(fileobj, self.encrypt_command())
+
+    def decrypt_reader(self, fileobj):
+        """Readable file object which decrypts fileobj
+        
+        Format (gpg or aead) is detected from the stream, not from the mode.
+        
+        Params:
+            fileobj: file object -> encrypted data, seekable or with peek()
+        """
+        if hasattr(fileobj, 'peek'):
+            magic = fileobj.peek(len(AEAD_MAGIC))[:len(AEAD_MAGIC)]
+        else:
+            magic = fileobj.read(len(AEAD_MAGIC))
+            fileobj.seek(-len(magic), os.SEEK_CUR)
+        if magic == AEAD_MAGIC:
+            return AEADReader(fileobj, unwrap_key=self.unwrap_key)
+        return ProcessReader(fileobj, self.decrypt_command())
+
+    def encrypt_reader(self, stream):
+        """Readable file object of encrypted stream, e.g. to upload it
+        
+        Params:
+            stream: file object -> readable plain data
+        """
+        if self.mode != 'aead':
+            return ProcessReader(stream, self.encrypt_command())
+        read_fd, write_fd = os.pipe()
+        
+        def encrypt():
+            with open(write_fd, 'wb') as output:
+                with self.encrypt_writer(output) as writer:
+                    shutil.copyfileobj(stream, writer, BUFFER_SIZE)
+        return _ThreadStream(open(read_fd, 'rb'), encrypt)
+
+    def decrypt_writer(self, fileobj):
+        """Writable file object which decrypts into fileobj, e.g. to download into it
+        
+        Close it to finish decryption, fileobj stays open.
+        
+        Params:
+            fileobj: file object -> destination of decrypted data
+        """
+        read_fd, write_fd = os.pipe()
+        
+        def decrypt():
+            with open(read_fd, 'rb') as source:
+                with self.decrypt_reader(source) as reader:
+                    shutil.copyfileobj(reader, fileobj, BUFFER_SIZE)
+        return _ThreadStream(open(write_fd, 'wb'), decrypt)
+
+    def open_envelope(self, read_at, size: int) -> EnvelopeFile:
+        """Random access to an AEAD envelope
+        
+        Params:
+            read_at: callable -> read_at(offset, size) returns bytes of the envelope
+            size: int -> size of the envelope
+        """
+        return EnvelopeFile(read_at, size, unwrap_key=self.unwrap_key)
+
     def encrypt_file(self, file: str):
         """Encrypt file with GPG key
         
@@ -45,9 +758,15 @@ class Cryption:
         
         # Run the GPG command using subprocess
         try:
+            if self.mode == 'aead':
+                # chunks are sealed in parallel by a process pool
+                key = os.urandom(32)
+                seal_file(file, output, key=key, wrapped_key=self.wrap_key(key),
+                          cipher=self.cipher)
+                return True, output
             subprocess.run(gpg_cmd, check=True)
             return True, output
-        except subprocess.CalledProcessError as e:
+        except (subprocess.CalledProcessError, RuntimeError) as e:
             print(f"Error encrypting file: {e}")
             return False, None
         
@@ -82,13 +801,65 @@ class Cryption:
         
         # Run the GPG command using subprocess
         try:
+            with open(file, 'rb') as f:
+                is_aead = f.read(len(AEAD_MAGIC)) == AEAD_MAGIC
+            if is_aead:
+                open_file(file, output, unwrap_key=self.unwrap_key)
+                return True, output
             subprocess.run(gpg_command, check=True)
             return True, output
-        except subprocess.CalledProcessError as e:
+        except (subprocess.CalledProcessError, ValueError, InvalidTag) as e:
             print(f"Error decrypting file: {e}")
             return False, None
         
-   
+    def encrypt_command(self) -> list:
+        """GPG command which encrypts stdin to stdout
+        
+        Use it as a stage of gcapi.pipeline.Pipeline to encrypt a stream
+        without writing it to disk.
+        
+        Return:
+            command: list -> gpg command as argument list
+        """
+        return [
+            "gpg",
+            "--batch",
+            "--encrypt",
+            "--always-trust",
+            "--recipient", GPG_RECIPIENT,
+            "--output", "-"
+        ]
+        
+    def decrypt_command(self) -> list:
+        """GPG command which decrypts stdin to stdout
+        
+        Return:
+            command: list -> gpg command as argument list
+        """
+        return [
+            "gpg",
+            "--batch",
+            "--decrypt",
+            "--always-trust",
+            "--output", "-"
+        ]
+        
+    def import_keys(self, file: str) -> bool:
+        """Import GPG key file to keyring
+        
+        Params:
+            file: str -> key file path
+        
+        Return:
+            status: bool -> True/False
+        """
+        try:
+            subprocess.run(["gpg", "--batch", "--import", file], check=True)
+            return True
+        except subprocess.CalledProcessError as e:
+            print(f"Error importing key: {e}")
+            return False
+        
     def __remove_gpg_extention(self, file_name: str) -> str:
         """Remove .gpg extension from file name"""
         if file_name.endswith('.gpg'):
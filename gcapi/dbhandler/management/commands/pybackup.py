@@ -2,10 +2,18 @@ from django.conf import settings
 from django.core.management.base import BaseCommand
 from gcapi.drive import GCDrive
 from gcapi.cryption import Cryption
+from gcapi.compress import compress_command, extension
+from gcapi.pipeline import Pipeline, closed_files
+from concurrent.futures import ThreadPoolExecutor
 import subprocess
 import datetime
+import shutil
+import time
 import os 
 
+# pg_dump writes these files at the end, upload them after pg_dump exits
+TOC_FILES = ('toc.dat', 'blobs.toc')
+
 class Command(BaseCommand):
     help = "Backup database"
     
@@ -15,6 +23,22 @@ class Command(BaseCommand):
             action='store_true',
             help='Encrypt dump file'
         )
+        parser.add_argument(
+            '--stream',
+            action='store_true',
+            help='Stream dump to Google Drive without temporary files'
+        )
+        parser.add_argument(
+            '--compress',
+            action='store_true',
+            help='Compress dump stream with gzip (only with --stream)'
+        )
+        parser.add_argument(
+            '--jobs',
+            type=int,
+            default=None,
+            help='Dump N tables in parallel (directory format) and upload them concurrently'
+        )
         
     def __success_output(self, text):
         """
@@ -55,7 +79,102 @@ class Command(BaseCommand):
         database_url = f"postgres://{db_config['USER']}:{db_config['PASSWORD']}@{db_config['HOST']}:{db_config['PORT']}/{db_config['NAME']}"
         return database_url
         
+    def __stream_backup(self, backup_filename: str, is_encrypt: bool, is_compress: bool):
+        """
+        Pipe pg_dump -> gzip -> encryption -> Google Drive
+        
+        Nothing is written to disk, memory usage is bounded by upload chunk size.
+        """
+        commands = [["pg_dump", self.__create_uri(), "-Fc"]]
+        if is_compress:
+            commands.append(compress_command())
+            backup_filename += extension()
+        
+        _drive = GCDrive()
+        pipeline = Pipeline(*commands)
+        stream = pipeline.stdout
+        if is_encrypt:
+            # gpg process or in-process AEAD, see GCAPI_CRYPTION_MODE
+            stream = Cryption().encrypt_reader(stream)
+            backup_filename += ".gpg"
+        try:
+            response = _drive.upload_stream(stream=stream, name=backup_filename)
+            if is_encrypt:
+                stream.close()
+        except Exception:
+            pipeline.kill()
+            raise
+        
+        status, errors = pipeline.wait()
+        if not status:
+            # uploaded file is incomplete, do not keep it as a backup
+            _drive.delete(file_id=response.get('id'))
+            raise RuntimeError(", ".join(errors))
+        return response
+    
+    def __upload_dump_file(self, _drive: GCDrive, path: str, folder_id: str, is_encrypt: bool):
+        """
+        Upload one file of directory format dump and remove it
+        """
+        if is_encrypt:
+            with open(path, 'rb') as f:
+                with Cryption().encrypt_reader(f) as encrypted:
+                    _drive.upload_stream(stream=encrypted,
+                                         name=f"{os.path.basename(path)}.gpg",
+                                         folder_id=folder_id)
+        else:
+            _drive.upload(file=path, folder_id=folder_id)
+        os.remove(path)
+    
+    def __parallel_backup(self, backup_filename: str, jobs: int, is_encrypt: bool):
+        """
+        Run pg_dump -Fd -j N and upload every table file to a backup folder
+        on Google Drive as soon as pg_dump closes it.
+        """
+        dump_dir = os.path.realpath(os.path.join(settings.BASE_DIR, backup_filename))
+        _drive = GCDrive()
+        folder = _drive.create_folder(name=backup_filename)
         
+        process = subprocess.Popen(["pg_dump", self.__create_uri(), 
+                                    "-Fd", "-j", str(jobs), "-f", dump_dir])
+        submitted = set()
+        futures = []
+        try:
+            with ThreadPoolExecutor(max_workers=jobs) as pool:
+                while True:
+                    finished = process.poll() is not None
+                    if not os.path.isdir(dump_dir):
+                        names = []
+                    elif finished:
+                        names = sorted(os.listdir(dump_dir))
+                    else:
+                        # skip files which are still written by pg_dump workers
+                        names = closed_files(dump_dir, process.pid, exclude=TOC_FILES) or []
+                    for name in names:
+                        if name in submitted:
+                            continue
+                        submitted.add(name)
+                        futures.append(pool.submit(self.__upload_dump_file, _drive,
+                                                   os.path.join(dump_dir, name),
+                                                   folder.get('id'), is_encrypt))
+                    if finished:
+                        break
+                    time.sleep(1)
+                
+                for future in futures:
+                    future.result()
+                    
+            if process.returncode != 0:
+                raise RuntimeError(f"pg_dump exited with {process.returncode}")
+        except Exception:
+            if process.poll() is None:
+                process.kill()
+            # do not keep incomplete backup folder
+            _drive.delete(file_id=folder.get('id'))
+            raise
+        finally:
+            shutil.rmtree(dump_dir, ignore_errors=True)
+        return folder
     
     def handle(self, *args, **options):
         db = settings.DATABASES['default']
@@ -63,12 +182,52 @@ class Command(BaseCommand):
         
         output_dir = settings.BASE_DIR
         is_encrypt = options['encrypt']
+        is_stream = options['stream']
+        is_compress = options['compress']
+        jobs = options['jobs']
+        
+        if jobs and is_stream:
+            return self.__error_output("--jobs can not be used with --stream, "
+                                       "directory format dump is written into files")
+        if is_compress and not is_stream:
+            return self.__error_output("--compress needs --stream, "
+                                       "pg_dump compresses custom and directory format dumps itself")
         
         # Create a timestamp for the backup file
         timestamp = datetime.datetime.now().strftime("%Y-%m-%d_%H-%M-%S-%f")
         
         # Define the backup file name
         backup_filename = f"default_{db_name}_{timestamp}.dump"
+        
+        if is_stream:
+            try:
+                self.__stream_backup(backup_filename=backup_filename,
+                                     is_encrypt=is_encrypt,
+                                     is_compress=is_compress)
+                self.__success_output(text="<------ Backup file streamed to Google drive -------->")
+            except Exception as e:
+                self.__error_output(f"Backup failed: {e}")
+            return
+        
+        if jobs:
+            try:
+                self.__parallel_backup(backup_filename=backup_filename,
+                                       jobs=jobs,
+                                       is_encrypt=is_encrypt)
+                self.__success_output(text="<------ Backup folder uploaded to Google drive -------->")
+            except Exception as e:
+                self.__error_output(f"Backup failed: {e}")
+            return
+        
+        # finish the upload of an interrupted backup instead of dumping again
+        try:
+            resumed = GCDrive().resume_uploads(prefix=f"default_{db_name}_")
+        except Exception as e:
+            return self.__error_output(f"Backup failed: {e}")
+        if resumed:
+            for file in resumed:
+                os.remove(file)
+            return self.__success_output(text="<------ Interrupted backup upload finished -------->")
 
         # Define the full path to the backup file
         backup_filepath = os.path.join(output_dir, backup_filename)
@@ -2,10 +2,12 @@ import asyncio
 from django.core.management.base import BaseCommand, CommandParser
 from django.conf import settings
 from gcapi.cryption import Cryption
-from gcapi.drive import GCDrive
-from gcapi.compress import compress_folder
+from gcapi.drive import GCDrive, DEDUP
+from gcapi.checksum import HashingWriter
+from gcapi.compress import compress_folder, compress_writer, extension
+from gcapi.manifest import backup_media
+from gcapi.archive import write_tar
 import os 
-import tarfile
 import datetime
 
 class Command(BaseCommand):
@@ -22,6 +24,16 @@ class Command(BaseCommand):
             action='store_true',
             help="Compress media folder"
         )   
+        parser.add_argument(
+            '--incremental',
+            action='store_true',
+            help="Upload only new or changed files as content-addressed packs"
+        )
+        parser.add_argument(
+            '--dedup',
+            action='store_true',
+            help="Copy the backup on Drive instead of uploading it if media did not change"
+        )
         
     def __success_output(self, text):
         """
@@ -52,20 +64,21 @@ class Command(BaseCommand):
     def _create_media_tar(self, media_folder: str):
         # Create a timestamp for the media folder
         timestamp = datetime.datetime.now().strftime("%Y-%m-%d_%H-%M-%S-%f")
-        tarname = f'media_{timestamp}.tar.gz'
+        tarname = f'media_{timestamp}.tar{extension()}'
         
         try:
-            # Create a tar file
-            with tarfile.open(tarname, 'w:gz') as tar:
-                # Walk through the media folder and add each file to the tar archive
-                for root, dirs, files in os.walk(media_folder):
-                    for file in files:
-                        file_path = os.path.join(root, file)
-                        # Add the file to the tar archive with the relative path
-                        tar.add(file_path, arcname=os.path.relpath(file_path, media_folder))
-            return True, tarname
+            # Create a tar stream compressed with GCAPI_COMPRESS_CODEC
+            with open(tarname, 'wb') as f:
+                # sha256 of the tarball is the dedup key, it is hashed while
+                # it is written so the tarball is not read again for it
+                hashing = HashingWriter(f)
+                with compress_writer(hashing) as compressed:
+                    # files are stat'ed and read by a thread pool,
+                    # archived with their path relative to media folder
+                    write_tar(media_folder, compressed)
+            return True, tarname, hashing.checksums.sha256.hexdigest()
         except Exception as exc:
-            return False, exc
+            return False, exc, None
 
     def handle(self, *args, **options):
         _drive = GCDrive() 
@@ -73,10 +86,24 @@ class Command(BaseCommand):
         media_root = settings.MEDIA_ROOT
         is_encrypt = options['encrypt']
         is_compress = options['compress']
+        is_dedup = options['dedup'] or DEDUP
+        content_hash = None
         temp_files = []
+        
+        if options['incremental']:
+            try:
+                result = backup_media(drive=_drive,
+                                      root=media_root,
+                                      cryption=_cryption if is_encrypt else None)
+                return self.__success_output(
+                    f"Success: {result['packs']} packs ({result['bytes']} bytes) uploaded\n"
+                    f" Manifest: {result['manifest']}")
+            except Exception as e:
+                return self.__error_output(f"Media backup failed: {e}")
 
         # Call the asynchronous function within the synchronous context
-        c_status, c_output = asyncio.run(self._create_media_tar_async(media_folder=media_root))
+        c_status, c_output, content_hash = asyncio.run(
+            self._create_media_tar_async(media_folder=media_root))
 
         if c_status:
             temp_files.append(c_output)
@@ -85,6 +112,26 @@ class Command(BaseCommand):
             self.__remove_temp(temp_files)
             return self.__error_output(f"Fail: Compress error!: {c_output}")
 
+        if is_encrypt and is_dedup:
+            # encrypted file differs on every run, dedup by the hash of the
+            # compressed tarball before anything is encrypted. It changes with
+            # GCAPI_COMPRESS_CODEC and GCAPI_COMPRESS_LEVEL
+            try:
+                duplicate = _drive.find_duplicate(content_hash=content_hash)
+                if duplicate:
+                    response = _drive.copy_duplicate(
+                        duplicate=duplicate,
+                        name=f"{os.path.basename(media_root)}.gpg",
+                        content_hash=content_hash)
+                    self.__remove_temp(temp_files)
+                    return self.__success_output(
+                        f"Success: Media did not change, backup is copied on Google Drive\n Message: {response}")
+            except Exception as e:
+                self.__remove_temp(temp_files)
+                return self.__error_output(f"Media backup failed: {e}")
+            # nothing to copy, the lookup is not repeated by upload
+            is_dedup = False
+
         if is_encrypt:
             # encrypt media.zip folder
             status, encrypted_file = _cryption.encrypt_file(file=media_root)
@@ -97,8 +144,12 @@ class Command(BaseCommand):
         # send to drive
 
         try:
-            response = _drive.upload(file=media_root)
-            if response:
+            response = _drive.upload(file=media_root, dedup=is_dedup,
+                                     content_hash=content_hash)
+            if response and response.get('duplicateOf'):
+                self.__success_output(
+                    f"Success: Media did not change, backup is copied on Google Drive\n Message: {response}")
+            elif response:
                 self.__success_output(
                     f"Success: Media backup successfully upload to Google Drive\n Message: {response}")
             self.__remove_temp(temp_files)
@@ -2,7 +2,8 @@ from django.core.management.base import BaseCommand, CommandParser
 from django.conf import settings
 from gcapi.drive import GCDrive
 from gcapi.cryption import Cryption
-from gcapi.compress import extract_folder, compress_folder
+from gcapi.compress import uncompress_folder, compress_folder
+from gcapi.manifest import restore_media
 import os 
 
 class Command(BaseCommand):
@@ -11,22 +12,27 @@ class Command(BaseCommand):
     
     def add_arguments(self, parser: CommandParser):
         parser.add_argument(
-            '--encrypt',
+            '--decrypt',
             action='store_true',
-            help='Encrypt media folder'
+            help='Decrypt media backup'
         )
         parser.add_argument(
             '--compress',
             action='store_true',
             help="Compress media folder"
         )   
+        parser.add_argument(
+            '--incremental',
+            action='store_true',
+            help="Download only missing or changed files from latest media manifest"
+        )
         
     def __protect_old_media(self):
         """
         Protect old media folder before changing new media folder
         """
         media_root = settings.MEDIA_ROOT
-        compress_folder(media_root, 'old_media')
+        compress_folder(media_root, f"{media_root}.tar")
         print("<----- media folder protected -------->")    
         return True
         
@@ -50,10 +56,20 @@ class Command(BaseCommand):
         is_decrypt = options['decrypt']
         temp_files = []
         
+        if options['incremental']:
+            # files are replaced one by one atomically,
+            # so old media folder does not have to be protected
+            try:
+                result = restore_media(drive=_drive, root=media_root, cryption=_cryption)
+                return self.__success_output(
+                    f"Success: {result['files']} files ({result['bytes']} bytes) restored")
+            except Exception as e:
+                return self.__error_output(f"Media restore failed: {e}")
+        
         # first protect old media folder
         is_protected = self.__protect_old_media()
         if is_protected:
-            temp_files.append(f"{media_root}.zip") # protected folder
+            temp_files.append(f"{media_root}.tar") # protected folder
             # find latest media backup and download it
             latest_media = _drive.get_latest_media()
             media_id = latest_media.get('id')
@@ -68,17 +84,19 @@ class Command(BaseCommand):
             #! but for now I make it just this one.
             
             # decrypt file
-            status, decrypt_file = _cryption.decrypt_file(file=media_file)
-            if not status:
-                self.__error_output("Fail: Decryption error! Check credentials.json!")
-                return
-            
-            temp_files.append(decrypt_file)
+            decrypt_file = media_file
+            if is_decrypt:
+                status, decrypt_file = _cryption.decrypt_file(file=media_file)
+                if not status:
+                    self.__error_output("Fail: Decryption error! Check credentials.json!")
+                    return
+                
+                temp_files.append(decrypt_file)
             
             # extract folder to media root
-            is_extract = extract_folder(
-                zip_filename=decrypt_file,
-                extract_path=media_root
+            is_extract, _ = uncompress_folder(
+                tar_path=decrypt_file,
+                extract_dir=media_root
             )
             
             if is_extract:
@@ -87,8 +105,8 @@ class Command(BaseCommand):
                 self.__success_output("Success: Media data's successfully restored")
             else:
                 # if there is a problem, back to old data
-                extract_folder(f"{media_root}.zip",
-                               extract_path=media_root)
+                uncompress_folder(f"{media_root}.tar",
+                                  extract_dir=os.path.dirname(media_root))
                 self.__error_output("Fail: Extract error!")
                 
             
@@ -0,0 +1,87 @@
+from django.core.management.base import BaseCommand, CommandParser
+from django.conf import settings
+from gcapi.drive import GCDrive
+from gcapi.cryption import Cryption
+from gcapi.retention import RetentionPolicy
+
+class Command(BaseCommand):
+    help = "Delete old backups with grandfather-father-son retention policy"
+    
+    def add_arguments(self, parser: CommandParser):
+        parser.add_argument(
+            '--hourly',
+            type=int,
+            default=24,
+            help='Keep newest backup of last N hours'
+        )
+        parser.add_argument(
+            '--daily',
+            type=int,
+            default=7,
+            help='Keep newest backup of last N days'
+        )
+        parser.add_argument(
+            '--weekly',
+            type=int,
+            default=4,
+            help='Keep newest backup of last N weeks'
+        )
+        parser.add_argument(
+            '--monthly',
+            type=int,
+            default=12,
+            help='Keep newest backup of last N months'
+        )
+        parser.add_argument(
+            '--media',
+            action='store_true',
+            help='Prune media backups instead of database backups'
+        )
+        parser.add_argument(
+            '--dry-run',
+            action='store_true',
+            help='Only show which backups would be deleted'
+        )
+        
+    def __success_output(self, text):
+        """
+        Success output
+        """
+        return self.stdout.write(self.style.SUCCESS(str(text)))
+    
+    def __error_output(self, text):
+        """
+        Error output
+        """
+        return self.stdout.write(self.style.ERROR(str(text)))
+    
+    def handle(self, *args, **options):
+        db_name = settings.DATABASES['default']['NAME']
+        prefix = "media_" if options['media'] else f"default_{db_name}_"
+        is_dry_run = options['dry_run']
+        policy = RetentionPolicy(hourly=options['hourly'],
+                                 daily=options['daily'],
+                                 weekly=options['weekly'],
+                                 monthly=options['monthly'])
+        
+        try:
+            # encrypted media manifests are read to find the packs they use
+            result = GCDrive().apply_retention(policy=policy,
+                                               prefix=prefix,
+                                               dry_run=is_dry_run,
+                                               cryption=Cryption() if options['media'] else None)
+        except Exception as e:
+            return self.__error_output(f"Prune failed: {e}")
+        
+        for file in result['delete']:
+            status = result['results'].get(file['id'])
+            if is_dry_run:
+                self.stdout.write(f"would delete {file['name']}")
+            elif status is True:
+                self.stdout.write(f"deleted {file['name']}")
+            else:
+                self.__error_output(f"could not delete {file['name']}: {status}")
+        
+        self.__success_output(
+            f"Success: {len(result['keep'])} backups kept, {len(result['delete'])} "
+            f"{'would be ' if is_dry_run else ''}deleted")
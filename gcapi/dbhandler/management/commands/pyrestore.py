@@ -1,8 +1,12 @@
 from django.core.management.base import BaseCommand, CommandParser
 from django.conf import settings
-from gcapi.cryption import Cryption
-from gcapi.drive import GCDrive
+from gcapi.cryption import Cryption, AEAD_MAGIC
+from gcapi.drive import GCDrive, FOLDER_MIMETYPE
+from gcapi.compress import uncompress_command, uncompress_file
+from gcapi.pipeline import Pipeline
+from concurrent.futures import ThreadPoolExecutor
 import subprocess
+import shutil
 import os 
 
 class Command(BaseCommand):
@@ -14,6 +18,17 @@ class Command(BaseCommand):
             action='store_true',
             help='Decrypt database dump file'
         )
+        parser.add_argument(
+            '--stream',
+            action='store_true',
+            help='Restore while downloading, without temporary files'
+        )
+        parser.add_argument(
+            '--jobs',
+            type=int,
+            default=None,
+            help='Download backup folder and run pg_restore with N parallel jobs'
+        )
         
     def __success_output(self, text):
         """
@@ -27,24 +42,126 @@ class Command(BaseCommand):
         """
         return self.stdout.write(self.style.ERROR(str(text)))
     
+    def __stream_restore(self, _drive: GCDrive, file_id: str, file_name: str, 
+                         db_name: str, is_decrypt: bool):
+        """
+        Pipe Google Drive -> decryption -> gunzip -> pg_restore
+        
+        pg_restore starts with the first downloaded chunk, nothing is written to disk.
+        """
+        commands = []
+        if file_name.removesuffix('.gpg').endswith('.gz'):
+            commands.append(uncompress_command(codec='gzip'))
+        elif file_name.removesuffix('.gpg').endswith('.zst'):
+            commands.append(uncompress_command(codec='zstd'))
+        commands.append(["pg_restore", "--clean", f"--dbname={db_name}"])
+        
+        pipeline = Pipeline(*commands, stdin=subprocess.PIPE, stdout=None)
+        try:
+            if is_decrypt:
+                # gpg or AEAD format is detected from the stream
+                with Cryption().decrypt_writer(pipeline.stdin) as writer:
+                    _drive.download_stream(file_id=file_id, stream=writer)
+            else:
+                _drive.download_stream(file_id=file_id, stream=pipeline.stdin)
+        except Exception:
+            pipeline.kill()
+            raise
+        
+        status, errors = pipeline.wait()
+        if not status:
+            raise RuntimeError(", ".join(errors))
+    
+    def __download_dump_file(self, _drive: GCDrive, file: dict, dump_dir: str, is_decrypt: bool):
+        """
+        Download one file of directory format dump, decrypt it on the fly
+        """
+        name = file.get('name')
+        if is_decrypt and name.endswith('.gpg'):
+            with open(os.path.join(dump_dir, name[:-4]), 'wb') as f:
+                with Cryption().decrypt_writer(f) as writer:
+                    _drive.download_stream(file_id=file.get('id'), stream=writer)
+        else:
+            with open(os.path.join(dump_dir, name), 'wb') as f:
+                _drive.download_stream(file_id=file.get('id'), stream=f)
+    
+    def __parallel_restore(self, _drive: GCDrive, folder: dict, db_name: str, jobs: int, is_decrypt: bool):
+        """
+        Download every file of a backup folder in parallel and
+        restore it with pg_restore -j N
+        """
+        dump_dir = os.path.join(settings.BASE_DIR, folder.get('name'))
+        os.makedirs(dump_dir, exist_ok=True)
+        try:
+            files = _drive.list(folder_id=folder.get('id'))
+            with ThreadPoolExecutor(max_workers=jobs) as pool:
+                futures = [pool.submit(self.__download_dump_file, _drive, file, dump_dir, is_decrypt)
+                           for file in files]
+                for future in futures:
+                    future.result()
+            
+            cmd = ["pg_restore", "--clean", "-j", str(jobs), f"--dbname={db_name}", dump_dir]
+            subprocess.run(cmd, check=True)
+        finally:
+            shutil.rmtree(dump_dir, ignore_errors=True)
     
     def handle(self, *args, **options):
         _drive = GCDrive() 
         db_name = settings.DATABASES['default']['NAME'] 
         is_decrypt = options['decrypt']
+        is_stream = options['stream']
+        jobs = options['jobs']
         
         # Get the latest backup file from Google Drive
         latest_backup = _drive.get_latest_backup(db_name=db_name)
         file_id = latest_backup.get('id')
         file_name = latest_backup.get('name')
-        # Download the backup file
-        download_status, file = _drive.download(file_id=file_id,
-                                                file_name=file_name)
+        
+        if latest_backup.get('mimeType') == FOLDER_MIMETYPE:
+            # directory format backup which is created by pybackup --jobs
+            try:
+                self.__parallel_restore(_drive=_drive,
+                                        folder=latest_backup,
+                                        db_name=db_name,
+                                        jobs=jobs or 1,
+                                        is_decrypt=is_decrypt)
+                self.__success_output("Success: Database data's successfully loaded from backup folder")
+            except Exception as e:
+                self.__error_output(f"Restore failed: {e}")
+            return
+        
+        if is_stream:
+            try:
+                self.__stream_restore(_drive=_drive, 
+                                      file_id=file_id, 
+                                      file_name=file_name,
+                                      db_name=db_name,
+                                      is_decrypt=is_decrypt)
+                self.__success_output("Success: Database data's successfully streamed from backup file")
+            except Exception as e:
+                self.__error_output(f"Restore failed: {e}")
+            return
+        
+        is_envelope = is_decrypt and _drive.download_range(
+            file_id, 0, len(AEAD_MAGIC) - 1) == AEAD_MAGIC
+        if is_envelope:
+            # AEAD backup, ranges are decrypted as they arrive
+            try:
+                download_status, file = _drive.download_decrypted(file_id=file_id,
+                                                                  cryption=Cryption(),
+                                                                  file_name=file_name)
+            except Exception as e:
+                self.__error_output(f"<------ Fail: Downloading issue. {e} ------->")
+                return
+        else:
+            # Download the backup file
+            download_status, file = _drive.download_ranges(file_id=file_id,
+                                                           file_name=file_name)
         if not download_status:
             self.__error_output("<------ Fail: Downloading issue. Check credentials.json! ------->")
             return
         
-        if is_decrypt:
+        if is_decrypt and not is_envelope:
             # Decrypt the downloaded file if requested
             status, decrypted_file = Cryption().decrypt_file(file=file)
             if not status:
@@ -56,9 +173,21 @@ class Command(BaseCommand):
             os.remove(file)  # Remove the original downloaded file
             file = decrypted_file
         
+        if file.endswith(('.gz', '.zst')):
+            # pybackup --stream --compress backup, pg_restore reads plain dumps only
+            try:
+                uncompressed_file = uncompress_file(file)
+            except Exception as e:
+                self.__error_output(f"<------ Fail: Uncompress issue. {e} ------->")
+                return
+            finally:
+                os.remove(file)
+            file = uncompressed_file
+        
         try:
             # Perform the restore using pg_restore command
-            cmd = f"pg_restore --clean --dbname={db_name} {file}"
+            jobs_option = f"-j {jobs} " if jobs else ""
+            cmd = f"pg_restore --clean {jobs_option}--dbname={db_name} {file}"
             subprocess.run(cmd, shell=True, check=True)
             os.remove(file)  # remove file
             self.__success_output("Success: Database data's successfully loaded from backup file")
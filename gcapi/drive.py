@@ -7,58 +7,232 @@ Backup handler with using Google Drive Api
 This class provide get, list, create, delete files.
     - get()     -> Get specific file details
     - list()    -> List all file in your drive
+    - iter_files() -> Iterate all files of a query page by page
     - create()  -> Create new file to your drive
     - delete()  -> Delete your specific file in your drive
     - bulk_delete() -> Delete multiple file in your drive
+    - find_duplicate() -> File which has the same content
     - execute_credentials() -> Set credentials and service
     
 Sources:
     resources files -> https://developers.google.com/drive/api/reference/rest/v3/files?hl=en 
 """
 import os
-from googleapiclient.discovery import build
-from google.oauth2.service_account import Credentials
-from googleapiclient.http import MediaFileUpload, MediaIoBaseDownload
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from googleapiclient.http import MediaFileUpload, MediaIoBaseDownload, MediaUpload
+from googleapiclient.errors import HttpError
 from gcapi.cryption import Cryption
-from dotenv import load_dotenv
+from gcapi.service import get_pool, ServicePool
+from gcapi.session import UploadSession
+from gcapi.checksum import Checksums, ChecksumError, HashingWriter
+from gcapi.throttle import concurrency
+from gcapi.retry import retry, operation, inherit, is_transient, backoff, retry_after, sleep, RETRIES
+from gcapi.index import DriveIndex
+from gcapi.retention import RetentionPolicy
+from gcapi.manifest import MANIFEST_SUFFIX, unreferenced_packs
 
-load_dotenv()
 
 BACKUP_FOLDER = os.environ.get('GCAPI_BACKUP_FOLDER')
 CREDENTIALS_PATH = os.environ.get('GCAPI_CREDENTIALS_PATH')
 PAGE_LIST_SIZE = os.environ.get('GCAPI_PAGE_SIZE', 100)
 FOLDER_ID = os.environ.get('GCAPI_FOLDER_ID', None)
+# serve name and latest backup lookups from local index (gcapi.index)
+USE_INDEX = os.environ.get('GCAPI_USE_INDEX', 'false').lower() in ('1', 'true', 'yes')
+# resumable upload chunk size, it must be multiple of 256 KiB
+CHUNK_SIZE = int(os.environ.get('GCAPI_CHUNK_SIZE', 8 * 1024 * 1024))
+# number of downloaded chunks which can wait for a slow consumer
+QUEUE_SIZE = int(os.environ.get('GCAPI_QUEUE_SIZE', 4))
+FOLDER_MIMETYPE = 'application/vnd.google-apps.folder'
+# default file fields of iter_files
+FILE_FIELDS = 'id, name, createdTime'
+# max calls in one batch request (drive limit is 100)
+BATCH_SIZE = 100
+# number of files which are uploaded at the same time by upload_many
+MAX_WORKERS = int(os.environ.get('GCAPI_MAX_WORKERS', 4))
+# byte range which is fetched by one request of download_ranges
+RANGE_SIZE = int(os.environ.get('GCAPI_RANGE_SIZE', 16 * 1024 * 1024))
+# compare md5/sha256 of uploaded and downloaded bytes with drive metadata
+VERIFY_CHECKSUM = os.environ.get('GCAPI_VERIFY_CHECKSUM', 'true').lower() in ('1', 'true', 'yes')
+# fields of upload responses, checksums are computed by drive after upload,
+# the others are kept in the local index
+UPLOAD_FIELDS = 'id, name, createdTime, size, md5Checksum, sha256Checksum, parents, mimeType'
+# copy a file with the same content on drive instead of uploading again
+DEDUP = os.environ.get('GCAPI_DEDUP', 'false').lower() in ('1', 'true', 'yes')
+# appProperties key of content hash which dedup uploads are looked up by
+DEDUP_PROPERTY = 'gcapiSha256'
+
+
+class _QueueWriter:
+    """
+    File-like object which puts every written chunk to a bounded queue.
+    Writing blocks while the queue is full, so a slow consumer slows down
+    the download instead of filling memory.
+    """
+    def __init__(self, chunks: queue.Queue) -> None:
+        self._chunks = chunks
+        
+    def write(self, data) -> int:
+        self._chunks.put(bytes(data))
+        return len(data)
+
+
+class MediaPipeUpload(MediaUpload):
+    """
+    Resumable upload body for non-seekable streams (pipes, process stdout)
+    
+    MediaIoBaseUpload wants to seek to end of the stream to learn its size,
+    which is impossible for a pipe. This class reads the stream chunk by chunk
+    and keeps only the last chunk in memory, so it can be sent again
+    if Drive did not commit it. Memory usage is bounded by chunk size.
+    """
+    def __init__(self,
+                 stream,
+                 mimetype: str='application/octet-stream',
+                 chunksize: int=CHUNK_SIZE
+        ) -> None:
+        self._stream = stream
+        self._mimetype = mimetype
+        self._chunksize = chunksize
+        self._buffer = b''
+        self._buffer_start = 0   # stream offset of first byte in buffer
+        self._eof = False
+        self._eof_on_boundary = False
+        # every byte is read from the stream once and in order
+        self.checksums = Checksums()
+        
+    def chunksize(self):
+        # googleapiclient decides the last chunk by a short read. If the stream
+        # ends exactly on a chunk boundary, report a bigger chunk size once
+        # so that the full chunk is sent as the final one.
+        if self._eof_on_boundary:
+            return self._chunksize + 1
+        return self._chunksize
+    
+    def mimetype(self):
+        return self._mimetype
+    
+    def size(self):
+        # unknown until the whole stream is read
+        if self._eof:
+            return self._buffer_start + len(self._buffer)
+        return None
+    
+    def resumable(self):
+        return True
+    
+    def has_stream(self):
+        return False
+    
+    def getbytes(self, begin, length):
+        if begin < self._buffer_start:
+            raise ValueError('Pipe upload can not go back to an already sent chunk')
+        # drop bytes which are committed by Drive
+        self._buffer = self._buffer[begin - self._buffer_start:]
+        self._buffer_start = begin
+        # read one more byte than needed to detect the end of stream
+        while len(self._buffer) <= length and not self._eof:
+            data = self._stream.read(length + 1 - len(self._buffer))
+            if not data:
+                self._eof = True
+            else:
+                self.checksums.update(data)
+                self._buffer += data
+        self._eof_on_boundary = self._eof and len(self._buffer) == length
+        return self._buffer[:length]
+    
+    def to_json(self):
+        """
+        googleapiclient serializes a request to send it again later, e.g. from
+        another process. Bytes of a pipe are read only once and the ones which
+        are committed by Drive are dropped, so a pipe upload can not be rebuilt
+        from json. It is not resumed by resume_uploads either, which only
+        continues uploads of files (gcapi.session); a failed stream backup is
+        run again from the start.
+        """
+        raise NotImplementedError('Pipe uploads can not be serialized')
+
+
+class HashingFileUpload(MediaFileUpload):
+    """
+    MediaFileUpload which hashes the file while its chunks are read for sending
+    
+    Chunks are read by getbytes() instead of a stream slice, so every byte
+    is hashed when it is read. A chunk which is sent again is not hashed
+    twice, and bytes which were sent by an interrupted process are read
+    once to fill the gap.
+    """
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self.checksums = Checksums()
+        
+    def has_stream(self):
+        return False
+    
+    def hash_until(self, end: int) -> None:
+        """Hash the bytes from the last hashed one until end"""
+        self._fd.seek(self.checksums.size)
+        while self.checksums.size < end:
+            data = self._fd.read(min(CHUNK_SIZE, end - self.checksums.size))
+            if not data:
+                break
+            self.checksums.update(data)
+    
+    def getbytes(self, begin, length):
+        if begin > self.checksums.size:
+            self.hash_until(begin)
+        data = super().getbytes(begin, length)
+        if begin <= self.checksums.size < begin + len(data):
+            self.checksums.update(data[self.checksums.size - begin:])
+        return data
+
 
 class GCDrive:
-    def __init__(self) -> None:
-        self.__credentials = None
-        self.__service = None
-        self.cryption = Cryption()
-        self.execute_credentials()
+    def __init__(self, use_index: bool=USE_INDEX, pool: ServicePool=None) -> None:
+        """
+        Params:
+            use_index:  bool        -> serve lookups from local index (gcapi.index)
+            pool:       ServicePool -> services to use, e.g. of gcapi.fakedrive
+                                       (shared pool of GCAPI_CREDENTIALS_PATH by default)
+        """
+        # credentials and services are shared by every GCDrive of the process
+        # and built on first request, so creating a GCDrive costs nothing
+        self.__pool = pool or get_pool(CREDENTIALS_PATH)
+        self.__cryption = None
+        self.index = DriveIndex(drive=self) if use_index else None
+    
+    @property
+    def cryption(self) -> Cryption:
+        if self.__cryption is None:
+            self.__cryption = Cryption()
+        return self.__cryption
     
     def set_credentials(self, cred_path: str):
-        self.__credentials = Credentials.from_service_account_file(cred_path)
+        self.__pool = get_pool(cred_path)
         return self
     
     def get_credentials(self):
-        return self.__credentials
+        return self.__pool.credentials()
     
     def set_service(self):
-        self.__service = build('drive', 'v3', 
-                               credentials=self.get_credentials())
+        """Build a new service (and connection) for the current thread"""
+        self.__pool.service(rebuild=True)
         return self
     
     def get_service(self):
-        return self.__service
+        """Service of the current thread, httplib2 is not thread-safe"""
+        return self.__pool.service()
     
     def execute_credentials(self) -> None:
         """
         Set credentials and service
         """
         self.set_credentials(cred_path=CREDENTIALS_PATH)
-        self.set_service()
+        self.get_service()
         return self
     
+    @operation
     def get(self, 
             file_id: str, 
             shared_drive: bool=None
@@ -71,16 +245,18 @@ class GCDrive:
             shared_drive:   boolean ->  support all drives. Include shared drives 
         
         Return:
-            File: id, name, createdTime, mimeType, kind, owners, size
+            File: id, name, createdTime, mimeType, kind, owners, size,
+                  md5Checksum, sha256Checksum
         """
         service = self.get_service()
-        result = service.files()\
+        request = service.files()\
             .get(fileId=file_id,
                     supportsAllDrives=shared_drive,
-                    fields='id, name, createdTime, mimeType, kind, owners, size')\
-            .execute()
-        return result
+                    fields='id, name, createdTime, mimeType, kind, owners, size, '
+                           'md5Checksum, sha256Checksum')
+        return retry(request.execute)
     
+    @operation
     def get_by_name(self, 
                 file_name: str, 
                 shared_drive: bool=None
@@ -95,28 +271,66 @@ class GCDrive:
         Return:
             File: id, name, createdTime, mimeType, kind, owners, size
         """
-        service = self.get_service()
+        if self.index and not shared_drive:
+            # index has the files of my drive only
+            return self.index.get_by_name(file_name=file_name)
         
         # Search for the file by name
         query = f"name='{file_name}'"
         # if shared_drive is not None:
         #     query += f" and '{'true' if shared_drive else 'false'}' in parents"
         
-        results = service.files().list(q=query,
-                                    supportsAllDrives=shared_drive,
-                                    fields='files(id, name, createdTime, mimeType, kind, owners, size)')\
-                                .execute()
+        files = self.iter_files(query=query,
+                                page_size=1,
+                                shared_drive=shared_drive,
+                                fields='id, name, createdTime, mimeType, kind, owners, size')
         
-        # Check if any files match the query
-        files = results.get('files', [])
-        if files:
-            # Return information for the first matching file
-            return files[0]
-        else:
-            # If no matching file is found, return None
-            return None
+        # Return information for the first matching file,
+        # if no matching file is found, return None
+        return next(files, None)
 
     
+    def iter_files(self,
+                   query: str=None,
+                   fields: str=FILE_FIELDS,
+                   page_size: int=1000,
+                   order_by: str=None,
+                   shared_drive: bool=None
+        ):
+        """
+        Iterate all files which match the query, page by page
+        
+        Pages are requested lazily while the generator is consumed,
+        so only one page is kept in memory.
+        
+        Params:
+            query:          str     -> Drive search query (q parameter)
+            fields:         str     -> file fields, only these are returned. e.g. "id, name"
+            page_size:      int     -> files per request (max 1000)
+            order_by:       str     -> sort order. e.g. "createdTime desc"
+            shared_drive:   bool    -> whether to include shared drives
+            
+        Return:
+            generator of file dictionaries
+        """
+        service = self.get_service()
+        page_token = None
+        while True:
+            request = service.files().list(
+                q=query or "",
+                pageSize=page_size,
+                pageToken=page_token,
+                orderBy=order_by,
+                supportsAllDrives=shared_drive,
+                includeItemsFromAllDrives=shared_drive,
+                fields=f"nextPageToken, files({fields})")
+            results = retry(request.execute)
+            yield from results.get("files", [])
+            page_token = results.get("nextPageToken")
+            if not page_token:
+                return
+    
+    @operation
     def list(self, folder_id: str=None) -> list[dict]:
         """
         List all item on Google Drive service
@@ -125,16 +339,23 @@ class GCDrive:
             Dictionary object in array list
             File: id, name ,createdTime, mimeType, fullFileExtension
         """
-        service = self.get_service()  # get drive service
-        results = service.files().list(
-            q=f"'{folder_id or FOLDER_ID}' in parents" if folder_id or FOLDER_ID else "",
-            pageSize=PAGE_LIST_SIZE, 
-            fields="nextPageToken, \
-            files(id, name, createdTime, mimeType, fullFileExtension, trashed)")\
-        .execute()
-        items = results.get("files", [])
-        return items
+        query = f"'{folder_id or FOLDER_ID}' in parents" if folder_id or FOLDER_ID else ""
+        return list(self.iter_files(
+            query=query,
+            page_size=PAGE_LIST_SIZE,
+            fields="id, name, createdTime, mimeType, fullFileExtension, trashed"))
     
+    def __backup_query(self, name: str) -> str:
+        """
+        Query of backup files: name prefix, not trashed, 
+        in GCAPI_FOLDER_ID folder if it is set
+        """
+        query = f"name contains '{name}' and trashed = false"
+        if FOLDER_ID:
+            query += f" and '{FOLDER_ID}' in parents"
+        return query
+    
+    @operation
     def list_backup_files(self, 
                           db_name: str
         ) -> list:
@@ -148,15 +369,13 @@ class GCDrive:
         Return:
             file list -> list
         """
-        service = self.get_service()
-        query = f"name contains 'default_{db_name}_'"
-        
-        response = service.files()\
-                                .list(q=query, 
-                                    fields="files(id, name, createdTime)")\
-                                .execute()
-        return response.get('files', [])
+        if self.index:
+            return self.index.list(prefix=f"default_{db_name}_")
+        query = self.__backup_query(name=f"default_{db_name}_")
+        return list(self.iter_files(query=query,
+                                    fields="id, name, createdTime, mimeType"))
     
+    @operation
     def get_latest_backup(self, 
                           db_name:str
         ) -> dict:
@@ -169,11 +388,16 @@ class GCDrive:
         Return:
             file -> None | dictionary
         """
-        backup_files = self.list_backup_files(db_name=db_name)
-        if backup_files:
-            latest_backup = max(backup_files, key=lambda x: x['createdTime'])
-            return latest_backup
+        if self.index:
+            return self.index.get_latest(prefix=f"default_{db_name}_")
+        # newest file is sorted and returned by drive in one small request
+        files = self.iter_files(query=self.__backup_query(name=f"default_{db_name}_"),
+                                fields="id, name, createdTime, mimeType, size",
+                                page_size=1,
+                                order_by="createdTime desc")
+        return next(files, None)
         
+    @operation
     def list_media_files(self) -> list:
         """List backup files of database
         
@@ -185,15 +409,13 @@ class GCDrive:
         Return:
             file list -> list
         """
-        service = self.get_service()
-        query = f"name contains 'media.'"
-        
-        response = service.files()\
-                                .list(q=query, 
-                                    fields="files(id, name, createdTime)")\
-                                .execute()
-        return response.get('files', [])
+        if self.index:
+            return self.index.list(prefix="media_")
+        query = self.__backup_query(name="media_")
+        return list(self.iter_files(query=query,
+                                    fields="id, name, createdTime"))
     
+    @operation
     def get_latest_media(self) -> dict:
         """
         Get specific database latest backup file
@@ -204,40 +426,432 @@ class GCDrive:
         Return:
             file -> None | dictionary
         """
-        media_files = self.list_media_files()
-        if media_files:
-            latest_media = max(media_files, key=lambda x: x['createdTime'])
-            return latest_media    
+        if self.index:
+            files = self.index.list(prefix="media_")
+        else:
+            files = self.iter_files(query=self.__backup_query(name="media_"),
+                                    fields="id, name, createdTime, mimeType, size",
+                                    page_size=10,
+                                    order_by="createdTime desc")
+        # skip manifests of incremental media backups (gcapi.manifest)
+        return next((file for file in files if MANIFEST_SUFFIX not in file['name']), None)
     
     
+    @operation
+    def create_folder(self,
+                      name: str,
+                      folder_id: str=None
+        ) -> dict:
+        """Create new folder
+        
+        A failed create is sent again only if the parent has no folder of
+        this name, which the failed attempt may have made.
+        
+        Params:
+            name :      string -> folder name
+            folder_id:  string -> parent folder id (GCAPI_FOLDER_ID by default)
+            
+        Return:
+            json : proivde id of created folder and name of folder
+        """
+        service = self.get_service()
+        folder_id = folder_id or FOLDER_ID
+        body = {
+            'name': name,
+            'mimeType': FOLDER_MIMETYPE,
+            'parents': [folder_id]
+        }
+        request = service.files().create(body=body, fields='id, name')
+        
+        def created() -> dict:
+            query = f"name='{name}' and mimeType='{FOLDER_MIMETYPE}' and trashed = false"
+            if folder_id:
+                query += f" and '{folder_id}' in parents"
+            return next(self.iter_files(query=query, fields='id, name', page_size=1), None)
+        
+        return self.__retry_create(request, find=created)
+    
+    def __retry_create(self, request, find) -> dict:
+        """
+        Send a request which is not idempotent (create, copy) with retries
+        
+        A failed request may be done on drive anyway, so before it is sent
+        again find() looks for the file it made.
+        
+        Params:
+            request:    HttpRequest -> create or copy request
+            find:       callable    -> file which a failed attempt made, or None
+            
+        Return:
+            response of request, or the file which find() returned
+        """
+        for attempt in range(RETRIES + 1):
+            try:
+                return request.execute()
+            except Exception as error:
+                if attempt == RETRIES or not is_transient(error):
+                    raise
+                sleep(max(backoff(attempt), retry_after(error)), error)
+                found = find()
+                if found:
+                    return found
+    
+    def __send_chunks(self, request, name: str, progress=None, session=None) -> dict:
+        """
+        Send resumable upload request chunk by chunk
+        
+        Params:
+            request:    HttpRequest     -> files().create request with resumable media
+            name:       string          -> file name which is passed to progress
+            progress:   callable        -> progress(name, uploaded_bytes, total_bytes)
+            session:    UploadSession   -> state file which is updated after every chunk
+        """
+        def resume():
+            # ask drive for the committed offset before sending more
+            if request.resumable_uri:
+                request._in_error_state = True
+        
+        response = None
+        while response is None:
+            # waits for a slot, a failed chunk is retried from the committed offset
+            status, response = retry(concurrency.call, request.next_chunk, on_retry=resume)
+            if session and response is None:
+                session.save(uri=request.resumable_uri, 
+                             offset=request.resumable_progress)
+            if progress:
+                total = request.resumable.size()
+                uploaded = status.resumable_progress if status else total
+                progress(name, uploaded, total)
+        if session:
+            session.remove()
+        return response
+    
+    def __verify_upload(self, response: dict, checksums: Checksums) -> dict:
+        """
+        Compare checksums of sent bytes with the ones drive computed
+        
+        A corrupt copy must not be taken as a backup, so the uploaded
+        file is deleted before ChecksumError is raised.
+        """
+        try:
+            checksums.verify(response)
+        except ChecksumError:
+            self.delete(response['id'])
+            raise
+        return response
+    
+    def __index(self, response: dict) -> None:
+        """Add an uploaded file to the local index, lookups find it before the next sync"""
+        if self.index:
+            self.index.insert(response)
+    
+    @operation
+    def find_duplicate(self,
+                       checksums: Checksums=None,
+                       content_hash: str=None,
+                       folder_id: str=None
+        ) -> dict:
+        """
+        Find a file with the same content in folder
+        
+        Files which are uploaded with dedup carry sha256 of their content in
+        appProperties, they are found with one files().list query. With the
+        local index (GCAPI_USE_INDEX) any file with same md5Checksum and
+        size is found without a request, also the ones uploaded without dedup.
+        
+        Params:
+            checksums:      Checksums -> checksums of the local file
+            content_hash:   string    -> sha256 hex which identifies the content
+                                         (sha256 of checksums by default)
+            folder_id:      string    -> parent folder id (GCAPI_FOLDER_ID by default)
+            
+        Return:
+            file -> None | dictionary (id, name, size, md5Checksum)
+        """
+        folder_id = folder_id or FOLDER_ID
+        if self.index and checksums and not content_hash:
+            found = self.index.get_by_checksum(md5=checksums.md5.hexdigest(),
+                                               size=checksums.size,
+                                               folder_id=folder_id)
+            if found:
+                return found
+        content_hash = content_hash or checksums.sha256.hexdigest()
+        query = (f"appProperties has {{ key='{DEDUP_PROPERTY}' and value='{content_hash}' }}"
+                 f" and trashed = false")
+        if folder_id:
+            query += f" and '{folder_id}' in parents"
+        files = self.iter_files(query=query, fields='id, name, size, md5Checksum', page_size=1)
+        return next(files, None)
+    
+    @operation
+    def copy_duplicate(self,
+                       duplicate: dict,
+                       name: str,
+                       content_hash: str,
+                       folder_id: str=None
+        ) -> dict:
+        """
+        Copy a file with the same content on drive instead of uploading it
+        
+        Copy is not idempotent, so before a failed copy is sent again the
+        folder is searched for a copy which the failed attempt made anyway
+        (same name and content hash).
+        
+        Params:
+            duplicate:      dict   -> file with the same content (find_duplicate)
+            name:           string -> name of the copy
+            content_hash:   string -> dedup key of the content, kept in appProperties
+            folder_id:      string -> parent folder id (GCAPI_FOLDER_ID by default)
+            
+        Return:
+            json : copy, its duplicateOf is the id of duplicate
+        """
+        folder_id = folder_id or FOLDER_ID
+        body = {
+            'name': name,
+            'parents': [folder_id],
+            'appProperties': {DEDUP_PROPERTY: content_hash}
+        }
+        request = self.get_service().files().copy(fileId=duplicate['id'],
+                                                  body=body,
+                                                  fields=UPLOAD_FIELDS)
+        
+        def made_copy() -> dict:
+            query = (f"name='{name}' and appProperties has {{ key='{DEDUP_PROPERTY}' "
+                     f"and value='{content_hash}' }} and trashed = false")
+            if folder_id:
+                query += f" and '{folder_id}' in parents"
+            files = self.iter_files(query=query, fields=UPLOAD_FIELDS)
+            return next((file for file in files if file['id'] != duplicate['id']), None)
+        
+        response = self.__retry_create(request, find=made_copy)
+        response['duplicateOf'] = duplicate['id']
+        return response
+    
+    @operation
     def upload(self, 
                file: str,
+               folder_id: str=None,
+               chunk_size: int=CHUNK_SIZE,
+               progress=None,
+               verify: bool=VERIFY_CHECKSUM,
+               dedup: bool=DEDUP,
+               content_hash: str=None
         ) -> dict:
         """Create new file
         
         Upload API to google drive
         
         Params:
-            file :       string -> path of file or file name
+            file :       string     -> path of file or file name
+            folder_id:   string     -> parent folder id (GCAPI_FOLDER_ID by default)
+            chunk_size:  int        -> resumable upload chunk size (multiple of 256 KiB)
+            progress:    callable   -> progress(file, uploaded_bytes, total_bytes)
+            verify:      bool       -> compare md5/sha256 of the sent bytes with
+                                       the ones drive returns, ChecksumError on mismatch
+            dedup:       bool       -> if the folder has a file with the same content,
+                                       copy it on drive instead of sending the bytes
+            content_hash: string    -> dedup key for files which differ on every run
+                                       with the same content (e.g. encrypted), sha256
+                                       of plain content. It is kept in appProperties
+                                       also without dedup. sha256 of file by default
+        
+        With dedup and without content_hash the file is hashed before upload,
+        its checksums are then used to verify the upload. Callers which hash
+        the content while they create it pass content_hash, so the file is
+        read only once. The copy has the new name, so name and latest backup
+        lookups work as for an upload, and its response has the id of the
+        original in duplicateOf.
+        
+        Session uri and committed offset are kept in a state file in 
+        GCAPI_BACKUP_FOLDER. If the process dies, uploading the same file 
+        again continues from the last committed offset.
             
         Return:
             json : proivde id of uploaded file and name of file
         """
         service = self.get_service()
-        
-        media_body = MediaFileUpload(filename=file,
-                                    resumable=True,
-                                    mimetype='application/octet-stream')
         body = {
             'name': os.path.basename(file),
-            'parents': [FOLDER_ID]
+            'parents': [folder_id or FOLDER_ID]
         }
         
-        response = service.files().create(body=body, 
-                                          media_body=media_body, 
-                                          fields='id, name').execute()
+        checksums = None
+        if dedup and not content_hash:
+            # content is looked up by its hash before any byte is sent
+            checksums = Checksums()
+            with open(file, 'rb') as f:
+                for data in iter(lambda: f.read(CHUNK_SIZE), b''):
+                    checksums.update(data)
+            content_hash = checksums.sha256.hexdigest()
+        if content_hash:
+            body['appProperties'] = {DEDUP_PROPERTY: content_hash}
+        
+        if dedup:
+            duplicate = self.find_duplicate(checksums=checksums,
+                                            content_hash=content_hash,
+                                            folder_id=folder_id)
+            if duplicate:
+                response = self.copy_duplicate(duplicate=duplicate,
+                                               name=body['name'],
+                                               content_hash=content_hash,
+                                               folder_id=folder_id)
+                # an interrupted upload of this file is not needed anymore
+                UploadSession(file).remove()
+                self.__index(response)
+                if progress:
+                    size = os.path.getsize(file)
+                    progress(file, size, size)
+                return response
+        
+        # a file which is hashed already is not hashed again while it is sent
+        media_class = HashingFileUpload if verify and checksums is None else MediaFileUpload
+        media_body = media_class(filename=file,
+                                 chunksize=chunk_size,
+                                 resumable=True,
+                                 mimetype='application/octet-stream')
+        request = service.files().create(body=body, 
+                                         media_body=media_body, 
+                                         fields=UPLOAD_FIELDS)
+        
+        session = UploadSession(file)
+        is_resumed = session.load()
+        if is_resumed:
+            # continue old session, drive is asked for the committed
+            # offset before sending the next chunk
+            request.resumable_uri = session.uri
+            request.resumable_progress = session.offset
+            request._in_error_state = True
+        else:
+            session.name = body['name']
+            session.folder_id = folder_id or FOLDER_ID
+        
+        try:
+            response = self.__send_chunks(request, name=file, progress=progress,
+                                          session=session)
+        except HttpError as e:
+            if is_resumed and e.resp.status in (404, 410):
+                # session is expired, start from zero
+                session.remove()
+                return self.upload(file=file, folder_id=folder_id,
+                                   chunk_size=chunk_size, progress=progress,
+                                   verify=verify, dedup=dedup,
+                                   content_hash=content_hash)
+            raise
+        if verify:
+            if checksums is None:
+                # drive may finish a resumed session without asking for more bytes
+                media_body.hash_until(media_body.size())
+                checksums = media_body.checksums
+            self.__verify_upload(response, checksums)
+        self.__index(response)
         return response
+    
+    @operation
+    def resume_uploads(self, prefix: str=None, progress=None) -> dict:
+        """Finish interrupted uploads
         
+        Continue every upload whose state file is in GCAPI_BACKUP_FOLDER
+        and whose source file still exists and is unchanged.
+        
+        Params:
+            prefix:     string   -> only resume files whose name starts with prefix
+            progress:   callable -> progress(file, uploaded_bytes, total_bytes)
+            
+        Return:
+            dict : file path -> id and name of uploaded file
+        """
+        responses = {}
+        for session in UploadSession.pending():
+            if prefix and not os.path.basename(session.file).startswith(prefix):
+                continue
+            responses[session.file] = self.upload(file=session.file,
+                                                  folder_id=session.folder_id,
+                                                  progress=progress)
+        return responses
+    
+    @operation
+    def upload_many(self,
+                    files: list,
+                    folder_id: str=None,
+                    max_workers: int=MAX_WORKERS,
+                    chunk_size: int=CHUNK_SIZE,
+                    progress=None
+        ) -> dict:
+        """Create multiple files
+        
+        Upload several files at the same time. Every worker thread uses
+        its own service and HTTP connection.
+        
+        Params:
+            files :      list[string] -> file paths
+            folder_id:   string       -> parent folder id (GCAPI_FOLDER_ID by default)
+            max_workers: int          -> number of files uploaded at the same time
+            chunk_size:  int          -> resumable upload chunk size
+            progress:    callable     -> progress(file, uploaded_bytes, total_bytes),
+                                         it is called from worker threads
+            
+        Return:
+            dict : file path -> id and name of uploaded file
+        """
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            upload = inherit(self.upload)
+            futures = {
+                file: pool.submit(upload, 
+                                  file=file,
+                                  folder_id=folder_id,
+                                  chunk_size=chunk_size,
+                                  progress=progress)
+                for file in files
+            }
+            return {file: future.result() for file, future in futures.items()}
+    
+    @operation
+    def upload_stream(self,
+                      stream,
+                      name: str,
+                      folder_id: str=None,
+                      chunk_size: int=CHUNK_SIZE,
+                      progress=None,
+                      verify: bool=VERIFY_CHECKSUM
+        ) -> dict:
+        """Create new file from a stream
+        
+        Upload readable stream (e.g. stdout of pg_dump | gpg) to google drive
+        chunk by chunk. Size of the stream does not have to be known and
+        nothing is written to disk.
+        
+        Params:
+            stream:     file object -> readable binary stream
+            name:       string      -> file name on google drive
+            folder_id:  string      -> parent folder id (GCAPI_FOLDER_ID by default)
+            chunk_size: int         -> resumable upload chunk size
+            progress:   callable    -> progress(name, uploaded_bytes, total_bytes),
+                                       total is None until the stream ends
+            verify:     bool        -> compare md5/sha256 of the read bytes with
+                                       the ones drive returns, ChecksumError on mismatch
+            
+        Return:
+            json : proivde id of uploaded file and name of file
+        """
+        service = self.get_service()
+        
+        media_body = MediaPipeUpload(stream=stream, chunksize=chunk_size)
+        body = {
+            'name': name,
+            'parents': [folder_id or FOLDER_ID]
+        }
+        
+        request = service.files().create(body=body,
+                                         media_body=media_body,
+                                         fields=UPLOAD_FIELDS)
+        response = self.__send_chunks(request, name=name, progress=progress)
+        if verify:
+            self.__verify_upload(response, media_body.checksums)
+        self.__index(response)
+        return response
+        
+    @operation
     def delete(self, 
                file_id: str
         ) -> bool:
@@ -253,42 +867,179 @@ class GCDrive:
             but for the control it return boolean value
         """
         service = self.get_service()
-        response = service.files().delete(fileId=file_id).execute()
+        request = service.files().delete(fileId=file_id)
+        attempts = []
+        
+        def send():
+            attempts.append(True)
+            return request.execute()
+        
+        try:
+            response = retry(send)
+        except HttpError as e:
+            # a retried delete finds the file deleted by the failed attempt
+            if e.resp.status != 404 or len(attempts) == 1:
+                raise
+            response = ""
+        if self.index:
+            self.index.forget(file_id=file_id)
         return True if response == "" else False 
     
+    def __batch(self, requests: dict, missing_ok: bool=False) -> dict:
+        """
+        Send requests as batch HTTP requests, up to BATCH_SIZE calls per batch
+        
+        Params:
+            requests:   dict -> key -> HttpRequest
+            missing_ok: bool -> a call which is sent again and answers 404 was
+                                done by its failed attempt (delete), it is a success
+            
+        Return:
+            dict : key -> response, or HttpError of the failed call
+        """
+        service = self.get_service()
+        results = {}
+        
+        def callback(request_id, response, exception):
+            results[request_id] = exception if exception else response
+        
+        keys = list(requests)
+        # calls which are sent more than once
+        resent = set()
+        for attempt in range(RETRIES + 1):
+            if attempt:
+                resent.update(keys)
+            for start in range(0, len(keys), BATCH_SIZE):
+                batch = service.new_batch_http_request(callback=callback)
+                for key in keys[start:start + BATCH_SIZE]:
+                    batch.add(requests[key], request_id=key)
+                attempts = []
+                
+                def send(batch=batch):
+                    attempts.append(True)
+                    return batch.execute()
+                
+                retry(send)
+                if len(attempts) > 1:
+                    # drive may have done the calls of the failed batch
+                    resent.update(keys[start:start + BATCH_SIZE])
+            if missing_ok:
+                for key in keys:
+                    if key in resent and isinstance(results[key], HttpError) \
+                            and results[key].resp.status == 404:
+                        # same as delete()
+                        results[key] = ""
+            # calls which failed with a transient error are sent in a new batch
+            keys = [key for key in keys 
+                    if isinstance(results[key], Exception) and is_transient(results[key])]
+            if not keys or attempt == RETRIES:
+                return results
+            sleep(backoff(attempt), results[keys[0]])
+    
+    @operation
     def bulk_delete(self,
                     file_list: list
-        ) -> bool:
+        ) -> dict:
         """Multiple delete file
         
-        Allow to delete more than one file on your google drive
+        Allow to delete more than one file on your google drive.
+        Files are deleted with batch requests (100 files per request)
+        and a failed file does not stop the others.
         
         Params:
             file_list :     list[string] -> item id as a list
             
         Return:
-            True/False : boolean -> Normally it return empty response, 
-            but for the control it return boolean value
+            dict : file id -> True if it is deleted, otherwise the error
         """
         service = self.get_service()
-        result = False
-        for file in file_list:
-            response = service.files().delete(fileId=file).execute()
-            if response == "":
-                result = True
-            else:
-                raise ValueError('Could not delete file, it my cause of id')
-        return result        
+        responses = self.__batch({
+            file_id: service.files().delete(fileId=file_id)
+            for file_id in file_list
+        }, missing_ok=True)
+        results = {}
+        for file_id, response in responses.items():
+            results[file_id] = response if isinstance(response, Exception) else True
+            if results[file_id] is True and self.index:
+                self.index.forget(file_id=file_id)
+        return results
+    
+    @operation
+    def bulk_get(self,
+                 file_list: list,
+                 fields: str='id, name, createdTime, mimeType, size'
+        ) -> dict:
+        """Multiple file information
+        
+        Get more than one file's information with batch requests
+        
+        Params:
+            file_list :     list[string] -> item id as a list
+            fields:         string       -> file fields. e.g. "id, name, size"
+            
+        Return:
+            dict : file id -> file dictionary, otherwise the error
+        """
+        service = self.get_service()
+        return self.__batch({
+            file_id: service.files().get(fileId=file_id, fields=fields)
+            for file_id in file_list
+        })
+
+    @operation
+    def apply_retention(self,
+                        policy: RetentionPolicy,
+                        prefix: str,
+                        dry_run: bool=False,
+                        cryption: Cryption=None
+        ) -> dict:
+        """Prune old backups
+        
+        Keep backups which are selected by grandfather-father-son policy
+        and delete the others with batch requests.
+        
+        Full tarballs and manifests of incremental media backups (gcapi.manifest)
+        are selected separately. Packs which only expired manifests refer to
+        are deleted too.
+        
+        Params:
+            policy:     RetentionPolicy -> how many hourly/daily/weekly/monthly backups to keep
+            prefix:     string          -> backup name prefix. e.g. "default_mydb_", "media_"
+            dry_run:    boolean         -> only report, do not delete
+            cryption:   Cryption        -> decrypt encrypted manifests to find their packs
+            
+        Return:
+            dict : keep -> kept files, delete -> expired files and unreferenced packs,
+                   results -> file id -> True | error (empty on dry run)
+        """
+        files = [file for file in self.iter_files(query=self.__backup_query(name=prefix),
+                                                  fields="id, name, createdTime")
+                 if file.get('name', '').startswith(prefix)]
+        manifests = [file for file in files if MANIFEST_SUFFIX in file['name']]
+        keep, expire = policy.split([file for file in files if MANIFEST_SUFFIX not in file['name']])
+        if manifests:
+            kept_manifests, expired_manifests = policy.split(manifests)
+            keep += kept_manifests
+            expire += expired_manifests
+            expire += unreferenced_packs(self, kept_manifests, cryption=cryption)
+        results = {}
+        if expire and not dry_run:
+            results = self.bulk_delete([file['id'] for file in expire])
+        return {'keep': keep, 'delete': expire, 'results': results}
 
+    @operation
     def download(self,
                file_id: str,
-               file_name: str=None
+               file_name: str=None,
+               verify: bool=VERIFY_CHECKSUM
         ):
         """
         Download specific file on your Google Drive as byte
         
         Params:
             file_id:    string -> item id
+            verify:     bool   -> hash written bytes and compare with drive
+                                  checksums, the file is removed on mismatch
             
         Return:
             status:     boolean -> download proccess status
@@ -298,10 +1049,270 @@ class GCDrive:
         name = file_name if file_name else file_id
         file = os.path.join(BACKUP_FOLDER, name)
         with open(file, 'wb') as f:
-            downloader = MediaIoBaseDownload(f, request)
+            writer = HashingWriter(f) if verify else f
+            downloader = MediaIoBaseDownload(writer, request)
             done = False
             while done is False:
-                status, done = downloader.next_chunk()
-            return done, file
+                # a failed chunk is retried, download continues from it
+                status, done = retry(concurrency.call, downloader.next_chunk)
+        if verify:
+            self.__verify_download(file_id, writer.checksums, file)
+        return done, file
+    
+    def __verify_download(self, file_id: str, checksums: Checksums, file: str=None) -> None:
+        """
+        Compare checksums of downloaded bytes with drive metadata
+        
+        Params:
+            file_id:    string    -> item id
+            checksums:  Checksums -> checksums of downloaded bytes
+            file:       string    -> local file which is removed on mismatch
+        """
+        try:
+            checksums.verify(self.get(file_id=file_id))
+        except ChecksumError:
+            if file:
+                os.remove(file)
+            raise
+    
+    @operation
+    def download_range(self,
+                       file_id: str,
+                       start: int,
+                       end: int
+        ) -> bytes:
+        """
+        Download a byte range of specific file on your Google Drive
+        
+        Params:
+            file_id:    string -> item id
+            start:      int    -> first byte
+            end:        int    -> last byte (inclusive)
+            
+        Return:
+            content:    bytes
+        """
+        request = self.get_service().files().get_media(fileId=file_id)
+        request.headers['range'] = f"bytes={start}-{end}"
+        content = retry(concurrency.call, request.execute)
+        if len(content) != end - start + 1:
+            raise ValueError(f"Range {start}-{end} of {file_id} is incomplete")
+        return content
+    
+    @operation
+    def download_ranges(self,
+                        file_id: str,
+                        file_name: str=None,
+                        range_size: int=RANGE_SIZE,
+                        max_workers: int=MAX_WORKERS,
+                        verify: bool=VERIFY_CHECKSUM
+        ):
+        """
+        Download specific file on your Google Drive with parallel range requests
+        
+        File is split into byte ranges which are fetched by a worker pool and
+        written to their place in a preallocated file. Finished ranges are
+        marked in a sidecar file (<file>.ranges), so an interrupted download
+        only fetches the missing ranges when it is started again.
+        
+        Params:
+            file_id:        string -> item id
+            file_name:      string -> local file name (file id by default)
+            range_size:     int    -> bytes fetched by one request
+            max_workers:    int    -> number of ranges fetched at the same time
+            verify:     bool       -> hash ranges in order and compare with drive
+                                      checksums, the file is removed on mismatch
+        
+        Ranges are hashed from memory as soon as all ranges before them are
+        hashed. A few early ranges wait in memory, the others (and the ranges
+        of an interrupted download) are read back from page cache in turn.
+            
+        Return:
+            status:     boolean -> download proccess status
+            file:       string  -> downloaded file path
+        """
+        metadata = self.get(file_id=file_id)
+        size = int(metadata.get('size', 0))
+        name = file_name if file_name else file_id
+        file = os.path.join(BACKUP_FOLDER, name)
+        sidecar = f"{file}.ranges"
+        count = -(-size // range_size)
+        # ranges of another file content under the same name are not reused
+        header = f"{size} {range_size} {metadata.get('md5Checksum', '')}\n".encode()
+        
+        # load finished ranges of an interrupted download
+        done = bytearray(count)
+        if os.path.exists(sidecar) and os.path.exists(file):
+            with open(sidecar, 'rb') as f:
+                state = f.read()
+            if state.startswith(header) and len(state) == len(header) + count:
+                done = bytearray(state[len(header):])
+        if not any(done):
+            with open(sidecar, 'wb') as f:
+                f.write(header + bytes(count))
+        
+        fd = os.open(file, os.O_RDWR | os.O_CREAT, 0o644)
+        sidecar_fd = os.open(sidecar, os.O_RDWR)
+        try:
+            os.ftruncate(fd, size)
+            
+            checksums = Checksums()
+            hash_lock = threading.Lock()
+            hashed = 0      # ranges which are hashed, in order
+            early = {}      # ranges which are fetched before the previous ones
+            
+            def hash_ready() -> None:
+                nonlocal hashed
+                while hashed < count:
+                    if hashed in early:
+                        content = early.pop(hashed)
+                    elif done[hashed]:
+                        start = hashed * range_size
+                        content = os.pread(fd, min(range_size, size - start), start)
+                    else:
+                        return
+                    checksums.update(content)
+                    hashed += 1
+            
+            def fetch(index: int):
+                start = index * range_size
+                end = min(start + range_size, size) - 1
+                content = self.download_range(file_id, start, end)
+                os.pwrite(fd, content, start)
+                os.pwrite(sidecar_fd, b'\x01', len(header) + index)
+                if verify:
+                    with hash_lock:
+                        if index == hashed or len(early) < max_workers:
+                            early[index] = content
+                        done[index] = 1
+                        hash_ready()
+            
+            with ThreadPoolExecutor(max_workers=max_workers) as pool:
+                fetch = inherit(fetch)
+                futures = [pool.submit(fetch, index) 
+                           for index in range(count) if not done[index]]
+                for future in futures:
+                    future.result()
+            if verify:
+                # every range is finished by an interrupted download
+                hash_ready()
+        finally:
+            os.close(fd)
+            os.close(sidecar_fd)
+        
+        os.remove(sidecar)
+        if verify:
+            try:
+                checksums.verify(metadata)
+            except ChecksumError:
+                os.remove(file)
+                raise
+        return True, file
 
+    @operation
+    def download_decrypted(self,
+                           file_id: str,
+                           cryption: Cryption,
+                           file_name: str=None,
+                           range_size: int=RANGE_SIZE,
+                           max_workers: int=MAX_WORKERS
+        ):
+        """
+        Download an AEAD encrypted file (GCAPI_CRYPTION_MODE=aead) with parallel
+        range requests, every range is decrypted as it arrives
+        
+        Params:
+            file_id:        string   -> item id
+            cryption:       Cryption -> unwraps the data key of the file
+            file_name:      string   -> local file name, .gpg is removed (file id by default)
+            range_size:     int      -> bytes fetched by one request
+            max_workers:    int      -> number of ranges fetched at the same time
+            
+        Return:
+            status:     boolean -> download proccess status
+            file:       string  -> decrypted file path
+        """
+        size = int(self.get(file_id=file_id).get('size', 0))
+        envelope = cryption.open_envelope(
+            read_at=inherit(lambda offset, length: self.download_range(file_id, offset, 
+                                                                       offset + length - 1)),
+            size=size)
+        name = (file_name if file_name else file_id).removesuffix('.gpg')
+        file = os.path.join(BACKUP_FOLDER, name)
+        envelope.decrypt_to(file, range_size=range_size, max_workers=max_workers)
+        return True, file
 
+    @operation
+    def download_stream(self,
+                        file_id: str,
+                        stream,
+                        chunk_size: int=CHUNK_SIZE,
+                        queue_size: int=QUEUE_SIZE,
+                        verify: bool=VERIFY_CHECKSUM
+        ) -> int:
+        """
+        Download specific file on your Google Drive into a writable stream
+        
+        Chunks are downloaded in a background thread and passed to the stream
+        through a bounded queue. So the consumer (e.g. stdin of gpg | pg_restore)
+        works while download continues, and a slow consumer applies
+        backpressure to the download.
+        
+        Params:
+            file_id:    string      -> item id
+            stream:     file object -> writable binary stream
+            chunk_size: int         -> size of each download request
+            queue_size: int         -> max chunks waiting in memory
+            verify:     bool        -> hash written bytes and compare with drive
+                                       checksums, ChecksumError on mismatch. The
+                                       stream has the data already, so the consumer
+                                       must not trust it when this is raised
+            
+        Return:
+            size:       int -> written bytes
+        """
+        service = self.get_service()
+        request = service.files().get_media(fileId=file_id)
+        chunks = queue.Queue(maxsize=queue_size)
+        errors = []
+        stop = threading.Event()
+        
+        def produce():
+            try:
+                downloader = MediaIoBaseDownload(_QueueWriter(chunks), request,
+                                                 chunksize=chunk_size)
+                done = False
+                while done is False and not stop.is_set():
+                    status, done = retry(concurrency.call, downloader.next_chunk)
+            except Exception as exc:
+                errors.append(exc)
+            finally:
+                chunks.put(None)
+        
+        producer = threading.Thread(target=inherit(produce), daemon=True)
+        producer.start()
+        checksums = Checksums()
+        size = 0
+        try:
+            while True:
+                chunk = chunks.get()
+                if chunk is None:
+                    break
+                stream.write(chunk)
+                size += len(chunk)
+                if verify:
+                    checksums.update(chunk)
+        finally:
+            # unblock producer if consumer failed
+            stop.set()
+            while producer.is_alive():
+                try:
+                    chunks.get(timeout=0.1)
+                except queue.Empty:
+                    pass
+        
+        if errors:
+            raise errors[0]
+        if verify:
+            self.__verify_download(file_id, checksums)
+        return size
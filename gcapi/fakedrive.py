@@ -0,0 +1,404 @@
+"""
+In-process fake of Google Drive v3
+
+Serves the part of Drive v3 which GCDrive uses over real HTTP on a local
+port, so googleapiclient, httplib2, retries and throttling all run as they
+do against Drive, without network or credentials:
+
+    - files.list    -> q (name =, name contains, 'id' in parents, mimeType,
+                       trashed, appProperties has), orderBy, paging
+    - files.get     -> metadata, or content with alt=media and Range
+    - files.create  -> metadata only, or resumable upload
+    - files.copy, files.delete
+    - batch         -> multipart/mixed batch of the calls above
+
+Faults can be injected to test retries and resumes:
+
+    with FakeDrive() as fake:
+        drive = GCDrive(pool=fake.pool())
+        fake.fail(status=503, times=2, retry_after=1)
+        drive.upload(file)
+
+Latency and bandwidth of a real link can be simulated for benchmarks
+(see benchmarks/transfer.py):
+
+    FakeDrive(latency=0.05, bandwidth='10M')
+"""
+import re
+import json
+import time
+import uuid
+import email
+import hashlib
+import datetime
+import threading
+import collections
+import http
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit, parse_qs
+from google.oauth2.credentials import Credentials
+from gcapi.service import ServicePool
+from gcapi.throttle import BandwidthProfile, TokenBucket, parse_rate
+
+
+FOLDER_MIMETYPE = 'application/vnd.google-apps.folder'
+# bytes which are read or written at once when bandwidth is limited
+BLOCK_SIZE = 64 * 1024
+BATCH_BOUNDARY = 'batch_fakedrive'
+# query clauses which are understood, other clauses are ignored
+QUERY_CLAUSES = {
+    r"name\s*=\s*'((?:[^'\\]|\\.)*)'":
+        lambda value: lambda file: file['name'] == value,
+    r"name\s+contains\s+'((?:[^'\\]|\\.)*)'":
+        lambda value: lambda file: value in file['name'],
+    r"'((?:[^'\\]|\\.)*)'\s+in\s+parents":
+        lambda value: lambda file: value in file.get('parents', []),
+    r"mimeType\s*=\s*'((?:[^'\\]|\\.)*)'":
+        lambda value: lambda file: file['mimeType'] == value,
+    r"mimeType\s*!=\s*'((?:[^'\\]|\\.)*)'":
+        lambda value: lambda file: file['mimeType'] != value,
+    r"trashed\s*=\s*(true|false)":
+        lambda value: lambda file: file['trashed'] == (value == 'true'),
+    r"appProperties\s+has\s+\{\s*key\s*=\s*'([^']*)'\s+and\s+value\s*=\s*'([^']*)'\s*\}":
+        lambda key, value: lambda file: file.get('appProperties', {}).get(key) == value,
+}
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args) -> None:
+        pass
+
+    def do_GET(self) -> None:
+        self.server.drive.handle(self)
+
+    do_POST = do_PUT = do_PATCH = do_DELETE = do_GET
+
+
+class FakeDrive:
+    def __init__(self, latency: float=0.0, bandwidth=0) -> None:
+        """
+        Params:
+            latency:    float -> seconds added to every response
+            bandwidth:        -> bytes per second of each direction, shared by all
+                                 connections like one link, e.g. '10M' (0 is unlimited)
+        """
+        self.latency = latency
+        self.files = {}             # id -> metadata
+        self.contents = {}          # id -> bytes
+        self.sessions = {}          # upload id -> resumable upload session
+        self.requests = []          # (method, path) of every http request
+        self.bytes_received = 0     # request bodies
+        self.bytes_sent = 0         # response bodies
+        self.faults = collections.deque()
+        self._received = TokenBucket(BandwidthProfile(default=parse_rate(bandwidth)))
+        self._sent = TokenBucket(BandwidthProfile(default=parse_rate(bandwidth)))
+        self.root_url = None
+        self._lock = threading.RLock()
+        self._server = None
+        self._clock = datetime.datetime(2024, 1, 1, tzinfo=datetime.timezone.utc)
+
+    def start(self) -> 'FakeDrive':
+        """Serve on a free local port in a background thread"""
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), _Handler)
+        self._server.daemon_threads = True
+        self._server.drive = self
+        self.root_url = f"http://127.0.0.1:{self._server.server_port}/"
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self) -> None:
+        if self._server:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+    def __enter__(self) -> 'FakeDrive':
+        return self.start()
+
+    def __exit__(self, *exc) -> None:
+        self.stop()
+
+    def pool(self) -> ServicePool:
+        """Service pool whose requests go to this server"""
+        return ServicePool(credentials=Credentials(token='fake'), root_url=self.root_url)
+
+    def add_file(self, name: str, content: bytes=None, **metadata) -> dict:
+        """Create a file (or a folder, without content) directly"""
+        with self._lock:
+            return self.__create(dict(metadata, name=name), content)
+
+    def fail(self,
+             status: int=503,
+             times: int=1,
+             retry_after=None,
+             reason: str='backendError',
+             method: str=None,
+             path: str=None,
+             drop: bool=False,
+             commit: bool=False,
+             after: int=0
+        ) -> None:
+        """
+        Answer next matching requests with an error
+
+        Params:
+            status:         int  -> http status of error response
+            times:          int  -> number of requests which fail
+            retry_after:         -> Retry-After header value
+            reason:         str  -> error reason, e.g. userRateLimitExceeded
+            method:         str  -> only requests of this http method
+            path:           str  -> only requests whose path starts with this
+            drop:           bool -> close the connection without a response
+            commit:         bool -> process the request before the error, like
+                                    a chunk which is stored but not acknowledged
+            after:          int  -> matching requests which are answered before
+                                    the first error, e.g. to fail halfway of a download
+        """
+        with self._lock:
+            for _ in range(times):
+                self.faults.append({'status': status, 'retry_after': retry_after,
+                                    'reason': reason, 'method': method, 'path': path,
+                                    'drop': drop, 'commit': commit, 'after': after})
+                # only the first fault waits
+                after = 0
+
+    def __take_fault(self, method: str, path: str) -> dict:
+        for fault in self.faults:
+            if fault['method'] not in (None, method):
+                continue
+            if fault['path'] and not path.startswith(fault['path']):
+                continue
+            if fault['after']:
+                fault['after'] -= 1
+                return None
+            self.faults.remove(fault)
+            return fault
+        return None
+
+    def clear(self) -> None:
+        """Remove all files and upload sessions"""
+        with self._lock:
+            self.files.clear()
+            self.contents.clear()
+            self.sessions.clear()
+
+    def reset_stats(self) -> None:
+        with self._lock:
+            self.requests = []
+            self.bytes_received = 0
+            self.bytes_sent = 0
+
+    def handle(self, handler: BaseHTTPRequestHandler) -> None:
+        url = urlsplit(handler.path)
+        params = {key: values[0] for key, values in parse_qs(url.query).items()}
+        body = self.__read(handler, int(handler.headers.get('Content-Length') or 0))
+        with self._lock:
+            self.requests.append((handler.command, url.path))
+            self.bytes_received += len(body)
+            response = self.__call(handler.command, url.path, params, body, handler.headers)
+        if self.latency:
+            time.sleep(self.latency)
+        if response is None:
+            # dropped connection
+            handler.close_connection = True
+            return
+        self.__send(handler, *response)
+
+    def __call(self, method: str, path: str, params: dict, body: bytes, headers) -> tuple:
+        """
+        Answer a call, or its fault
+
+        Return:
+            status, payload, headers (None for a dropped connection)
+        """
+        fault = self.__take_fault(method, path)
+        if fault is None or fault['commit']:
+            response = self.__route(method, path, params, body, headers)
+        if fault is None:
+            return response
+        if fault['drop']:
+            return None
+        headers = {'Retry-After': str(fault['retry_after'])} if fault['retry_after'] is not None else {}
+        error = {'error': {'code': fault['status'], 'message': fault['reason'],
+                           'errors': [{'reason': fault['reason']}]}}
+        return fault['status'], error, headers
+
+    def __read(self, handler: BaseHTTPRequestHandler, length: int) -> bytes:
+        """Read request body as fast as the simulated link allows"""
+        blocks = []
+        while length > 0:
+            block = handler.rfile.read(min(BLOCK_SIZE, length))
+            if not block:
+                break
+            self._received.consume(len(block))
+            blocks.append(block)
+            length -= len(block)
+        return b''.join(blocks)
+
+    def __encode(self, payload=None, headers: dict=None) -> tuple:
+        """Return: content bytes, headers"""
+        if isinstance(payload, (dict, list)):
+            return json.dumps(payload).encode(), dict(headers or {}, **{'Content-Type': 'application/json'})
+        return payload or b'', headers or {}
+
+    def __send(self, handler: BaseHTTPRequestHandler, status: int, payload=None,
+               headers: dict=None) -> None:
+        content, headers = self.__encode(payload, headers)
+        handler.send_response(status)
+        for key, value in headers.items():
+            handler.send_header(key, value)
+        handler.send_header('Content-Length', str(len(content)))
+        handler.end_headers()
+        with self._lock:
+            self.bytes_sent += len(content)
+        for start in range(0, len(content), BLOCK_SIZE):
+            block = content[start:start + BLOCK_SIZE]
+            self._sent.consume(len(block))
+            handler.wfile.write(block)
+
+    def __batch(self, body: bytes, content_type: str) -> tuple:
+        """Answer every call of a multipart/mixed batch request"""
+        message = email.message_from_bytes(f"Content-Type: {content_type}\r\n\r\n".encode() + body)
+        parts = []
+        for part in message.get_payload():
+            head, _, inner_body = part.get_payload().replace('\r\n', '\n').partition('\n\n')
+            request_line, _, header_lines = head.partition('\n')
+            method, target, _ = request_line.split(' ', 2)
+            url = urlsplit(target)
+            params = {key: values[0] for key, values in parse_qs(url.query).items()}
+            response = self.__call(method, url.path, params, inner_body.encode(),
+                                   email.message_from_string(header_lines))
+            status, payload, headers = response or (503, None, {})
+            content, headers = self.__encode(payload, headers)
+            lines = [f"HTTP/1.1 {status} {http.HTTPStatus(status).phrase}"]
+            lines += [f"{key}: {value}" for key, value in headers.items()]
+            lines.append(f"Content-Length: {len(content)}")
+            # request Content-ID <base + id> is answered as <response-base + id>,
+            # long ids are folded into lines
+            content_id = ' '.join(part['Content-ID'].split()).strip('<>')
+            parts.append(f"--{BATCH_BOUNDARY}\r\n"
+                         f"Content-Type: application/http\r\n"
+                         f"Content-ID: <response-{content_id}>\r\n\r\n"
+                         + "\r\n".join(lines) + "\r\n\r\n" + content.decode() + "\r\n")
+        content = ("".join(parts) + f"--{BATCH_BOUNDARY}--\r\n").encode()
+        return 200, content, {'Content-Type': f"multipart/mixed; boundary={BATCH_BOUNDARY}"}
+
+    def __route(self, method: str, path: str, params: dict, body: bytes, headers) -> tuple:
+        """Return: status, payload, headers"""
+        if path == '/batch/drive/v3' and method == 'POST':
+            return self.__batch(body, headers.get('Content-Type'))
+        parts = path.strip('/').split('/')
+        if parts[:3] == ['upload', 'drive', 'v3'] and parts[3:] == ['files']:
+            if method == 'POST':
+                return self.__start_upload(params, body)
+            if method == 'PUT':
+                return self.__upload_chunk(params, body, headers)
+        if parts[:2] == ['drive', 'v3'] and parts[2:3] == ['files']:
+            file_id = parts[3] if len(parts) > 3 else None
+            if file_id is None and method == 'GET':
+                return self.__list(params)
+            if file_id is None and method == 'POST':
+                return 200, self.__create(json.loads(body or b'{}'), None), {}
+            if file_id not in self.files:
+                return self.__error(404, 'notFound')
+            if parts[4:] == ['copy'] and method == 'POST':
+                metadata = dict(self.files[file_id], **json.loads(body or b'{}'))
+                return 200, self.__create(metadata, self.contents.get(file_id)), {}
+            if method == 'GET' and params.get('alt') == 'media':
+                return self.__media(file_id, headers)
+            if method == 'GET':
+                return 200, self.files[file_id], {}
+            if method == 'DELETE':
+                del self.files[file_id]
+                self.contents.pop(file_id, None)
+                return 204, None, {}
+        return self.__error(404, 'notFound')
+
+    def __error(self, status: int, reason: str) -> tuple:
+        return status, {'error': {'code': status, 'message': reason,
+                                  'errors': [{'reason': reason}]}}, {}
+
+    def __create(self, metadata: dict, content: bytes) -> dict:
+        # strictly increasing creation times keep orderBy stable
+        self._clock += datetime.timedelta(milliseconds=1)
+        file = {
+            'kind': 'drive#file',
+            'id': uuid.uuid4().hex,
+            'mimeType': 'application/octet-stream',
+            'parents': [],
+            'trashed': False,
+        }
+        file.update({key: value for key, value in metadata.items()
+                     if key not in ('id', 'size', 'md5Checksum', 'sha256Checksum')})
+        file['parents'] = [parent for parent in file['parents'] if parent]
+        file['createdTime'] = self._clock.strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3] + 'Z'
+        if content is not None:
+            file['size'] = str(len(content))
+            file['md5Checksum'] = hashlib.md5(content).hexdigest()
+            file['sha256Checksum'] = hashlib.sha256(content).hexdigest()
+            self.contents[file['id']] = bytes(content)
+        self.files[file['id']] = file
+        return file
+
+    def __list(self, params: dict) -> tuple:
+        checks = []
+        for pattern, check in QUERY_CLAUSES.items():
+            for match in re.finditer(pattern, params.get('q', '')):
+                values = [value.replace("\\'", "'") for value in match.groups()]
+                checks.append(check(*values))
+        files = [file for file in self.files.values() if all(check(file) for check in checks)]
+        if params.get('orderBy'):
+            key, *direction = params['orderBy'].split(',')[0].split()
+            files.sort(key=lambda file: file.get(key, ''), reverse=direction == ['desc'])
+        start = int(params.get('pageToken') or 0)
+        size = int(params.get('pageSize') or 100)
+        result = {'files': files[start:start + size]}
+        if start + size < len(files):
+            result['nextPageToken'] = str(start + size)
+        return 200, result, {}
+
+    def __media(self, file_id: str, headers) -> tuple:
+        content = self.contents.get(file_id, b'')
+        match = re.fullmatch(r'bytes=(\d+)-(\d*)', headers.get('Range') or '')
+        if not match:
+            return 200, content, {}
+        start = int(match[1])
+        end = min(int(match[2]) if match[2] else len(content) - 1, len(content) - 1)
+        if content and start >= len(content):
+            return self.__error(416, 'requestedRangeNotSatisfiable')
+        return 206, content[start:end + 1], {'Content-Range': f"bytes {start}-{end}/{len(content)}"}
+
+    def __start_upload(self, params: dict, body: bytes) -> tuple:
+        if params.get('uploadType') != 'resumable':
+            return self.__error(400, 'badRequest')
+        upload_id = uuid.uuid4().hex
+        self.sessions[upload_id] = {'metadata': json.loads(body or b'{}'), 'data': bytearray()}
+        location = f"{self.root_url}upload/drive/v3/files?uploadType=resumable&upload_id={upload_id}"
+        return 200, None, {'Location': location}
+
+    def __upload_chunk(self, params: dict, body: bytes, headers) -> tuple:
+        session = self.sessions.get(params.get('upload_id'))
+        if session is None:
+            return self.__error(404, 'notFound')
+        data = session['data']
+        content_range = headers.get('Content-Range')
+        total = None
+        if content_range:
+            match = re.fullmatch(r'bytes (\*|(\d+)-(\d+))/(\*|\d+)', content_range)
+            if not match:
+                return self.__error(400, 'badRequest')
+            total = None if match[4] == '*' else int(match[4])
+            if match[2] is not None and int(match[2]) <= len(data):
+                # bytes which are already stored are sent again after a failure
+                del data[int(match[2]):]
+                data += body
+        else:
+            # a single request with the whole (e.g. empty) file
+            data += body
+            total = len(data)
+        if total is not None and len(data) >= total:
+            del self.sessions[params['upload_id']]
+            return 200, self.__create(session['metadata'], bytes(data[:total])), {}
+        return 308, None, {'Range': f"bytes=0-{len(data) - 1}"} if data else {}
@@ -0,0 +1,252 @@
+"""
+Local index of Google Drive files
+
+Keep id, name, createdTime, size, md5 and parents of backup files in a
+SQLite database, so name and latest backup lookups do not need a files().list
+request every time. The index is kept current with the Drive Changes API:
+after the first full listing only the changes since the saved start page
+token are fetched.
+
+    - sync()        -> Fetch changes (or full listing for a new index)
+    - refresh()     -> Sync only if the index is older than max_age
+    - get_by_name() -> File by exact name
+    - list()        -> Files by name prefix
+    - get_latest()  -> Newest file by name prefix
+    - get_by_checksum() -> File with same md5 and size (upload dedup)
+    - insert()      -> Add a file right after it is uploaded
+
+Sources:
+    changes -> https://developers.google.com/drive/api/guides/manage-changes
+"""
+import os
+import time
+import sqlite3
+import contextlib
+from gcapi.retry import retry
+
+
+BACKUP_FOLDER = os.environ.get('GCAPI_BACKUP_FOLDER')
+FOLDER_ID = os.environ.get('GCAPI_FOLDER_ID', None)
+INDEX_PATH = os.environ.get('GCAPI_INDEX_PATH',
+                            os.path.join(BACKUP_FOLDER or '.', '.gcapi-index.sqlite3'))
+# index older than this many seconds is synced before a lookup
+INDEX_MAX_AGE = int(os.environ.get('GCAPI_INDEX_MAX_AGE', 60))
+# index older than this many seconds is dropped and listed again
+INDEX_TTL = int(os.environ.get('GCAPI_INDEX_TTL', 24 * 60 * 60))
+
+FIELDS = 'id, name, createdTime, size, md5Checksum, parents, mimeType, trashed'
+COLUMNS = ('id', 'name', 'createdTime', 'size', 'md5Checksum', 'parents', 'mimeType')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    id TEXT PRIMARY KEY,
+    name TEXT NOT NULL,
+    createdTime TEXT,
+    size INTEGER,
+    md5Checksum TEXT,
+    parents TEXT,
+    mimeType TEXT
+);
+CREATE INDEX IF NOT EXISTS files_name ON files (name);
+CREATE INDEX IF NOT EXISTS files_created ON files (createdTime);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+
+class DriveIndex:
+    def __init__(self,
+                 drive,
+                 path: str=INDEX_PATH,
+                 folder_id: str=FOLDER_ID,
+                 max_age: int=INDEX_MAX_AGE,
+                 ttl: int=INDEX_TTL
+        ) -> None:
+        """
+        Params:
+            drive:      GCDrive -> client which is used for syncing
+            path:       str     -> sqlite database path
+            folder_id:  str     -> only index files in this folder (all files if None)
+            max_age:    int     -> staleness in seconds which is allowed for lookups
+            ttl:        int     -> seconds after which the index is rebuilt from zero
+        """
+        self.drive = drive
+        self.path = path
+        self.folder_id = folder_id
+        self.max_age = max_age
+        self.ttl = ttl
+        # tables are created on first use, so creating a GCDrive touches no file
+        self._schema_ready = False
+
+    @contextlib.contextmanager
+    def __connect(self):
+        """Connection in a transaction, committed and closed at the end of the block"""
+        with contextlib.closing(sqlite3.connect(self.path)) as conn:
+            conn.row_factory = sqlite3.Row
+            if not self._schema_ready:
+                conn.executescript(SCHEMA)
+                self._schema_ready = True
+            with conn:
+                yield conn
+
+    def __get_meta(self, conn, key: str):
+        row = conn.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row['value'] if row else None
+
+    def __set_meta(self, conn, key: str, value) -> None:
+        conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)",
+                     (key, str(value)))
+
+    def __is_indexed(self, file: dict) -> bool:
+        if file.get('trashed'):
+            return False
+        return not self.folder_id or self.folder_id in file.get('parents', [])
+
+    def __save(self, conn, file: dict) -> None:
+        values = dict(file)
+        values['parents'] = ",".join(file.get('parents', []))
+        conn.execute(
+            f"INSERT OR REPLACE INTO files ({', '.join(COLUMNS)}) "
+            f"VALUES ({', '.join('?' for _ in COLUMNS)})",
+            [values.get(column) for column in COLUMNS])
+
+    def __row(self, row: sqlite3.Row) -> dict:
+        file = dict(row)
+        file['parents'] = file['parents'].split(",") if file['parents'] else []
+        return file
+
+    def __rebuild(self, conn, service) -> None:
+        """Index every file from zero"""
+        # take the token before listing, so changes during listing are not lost
+        token = retry(service.changes().getStartPageToken().execute).get('startPageToken')
+        conn.execute("DELETE FROM files")
+        query = "trashed = false"
+        if self.folder_id:
+            query += f" and '{self.folder_id}' in parents"
+        for file in self.drive.iter_files(query=query, fields=FIELDS):
+            self.__save(conn, file)
+        self.__set_meta(conn, 'page_token', token)
+        self.__set_meta(conn, 'built_at', time.time())
+
+    def __apply_changes(self, conn, service, token: str) -> None:
+        """Apply changes since the saved page token"""
+        while token:
+            request = service.changes().list(
+                pageToken=token,
+                pageSize=1000,
+                fields=f"nextPageToken, newStartPageToken, "
+                       f"changes(fileId, removed, file({FIELDS}))")
+            response = retry(request.execute)
+            for change in response.get('changes', []):
+                file = change.get('file')
+                if change.get('removed') or not file or not self.__is_indexed(file):
+                    conn.execute("DELETE FROM files WHERE id = ?", (change.get('fileId'),))
+                else:
+                    self.__save(conn, file)
+            if response.get('newStartPageToken'):
+                self.__set_meta(conn, 'page_token', response['newStartPageToken'])
+            token = response.get('nextPageToken')
+
+    def sync(self) -> None:
+        """
+        Bring the index up to date
+
+        New or expired (older than ttl) index is listed from zero,
+        otherwise only the changes since the last sync are fetched.
+        """
+        service = self.drive.get_service()
+        with self.__connect() as conn:
+            token = self.__get_meta(conn, 'page_token')
+            built_at = float(self.__get_meta(conn, 'built_at') or 0)
+            if token is None or time.time() - built_at > self.ttl:
+                self.__rebuild(conn, service)
+            else:
+                self.__apply_changes(conn, service, token)
+            self.__set_meta(conn, 'synced_at', time.time())
+
+    def refresh(self) -> None:
+        """Sync if the index is older than max_age"""
+        with self.__connect() as conn:
+            synced_at = float(self.__get_meta(conn, 'synced_at') or 0)
+        if time.time() - synced_at > self.max_age:
+            self.sync()
+
+    def get_by_name(self, file_name: str) -> dict:
+        """
+        Get file by its exact name
+
+        Return:
+            file -> None | dictionary
+        """
+        self.refresh()
+        with self.__connect() as conn:
+            row = conn.execute("SELECT * FROM files WHERE name = ? LIMIT 1",
+                               (file_name,)).fetchone()
+        return self.__row(row) if row else None
+
+    def list(self, prefix: str) -> list:
+        """
+        List files whose name starts with prefix
+
+        Return:
+            file list -> list
+        """
+        self.refresh()
+        with self.__connect() as conn:
+            rows = conn.execute("SELECT * FROM files WHERE substr(name, 1, ?) = ? "
+                                "ORDER BY createdTime DESC",
+                                (len(prefix), prefix)).fetchall()
+        return [self.__row(row) for row in rows]
+
+    def get_latest(self, prefix: str) -> dict:
+        """
+        Newest file whose name starts with prefix
+
+        Return:
+            file -> None | dictionary
+        """
+        self.refresh()
+        with self.__connect() as conn:
+            row = conn.execute("SELECT * FROM files WHERE substr(name, 1, ?) = ? "
+                               "ORDER BY createdTime DESC LIMIT 1",
+                               (len(prefix), prefix)).fetchone()
+        return self.__row(row) if row else None
+
+    def get_by_checksum(self, md5: str, size: int, folder_id: str=None) -> dict:
+        """
+        Get a file with same content, md5Checksum is computed by drive
+
+        Params:
+            md5:        str -> md5 hex digest
+            size:       int -> file size in bytes
+            folder_id:  str -> only files in this folder
+
+        Return:
+            file -> None | dictionary
+        """
+        self.refresh()
+        with self.__connect() as conn:
+            row = conn.execute("SELECT * FROM files WHERE md5Checksum = ? AND size = ? "
+                               "AND (? IS NULL OR ',' || parents || ',' LIKE '%,' || ? || ',%') "
+                               "LIMIT 1",
+                               (md5, size, folder_id, folder_id)).fetchone()
+        return self.__row(row) if row else None
+
+    def insert(self, file: dict) -> None:
+        """
+        Add a file to index (e.g. right after it is uploaded)
+
+        The next sync would bring it as a change, until then lookups
+        within max_age would not find it.
+        """
+        if not self.__is_indexed(file):
+            return
+        with self.__connect() as conn:
+            self.__save(conn, file)
+
+    def forget(self, file_id: str) -> None:
+        """Remove a file from index (e.g. right after it is deleted)"""
+        with self.__connect() as conn:
+            conn.execute("DELETE FROM files WHERE id = ?", (file_id,))
@@ -0,0 +1,453 @@
+"""
+Incremental, content-addressed media backup
+
+Instead of a full tarball of MEDIA_ROOT on every run, only new or changed
+files are uploaded:
+
+    - A local manifest (GCAPI_BACKUP_FOLDER/.gcapi-media-manifest.json) keeps
+      size, mtime and sha256 of every file. Only files whose size or mtime
+      changed are hashed again.
+    - Contents which are not on Drive yet are packed into pack objects
+      (mediapack_<sha256>) of about GCAPI_PACK_SIZE bytes. A pack is the plain
+      concatenation of file contents and its name is the hash of its member
+      hashes, so the same content is never uploaded twice.
+    - Every backup uploads a small manifest (media_<timestamp>.manifest.json.gz)
+      which maps every path to its content and every content to its pack.
+
+Restore compares the newest manifest with the local tree and only downloads
+missing or changed files. Every file is written to a temporary file and
+renamed over the old one, so a half written file is never left behind.
+
+Manifest:
+    {
+        "version": 1,
+        "files": {"path/in/media": {"size": 1, "mtime_ns": 1, "sha256": "..."}},
+        "blobs": {"<sha256>": {"pack": "mediapack_...", "offset": 0, "size": 1}},
+        "packs": {"mediapack_...": {"id": "<drive id>", "encrypted": false}}
+    }
+"""
+import io
+import os
+import gzip
+import json
+import hashlib
+import datetime
+from concurrent.futures import ThreadPoolExecutor
+
+
+BACKUP_FOLDER = os.environ.get('GCAPI_BACKUP_FOLDER')
+FOLDER_ID = os.environ.get('GCAPI_FOLDER_ID', None)
+MANIFEST_PATH = os.environ.get('GCAPI_MEDIA_MANIFEST',
+                               os.path.join(BACKUP_FOLDER or '.', '.gcapi-media-manifest.json'))
+PACK_SIZE = int(os.environ.get('GCAPI_PACK_SIZE', 64 * 1024 * 1024))
+PACK_PREFIX = 'mediapack_'
+MANIFEST_SUFFIX = '.manifest.json.gz'
+READ_SIZE = 1024 * 1024
+# number of files or packs which are downloaded at the same time on restore
+MAX_WORKERS = int(os.environ.get('GCAPI_MAX_WORKERS', 4))
+
+
+def file_sha256(path: str) -> str:
+    """sha256 of file content"""
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(READ_SIZE), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+class MediaManifest:
+    def __init__(self, files: dict=None, blobs: dict=None, packs: dict=None) -> None:
+        self.files = files or {}
+        self.blobs = blobs or {}
+        self.packs = packs or {}
+
+    def to_dict(self) -> dict:
+        return {
+            'version': 1,
+            'files': self.files,
+            'blobs': self.blobs,
+            'packs': self.packs,
+        }
+
+    @classmethod
+    def from_dict(cls, data: dict) -> 'MediaManifest':
+        return cls(files=data.get('files'),
+                   blobs=data.get('blobs'),
+                   packs=data.get('packs'))
+
+    @classmethod
+    def load(cls, path: str=MANIFEST_PATH) -> 'MediaManifest':
+        """Read local manifest, empty manifest if there is not any"""
+        if not os.path.exists(path):
+            return cls()
+        with open(path, 'r') as f:
+            return cls.from_dict(json.load(f))
+
+    def save(self, path: str=MANIFEST_PATH) -> None:
+        """Write local manifest atomically"""
+        temp = f"{path}.tmp"
+        with open(temp, 'w') as f:
+            json.dump(self.to_dict(), f)
+        os.replace(temp, path)
+
+    def dumps(self) -> bytes:
+        """Gzipped manifest which is uploaded with every backup"""
+        return gzip.compress(json.dumps(self.to_dict()).encode())
+
+    @classmethod
+    def loads(cls, data: bytes) -> 'MediaManifest':
+        return cls.from_dict(json.loads(gzip.decompress(data)))
+
+    def scan(self, root: str) -> 'MediaManifest':
+        """
+        Manifest of current files under root
+
+        Files with the same size and mtime as in this manifest are
+        not read again, their old hash is used.
+
+        Return:
+            new manifest (blobs and packs are copied from this one)
+        """
+        files = {}
+        for folder, dirs, names in os.walk(root):
+            for name in names:
+                path = os.path.join(folder, name)
+                stat = os.stat(path)
+                relpath = os.path.relpath(path, root)
+                old = self.files.get(relpath)
+                if old and old['size'] == stat.st_size and old['mtime_ns'] == stat.st_mtime_ns:
+                    files[relpath] = old
+                    continue
+                files[relpath] = {
+                    'size': stat.st_size,
+                    'mtime_ns': stat.st_mtime_ns,
+                    'sha256': file_sha256(path),
+                }
+        return MediaManifest(files=files, blobs=dict(self.blobs), packs=dict(self.packs))
+
+    def missing_blobs(self) -> dict:
+        """
+        Contents which are not in any pack yet
+
+        Return:
+            dict : sha256 -> relative path of one file with that content
+        """
+        missing = {}
+        for relpath, file in self.files.items():
+            if file['sha256'] not in self.blobs:
+                missing.setdefault(file['sha256'], relpath)
+        return missing
+
+    def plan_packs(self, pack_size: int=PACK_SIZE) -> list:
+        """
+        Group missing contents into packs of about pack_size bytes
+
+        Return:
+            list of packs, every pack is a list of (sha256, relpath, size)
+        """
+        packs, current, current_size = [], [], 0
+        for sha, relpath in sorted(self.missing_blobs().items(), key=lambda item: item[1]):
+            size = self.files[relpath]['size']
+            if current and current_size + size > pack_size:
+                packs.append(current)
+                current, current_size = [], 0
+            current.append((sha, relpath, size))
+            current_size += size
+        if current:
+            packs.append(current)
+        return packs
+
+
+class PackReader:
+    """
+    Readable stream of a pack: member files one after another,
+    nothing is copied to disk
+
+    Members are hashed while they are read, a file which changed since
+    it was scanned raises ValueError instead of a pack with a wrong blob.
+    """
+    def __init__(self, root: str, members: list) -> None:
+        self._root = root
+        self._members = iter(members)
+        self._file = None
+        self._left = 0
+        self._sha = None
+        self._expected = None
+
+    def __finish_file(self) -> None:
+        """Close current member, it must end at its scanned size with its scanned hash"""
+        grown = self._file.read(1)
+        self._file.close()
+        if grown or self._sha.hexdigest() != self._expected:
+            raise ValueError(f"{self._file.name} changed while it was backed up")
+        self._file = None
+
+    def __next_file(self) -> bool:
+        if self._file:
+            self.__finish_file()
+        member = next(self._members, None)
+        if member is None:
+            return False
+        self._expected, relpath, size = member
+        self._file = open(os.path.join(self._root, relpath), 'rb')
+        self._sha = hashlib.sha256()
+        self._left = size
+        return True
+
+    def read(self, size: int=-1) -> bytes:
+        size = size if size >= 0 else float('inf')
+        chunks = []
+        read = 0
+        while read < size:
+            if self._left == 0 and not self.__next_file():
+                break
+            data = self._file.read(int(min(size - read, self._left, READ_SIZE)))
+            if not data:
+                raise ValueError(f"{self._file.name} changed while it was backed up")
+            self._sha.update(data)
+            self._left -= len(data)
+            read += len(data)
+            chunks.append(data)
+        return b''.join(chunks)
+
+
+def pack_name(members: list) -> str:
+    """Content address of a pack: hash of its member hashes"""
+    sha = hashlib.sha256("".join(member[0] for member in members).encode())
+    return f"{PACK_PREFIX}{sha.hexdigest()}"
+
+
+def _upload(drive, stream, name: str, cryption=None) -> dict:
+    """Upload a stream, encrypted on the fly if cryption is given"""
+    if cryption is None:
+        return drive.upload_stream(stream=stream, name=name)
+
+    encrypted = cryption.encrypt_reader(stream)
+    response = drive.upload_stream(stream=encrypted, name=f"{name}.gpg")
+    try:
+        encrypted.close()
+    except Exception:
+        drive.delete(file_id=response.get('id'))
+        raise
+    return response
+
+
+def backup_media(drive,
+                 root: str,
+                 cryption=None,
+                 manifest_path: str=MANIFEST_PATH,
+                 pack_size: int=PACK_SIZE
+    ) -> dict:
+    """
+    Incremental backup of a media folder
+
+    Params:
+        drive:          GCDrive     -> drive client
+        root:           str         -> media folder
+        cryption:       Cryption    -> encrypt packs and manifest if given
+        manifest_path:  str         -> local manifest path
+        pack_size:      int         -> target pack size in bytes
+
+    Return:
+        dict : manifest -> uploaded manifest file, packs -> number of new packs,
+               bytes -> number of new bytes
+    """
+    old = MediaManifest.load(manifest_path)
+    manifest = old.scan(root)
+    uploaded_bytes = 0
+    packs = manifest.plan_packs(pack_size=pack_size)
+
+    for members in packs:
+        name = pack_name(members)
+        response = _upload(drive, PackReader(root, members), name=name, cryption=cryption)
+        manifest.packs[name] = {'id': response.get('id'),
+                                'encrypted': cryption is not None}
+        offset = 0
+        for sha, relpath, size in members:
+            manifest.blobs[sha] = {'pack': name, 'offset': offset, 'size': size}
+            offset += size
+        uploaded_bytes += offset
+        # keep progress, a rerun does not upload finished packs again
+        manifest.save(manifest_path)
+
+    timestamp = datetime.datetime.now().strftime("%Y-%m-%d_%H-%M-%S-%f")
+    response = _upload(drive, io.BytesIO(manifest.dumps()),
+                       name=f"media_{timestamp}{MANIFEST_SUFFIX}",
+                       cryption=cryption)
+    manifest.save(manifest_path)
+    return {'manifest': response, 'packs': len(packs), 'bytes': uploaded_bytes}
+
+
+def _query(name: str) -> str:
+    """
+    Query of backup objects: name prefix, not trashed,
+    in GCAPI_FOLDER_ID folder if it is set (same as GCDrive)
+    """
+    query = f"name contains '{name}' and trashed = false"
+    if FOLDER_ID:
+        query += f" and '{FOLDER_ID}' in parents"
+    return query
+
+
+def latest_manifest(drive) -> dict:
+    """
+    Newest media manifest file on Google Drive
+
+    Return:
+        file -> None | dictionary
+    """
+    files = drive.iter_files(query=_query('media_'),
+                             fields="id, name, createdTime",
+                             page_size=100,
+                             order_by="createdTime desc")
+    for file in files:
+        if MANIFEST_SUFFIX in file.get('name', ''):
+            return file
+    return None
+
+
+def _download(drive, file_id: str, encrypted: bool, cryption=None) -> bytes:
+    """Download a whole object into memory, decrypted on the fly if it is encrypted"""
+    output = io.BytesIO()
+    if not encrypted:
+        drive.download_stream(file_id=file_id, stream=output)
+        return output.getvalue()
+    if cryption is None:
+        raise ValueError("Object is encrypted, cryption is required to restore it")
+
+    with cryption.decrypt_writer(output) as writer:
+        drive.download_stream(file_id=file_id, stream=writer)
+    return output.getvalue()
+
+
+
+def unreferenced_packs(drive, manifests: list, cryption=None) -> list:
+    """
+    Packs on Google Drive which none of the manifests refers to
+
+    Packs which are newer than the newest manifest are not returned,
+    they may belong to a backup which did not upload its manifest yet.
+
+    Params:
+        drive:      GCDrive     -> drive client
+        manifests:  list[dict]  -> manifest files (id, name, createdTime) which are kept
+        cryption:   Cryption    -> decrypt encrypted manifests
+
+    Return:
+        list of pack files
+    """
+    if not manifests:
+        return []
+    referenced = set()
+    for file in manifests:
+        manifest = MediaManifest.loads(_download(drive, file['id'],
+                                                 encrypted=file['name'].endswith('.gpg'),
+                                                 cryption=cryption))
+        referenced.update(pack['id'] for pack in manifest.packs.values())
+    newest = max(file['createdTime'] for file in manifests)
+    packs = drive.iter_files(query=_query(PACK_PREFIX), fields="id, name, createdTime")
+    return [file for file in packs
+            if file['name'].startswith(PACK_PREFIX) and file['id'] not in referenced
+            and file['createdTime'] < newest]
+
+
+def changed_files(manifest: MediaManifest, root: str) -> list:
+    """
+    Files of manifest which are missing or different under root
+
+    Size and mtime are compared first, content is hashed only
+    if the size is the same but mtime is different.
+
+    Return:
+        list of relative paths
+    """
+    changed = []
+    for relpath, file in manifest.files.items():
+        path = os.path.join(root, relpath)
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            changed.append(relpath)
+            continue
+        if stat.st_size != file['size']:
+            changed.append(relpath)
+        elif stat.st_mtime_ns != file['mtime_ns'] and file_sha256(path) != file['sha256']:
+            changed.append(relpath)
+    return changed
+
+
+def _write_atomic(root: str, relpath: str, content: bytes, file: dict) -> None:
+    """Write file to temporary path and rename it over the old one"""
+    if hashlib.sha256(content).hexdigest() != file['sha256']:
+        raise ValueError(f"Checksum mismatch for {relpath}")
+    path = os.path.join(root, relpath)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temp = os.path.join(os.path.dirname(path), f".{os.path.basename(path)}.gcapi-tmp")
+    with open(temp, 'wb') as f:
+        f.write(content)
+    os.utime(temp, ns=(file['mtime_ns'], file['mtime_ns']))
+    os.replace(temp, path)
+
+
+def restore_media(drive,
+                  root: str,
+                  cryption=None,
+                  max_workers: int=MAX_WORKERS
+    ) -> dict:
+    """
+    Incremental restore of a media folder from the newest manifest
+
+    Params:
+        drive:          GCDrive     -> drive client
+        root:           str         -> media folder
+        cryption:       Cryption    -> decrypt encrypted manifest and packs
+        max_workers:    int         -> number of parallel downloads
+
+    Return:
+        dict : files -> number of restored files, bytes -> number of restored bytes
+    """
+    remote = latest_manifest(drive)
+    if remote is None:
+        raise ValueError("There is not any media manifest on Google Drive")
+    manifest = MediaManifest.loads(_download(drive, remote['id'],
+                                             encrypted=remote['name'].endswith('.gpg'),
+                                             cryption=cryption))
+
+    # group changed files by the pack of their content
+    by_pack = {}
+    for relpath in changed_files(manifest, root):
+        blob = manifest.blobs[manifest.files[relpath]['sha256']]
+        by_pack.setdefault(blob['pack'], []).append(relpath)
+
+    def restore_pack(pack: str, relpaths: list) -> int:
+        info = manifest.packs[pack]
+        written = 0
+        if info.get('encrypted'):
+            # encrypted pack can not be read partly, fetch and decrypt it once
+            content = _download(drive, info['id'], encrypted=True, cryption=cryption)
+            for relpath in relpaths:
+                file = manifest.files[relpath]
+                blob = manifest.blobs[file['sha256']]
+                _write_atomic(root, relpath, 
+                              content[blob['offset']:blob['offset'] + blob['size']], file)
+                written += blob['size']
+            return written
+        for relpath in relpaths:
+            file = manifest.files[relpath]
+            blob = manifest.blobs[file['sha256']]
+            content = b''
+            if blob['size']:
+                content = drive.download_range(info['id'], blob['offset'],
+                                               blob['offset'] + blob['size'] - 1)
+            _write_atomic(root, relpath, content, file)
+            written += blob['size']
+        return written
+
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        futures = [pool.submit(restore_pack, pack, relpaths)
+                   for pack, relpaths in by_pack.items()]
+        restored_bytes = sum(future.result() for future in futures)
+
+    return {'files': sum(len(relpaths) for relpaths in by_pack.values()),
+            'bytes': restored_bytes}
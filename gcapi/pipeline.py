@@ -0,0 +1,152 @@
+"""
+Subprocess pipelines
+
+Chain shell tools (pg_dump, gzip, gpg, pg_restore ...) together with pipes
+so data flows from one process to the next without touching the disk.
+
+Example:
+    pipe = Pipeline(["pg_dump", uri, "-Fc"], ["gpg", "--encrypt", ...])
+    GCDrive().upload_stream(stream=pipe.stdout, name="backup.dump.gpg")
+    status, errors = pipe.wait()
+"""
+import os
+import subprocess
+
+
+class Pipeline:
+    def __init__(self,
+                 *commands: list,
+                 stdin=None,
+                 stdout=subprocess.PIPE
+        ) -> None:
+        """
+        Start every command and connect stdout of each one to stdin of next one
+
+        Params:
+            commands:   list[str]   -> commands as argument lists, in order
+            stdin:      file | int  -> input of the first command
+            stdout:     file | int  -> output of the last command (PIPE by default)
+        """
+        if not commands:
+            raise ValueError('Pipeline needs at least one command')
+
+        self.commands = commands
+        self.processes = []
+
+        source = stdin
+        for index, command in enumerate(commands):
+            is_last = index == len(commands) - 1
+            process = subprocess.Popen(command,
+                                       stdin=source,
+                                       stdout=stdout if is_last else subprocess.PIPE)
+            # close our copy of the previous pipe, so that the previous process
+            # gets SIGPIPE if this one exits early
+            if self.processes:
+                self.processes[-1].stdout.close()
+            self.processes.append(process)
+            source = process.stdout
+
+    @property
+    def stdin(self):
+        """Writable input of the first process (only if stdin=PIPE)"""
+        return self.processes[0].stdin
+
+    @property
+    def stdout(self):
+        """Readable output of the last process (only if stdout=PIPE)"""
+        return self.processes[-1].stdout
+
+    def wait(self) -> tuple:
+        """
+        Wait all processes and collect their exit codes
+
+        Return:
+            status: bool -> True if every process exited with 0
+            errors: list -> failed commands' names and exit codes
+        """
+        if self.processes[0].stdin:
+            self.processes[0].stdin.close()
+        errors = []
+        for command, process in zip(self.commands, self.processes):
+            code = process.wait()
+            if code != 0:
+                errors.append(f"{command[0]} exited with {code}")
+        return not errors, errors
+
+    def kill(self) -> None:
+        """Stop all processes of the pipeline"""
+        for process in self.processes:
+            if process.poll() is None:
+                process.kill()
+        for process in self.processes:
+            process.wait()
+
+
+def _children(pid: int) -> list:
+    """Process ids whose parent is pid"""
+    children = []
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f'/proc/{entry}/stat', 'r') as f:
+                # comm may contain spaces, parent pid comes after ")"
+                fields = f.read().rsplit(')', 1)[1].split()
+        except OSError:
+            continue
+        if int(fields[1]) == pid:
+            children.append(int(entry))
+    return children
+
+
+def open_files(pid: int):
+    """
+    Paths opened by a process and its child processes (e.g. pg_dump -j workers)
+    
+    Params:
+        pid: int -> process id
+        
+    Return:
+        set of paths, or None if /proc is not available on this platform
+    """
+    if not os.path.isdir('/proc'):
+        return None
+    
+    paths = set()
+    for process_id in [pid, *_children(pid)]:
+        fd_dir = f'/proc/{process_id}/fd'
+        try:
+            fds = os.listdir(fd_dir)
+        except OSError:
+            continue
+        for fd in fds:
+            try:
+                paths.add(os.path.realpath(os.readlink(os.path.join(fd_dir, fd))))
+            except OSError:
+                continue
+    return paths
+
+
+def closed_files(folder: str, pid: int, exclude: tuple=()):
+    """
+    Files of folder which are not opened by a process and its child processes,
+    e.g. table files which pg_dump -j workers finished writing
+
+    Params:
+        folder:     str     -> folder written by the process
+        pid:        int     -> process id
+        exclude:    tuple   -> names which are never returned
+
+    Return:
+        sorted names, or None if open files can not be read on this platform
+    """
+    # /proc links are absolute and resolved, folder may be relative or a symlink
+    folder = os.path.realpath(folder)
+    # list before the open files are read: a file which is created after the
+    # snapshot is not in it, so it must not be in the listing either
+    names = os.listdir(folder)
+    busy = open_files(pid)
+    if busy is None:
+        return None
+    return sorted(name for name in names
+                  if name not in exclude and os.path.join(folder, name) not in busy)
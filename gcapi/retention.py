@@ -0,0 +1,93 @@
+"""
+Retention policy of backups
+
+Grandfather-father-son pruning: keep the newest backup of each of the last
+N hours, days, weeks and months. Age of a backup is read from the timestamp
+which pybackup and pymedia_backup write into the file name:
+
+    default_<db>_2024-05-01_03-00-00-000000.dump.gpg
+    media_2024-05-01_03-00-00-000000.tar.gz
+
+Files without such timestamp are never deleted.
+"""
+import re
+import datetime
+
+TIMESTAMP_FORMAT = "%Y-%m-%d_%H-%M-%S-%f"
+TIMESTAMP_PATTERN = re.compile(r"_(\d{4}-\d{2}-\d{2}_\d{2}-\d{2}-\d{2}-\d{6})")
+
+
+def backup_time(file_name: str):
+    """
+    Timestamp in backup file name
+
+    Return:
+        datetime or None
+    """
+    match = TIMESTAMP_PATTERN.search(file_name)
+    if not match:
+        return None
+    return datetime.datetime.strptime(match.group(1), TIMESTAMP_FORMAT)
+
+
+class RetentionPolicy:
+    # period key of a backup time for every level
+    PERIODS = {
+        'hourly': lambda time: (time.year, time.month, time.day, time.hour),
+        'daily': lambda time: (time.year, time.month, time.day),
+        'weekly': lambda time: time.isocalendar()[:2],
+        'monthly': lambda time: (time.year, time.month),
+    }
+
+    def __init__(self,
+                 hourly: int=24,
+                 daily: int=7,
+                 weekly: int=4,
+                 monthly: int=12
+        ) -> None:
+        """
+        Params:
+            hourly:     int -> keep newest backup of last N hours
+            daily:      int -> keep newest backup of last N days
+            weekly:     int -> keep newest backup of last N weeks
+            monthly:    int -> keep newest backup of last N months
+        """
+        self.keep = {
+            'hourly': hourly,
+            'daily': daily,
+            'weekly': weekly,
+            'monthly': monthly,
+        }
+
+    def split(self, files: list) -> tuple:
+        """
+        Split files to kept and expired ones
+
+        Params:
+            files: list[dict] -> drive files, at least with "name"
+
+        Return:
+            keep:   list[dict] -> files which are kept, newest first
+            expire: list[dict] -> files which can be deleted, newest first
+        """
+        dated = [(backup_time(file.get('name', '')), file) for file in files]
+        undated = [file for time, file in dated if time is None]
+        dated = sorted([item for item in dated if item[0] is not None],
+                       key=lambda item: item[0], reverse=True)
+
+        kept_ids = set()
+        for level, count in self.keep.items():
+            period_of = self.PERIODS[level]
+            periods = set()
+            for time, file in dated:
+                if len(periods) >= count:
+                    break
+                period = period_of(time)
+                if period not in periods:
+                    # first file of a period is the newest one of it
+                    periods.add(period)
+                    kept_ids.add(file['id'])
+
+        keep = [file for time, file in dated if file['id'] in kept_ids] + undated
+        expire = [file for time, file in dated if file['id'] not in kept_ids]
+        return keep, expire
@@ -0,0 +1,165 @@
+"""
+Retries with backoff and operation deadlines
+
+Every Drive request of GCDrive goes through retry(). Transient errors
+(connection errors, 408, 429, 5xx and 403 rate limits) are retried with
+exponential backoff and full jitter, a Retry-After header is respected.
+
+Idempotent requests are sent again as a whole. Chunked transfers are retried
+chunk by chunk: a resumable upload asks Drive for the committed offset and a
+download continues from its current chunk, so a blip does not restart them.
+
+A deadline covers all requests and retries of an operation, also the ones of
+its worker threads (see inherit()):
+
+    with deadline(600):
+        drive.upload(file)
+
+GCAPI_DEADLINE gives every GCDrive operation a default deadline in seconds.
+"""
+import os
+import ssl
+import time
+import random
+import functools
+import threading
+import contextlib
+import http.client
+import email.utils
+import httplib2
+from googleapiclient.errors import HttpError
+from gcapi.throttle import is_rate_limited
+
+
+# max retries of one request
+RETRIES = int(os.environ.get('GCAPI_RETRIES', 6))
+# backoff before retry n is random between 0 and min(max, base * 2 ** n) seconds
+BACKOFF_BASE = float(os.environ.get('GCAPI_BACKOFF_BASE', 1.0))
+BACKOFF_MAX = float(os.environ.get('GCAPI_BACKOFF_MAX', 64.0))
+# default deadline of a GCDrive operation in seconds, 0 is no deadline
+DEADLINE = float(os.environ.get('GCAPI_DEADLINE', 0))
+TRANSIENT_STATUS = (408, 429, 500, 502, 503, 504)
+TRANSIENT_ERRORS = (ConnectionError, TimeoutError, ssl.SSLError,
+                    http.client.HTTPException, httplib2.ServerNotFoundError)
+
+_local = threading.local()
+
+
+class DeadlineExceeded(TimeoutError):
+    """Deadline of an operation passed before it finished"""
+
+
+@contextlib.contextmanager
+def deadline(seconds: float=DEADLINE):
+    """
+    Deadline for every request in the block, an earlier outer deadline wins
+
+    Params:
+        seconds: float -> seconds from now, 0 or None does not add a deadline
+    """
+    previous = getattr(_local, 'until', None)
+    until = previous
+    if seconds:
+        until = time.monotonic() + seconds
+        if previous is not None:
+            until = min(until, previous)
+    _local.until = until
+    try:
+        yield
+    finally:
+        _local.until = previous
+
+
+def remaining() -> float:
+    """Seconds until the deadline of this thread, None if there is no deadline"""
+    until = getattr(_local, 'until', None)
+    return None if until is None else until - time.monotonic()
+
+
+def inherit(func):
+    """Run func (e.g. in a worker thread) under the deadline of the calling thread"""
+    until = getattr(_local, 'until', None)
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        previous = getattr(_local, 'until', None)
+        _local.until = until
+        try:
+            return func(*args, **kwargs)
+        finally:
+            _local.until = previous
+    return wrapper
+
+
+def operation(method):
+    """Run a GCDrive method under the default deadline GCAPI_DEADLINE"""
+    @functools.wraps(method)
+    def wrapper(*args, **kwargs):
+        with deadline(DEADLINE):
+            return method(*args, **kwargs)
+    return wrapper
+
+
+def is_transient(error: Exception) -> bool:
+    """Error which may not happen again when the request is sent again"""
+    if isinstance(error, DeadlineExceeded):
+        return False
+    if isinstance(error, HttpError):
+        return int(error.resp.status) in TRANSIENT_STATUS or is_rate_limited(error)
+    return isinstance(error, TRANSIENT_ERRORS)
+
+
+def retry_after(error: Exception) -> float:
+    """Seconds in Retry-After header of an error response (0 if there is none)"""
+    value = getattr(getattr(error, 'resp', None), 'get', lambda key: None)('retry-after')
+    if not value:
+        return 0.0
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        date = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return 0.0
+    return max(0.0, date.timestamp() - time.time())
+
+
+def backoff(attempt: int, base: float=BACKOFF_BASE, cap: float=BACKOFF_MAX) -> float:
+    """Full jitter: random delay between 0 and the exponential backoff"""
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+def sleep(delay: float, error: Exception=None) -> None:
+    """Sleep before a retry, raise DeadlineExceeded if the deadline is sooner"""
+    left = remaining()
+    if left is not None and delay >= left:
+        raise DeadlineExceeded(f"Deadline passes in {max(left, 0):.1f}s, "
+                               f"retry needs {delay:.1f}s") from error
+    time.sleep(delay)
+
+
+def retry(func, *args, retries: int=RETRIES, on_retry=None, **kwargs):
+    """
+    Call func, retry it on transient errors
+
+    Params:
+        func:       callable -> request, e.g. request.execute
+        retries:    int      -> max retries
+        on_retry:   callable -> called before every retry, e.g. to resume a transfer
+
+    Return:
+        result of func
+    """
+    for attempt in range(retries + 1):
+        left = remaining()
+        if left is not None and left <= 0:
+            raise DeadlineExceeded("Deadline passed")
+        try:
+            return func(*args, **kwargs)
+        except Exception as error:
+            if attempt == retries or not is_transient(error):
+                raise
+            sleep(max(backoff(attempt), retry_after(error)), error)
+            if on_retry:
+                on_retry()
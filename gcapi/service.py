@@ -0,0 +1,123 @@
+"""
+Process-wide pool of Drive services
+
+Building a Drive service used to read the service account json, parse the
+discovery document and open a new connection for every GCDrive(). Now:
+    - credentials are loaded once per credentials file and shared, token
+      refresh is done once under a lock for all threads
+    - the bundled (static) discovery document is parsed once, so building
+      a service never fetches or parses it again
+    - every thread gets its own service and keep-alive http connection
+      (httplib2 is not thread-safe), which is reused by every GCDrive of
+      that thread
+    - connections are shaped by the bandwidth limits of gcapi.throttle
+
+Usage:
+    pool = get_pool()           # shared pool of GCAPI_CREDENTIALS_PATH
+    service = pool.service()    # service of the current thread
+"""
+import os
+import json
+import threading
+import google_auth_httplib2
+from googleapiclient.discovery import build_from_document
+from googleapiclient.discovery_cache import get_static_doc
+from google.oauth2.service_account import Credentials
+from gcapi.throttle import ThrottledHttp
+
+
+CREDENTIALS_PATH = os.environ.get('GCAPI_CREDENTIALS_PATH')
+SCOPES = ['https://www.googleapis.com/auth/drive']
+# socket timeout of pooled connections in seconds
+HTTP_TIMEOUT = int(os.environ.get('GCAPI_HTTP_TIMEOUT', 60))
+
+_lock = threading.Lock()
+_pools = {}
+_discovery = None
+
+
+def discovery_document() -> dict:
+    """Parsed static discovery document of Drive v3, loaded once"""
+    global _discovery
+    if _discovery is None:
+        with _lock:
+            if _discovery is None:
+                _discovery = json.loads(get_static_doc('drive', 'v3'))
+    return _discovery
+
+
+class ServicePool:
+    def __init__(self, cred_path: str=CREDENTIALS_PATH, credentials=None,
+                 root_url: str=None) -> None:
+        """
+        Params:
+            cred_path:      str         -> service account json, read on first use
+            credentials:    Credentials -> ready credentials instead of cred_path
+            root_url:       str         -> Google APIs root url, e.g. of gcapi.fakedrive
+        """
+        self.cred_path = cred_path
+        self.root_url = root_url
+        self.__credentials = credentials
+        self.__lock = threading.Lock()
+        self.__local = threading.local()
+
+    def credentials(self):
+        """Shared credentials, loaded on first call"""
+        if self.__credentials is None:
+            with self.__lock:
+                if self.__credentials is None:
+                    credentials = Credentials.from_service_account_file(self.cred_path)
+                    if credentials.requires_scopes:
+                        credentials = credentials.with_scopes(SCOPES)
+                    self.__credentials = credentials
+        return self.__credentials
+
+    def refresh(self, http) -> None:
+        """Refresh token once for all threads when it is expired"""
+        credentials = self.credentials()
+        if credentials.valid:
+            return
+        with self.__lock:
+            # another thread may have refreshed it meanwhile
+            if not credentials.valid:
+                credentials.refresh(google_auth_httplib2.Request(http))
+
+    def http(self):
+        """Authorized keep-alive http connection of the current thread"""
+        http = getattr(self.__local, 'http', None)
+        if http is None:
+            http = google_auth_httplib2.AuthorizedHttp(
+                self.credentials(), http=ThrottledHttp(timeout=HTTP_TIMEOUT))
+            self.__local.http = http
+        return http
+
+    def service(self, rebuild: bool=False):
+        """
+        Drive service of the current thread
+
+        Params:
+            rebuild: bool -> build a new service and connection for this thread
+        """
+        if rebuild:
+            self.__local.http = None
+            self.__local.service = None
+        service = getattr(self.__local, 'service', None)
+        if service is None:
+            http = self.http()
+            document = discovery_document()
+            if self.root_url:
+                document = dict(document, rootUrl=self.root_url,
+                                baseUrl=self.root_url + document['servicePath'])
+            service = build_from_document(document, http=http)
+            self.__local.service = service
+        self.refresh(self.__local.http.http)
+        return service
+
+
+def get_pool(cred_path: str=CREDENTIALS_PATH) -> ServicePool:
+    """Shared pool of a credentials file, created on first call"""
+    pool = _pools.get(cred_path)
+    if pool is None:
+        with _lock:
+            pool = _pools.setdefault(cred_path, ServicePool(cred_path))
+    return pool
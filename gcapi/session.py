@@ -0,0 +1,156 @@
+"""
+Resumable upload sessions
+
+Google Drive keeps a resumable upload session for a week. If the process
+dies in the middle of an upload, the session URI and the committed byte
+offset are enough to continue from where it stopped. UploadSession keeps them
+in a small json state file in GCAPI_BACKUP_FOLDER, so a rerun of the same
+upload can find them.
+
+State file:
+    {
+        "file": "/abs/path/of/source",
+        "name": "name on drive",
+        "folder_id": "parent folder id",
+        "uri": "resumable session uri",
+        "offset": 1048576,
+        "checksum": "sampled md5 of the source"
+    }
+"""
+import os
+import json
+import glob
+import hashlib
+
+
+BACKUP_FOLDER = os.environ.get('GCAPI_BACKUP_FOLDER')
+STATE_PREFIX = '.gcapi-upload-'
+# checksum reads this many bytes from beginning and end of the file
+SAMPLE_SIZE = 1024 * 1024
+
+
+def file_checksum(file: str) -> str:
+    """
+    Sampled md5 of a file: size, mtime, first and last MiB
+
+    Reading a multi-GB dump completely just to recognize it again would cost
+    another disk pass, and dumps are never modified in place after creation.
+
+    Params:
+        file: str -> file path
+
+    Return:
+        hex digest
+    """
+    stat = os.stat(file)
+    md5 = hashlib.md5(f"{stat.st_size}:{stat.st_mtime_ns}".encode())
+    with open(file, 'rb') as f:
+        md5.update(f.read(SAMPLE_SIZE))
+        if stat.st_size > SAMPLE_SIZE:
+            f.seek(max(SAMPLE_SIZE, stat.st_size - SAMPLE_SIZE))
+            md5.update(f.read(SAMPLE_SIZE))
+    return md5.hexdigest()
+
+
+class UploadSession:
+    def __init__(self, file: str, state_folder: str=BACKUP_FOLDER) -> None:
+        """
+        Params:
+            file:           str -> source file of the upload
+            state_folder:   str -> folder of state files (GCAPI_BACKUP_FOLDER)
+        """
+        self.file = os.path.abspath(file)
+        self.state_folder = state_folder
+        self.uri = None
+        self.offset = 0
+        self.name = None
+        self.folder_id = None
+        self.checksum = None
+
+    @property
+    def state_path(self) -> str:
+        key = hashlib.md5(self.file.encode()).hexdigest()[:16]
+        return os.path.join(self.state_folder, f"{STATE_PREFIX}{key}.json")
+
+    def load(self) -> bool:
+        """
+        Read state file of the source file
+
+        Return:
+            True if there is a session for the same (unchanged) file
+        """
+        if not self.state_folder or not os.path.exists(self.state_path):
+            return False
+        try:
+            with open(self.state_path, 'r') as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            return False
+
+        self.checksum = file_checksum(self.file)
+        if state.get('file') != self.file or state.get('checksum') != self.checksum:
+            # file was changed since the session was started
+            self.remove()
+            return False
+
+        self.uri = state.get('uri')
+        self.offset = state.get('offset', 0)
+        self.name = state.get('name')
+        self.folder_id = state.get('folder_id')
+        return self.uri is not None
+
+    def save(self, uri: str, offset: int, name: str=None, folder_id: str=None) -> None:
+        """
+        Write session uri and committed offset to state file atomically
+        """
+        if not self.state_folder:
+            return
+        if self.checksum is None:
+            self.checksum = file_checksum(self.file)
+        self.uri = uri
+        self.offset = offset
+        self.name = name or self.name
+        self.folder_id = folder_id or self.folder_id
+
+        temp = f"{self.state_path}.tmp"
+        with open(temp, 'w') as f:
+            json.dump({
+                'file': self.file,
+                'name': self.name,
+                'folder_id': self.folder_id,
+                'uri': self.uri,
+                'offset': self.offset,
+                'checksum': self.checksum
+            }, f)
+        os.replace(temp, self.state_path)
+
+    def remove(self) -> None:
+        """Remove state file after upload finished or session expired"""
+        if self.state_folder and os.path.exists(self.state_path):
+            os.remove(self.state_path)
+
+    @classmethod
+    def pending(cls, state_folder: str=BACKUP_FOLDER) -> list:
+        """
+        Unfinished upload sessions whose source file still exists
+
+        Return:
+            list of UploadSession
+        """
+        if not state_folder:
+            return []
+        sessions = []
+        for path in glob.glob(os.path.join(state_folder, f"{STATE_PREFIX}*.json")):
+            try:
+                with open(path, 'r') as f:
+                    file = json.load(f).get('file')
+            except (OSError, ValueError):
+                continue
+            if not file or not os.path.exists(file):
+                # source file is gone, session can not be resumed
+                os.remove(path)
+                continue
+            session = cls(file, state_folder=state_folder)
+            if session.load():
+                sessions.append(session)
+        return sessions
@@ -1,22 +1,1424 @@
+import functools
+import gzip
+import hashlib
+import importlib.util
+import io
+import json
+import os
+import shutil
+import tarfile
+import tempfile
+import threading
 import unittest
-from gcapi.drive import GCDrive
+from unittest import mock
+from gcapi.drive import GCDrive, MediaPipeUpload, HashingFileUpload
+from gcapi.checksum import Checksums, ChecksumError
+from gcapi.session import UploadSession
+from gcapi.index import DriveIndex
+from gcapi.retention import RetentionPolicy
+from gcapi.compress import compress_stream, uncompress_stream, compress_file, uncompress_file, zstandard
+from gcapi.manifest import MediaManifest, PackReader, backup_media, restore_media, latest_manifest
+from gcapi.archive import write_tar, extract_tar
+from gcapi.cryption import Cryption, ProcessWriter, ProcessReader, AEADWriter, AEADReader, EnvelopeFile, seal_file, open_file
+from gcapi.aiodrive import AsyncGCDrive, aiohttp
+from gcapi.service import ServicePool
+from gcapi.throttle import BandwidthProfile, TokenBucket, AdaptiveConcurrency, AsyncAdaptiveConcurrency, parse_rate
+from gcapi.retry import retry, deadline, DeadlineExceeded, RETRIES
+from gcapi.fakedrive import FakeDrive
+from gcapi.pipeline import open_files, closed_files
 
 class TestGoogleDriveAPI(unittest.TestCase):
     
+    def setUp(self):
+        self.fake = FakeDrive().start()
+        self.addCleanup(self.fake.stop)
+        self.drive = GCDrive(pool=self.fake.pool())
+        self.folder = tempfile.TemporaryDirectory()
+        self.addCleanup(self.folder.cleanup)
+        backup_folder = mock.patch('gcapi.drive.BACKUP_FOLDER', self.folder.name)
+        backup_folder.start()
+        self.addCleanup(backup_folder.stop)
+    
     def test_list(self):
-        ...
+        names = ['default_db_1.dump', 'default_db_2.dump']
+        for name in names:
+            self.fake.add_file(name, b'', parents=['F'])
+        self.fake.add_file('other.dump', b'', parents=['G'])
+        self.assertEqual(sorted(file['name'] for file in self.drive.list(folder_id='F')), names)
     
     def test_get(self):
-       ...
+        file = self.fake.add_file('default_db.dump', b'dump', parents=['F'])
+        self.assertEqual(self.drive.get(file['id'])['name'], 'default_db.dump')
         
     def test_delete(self):
-        ...
+        file = self.fake.add_file('default_db.dump', b'dump', parents=['F'])
+        self.assertTrue(self.drive.delete(file['id']))
+        self.assertNotIn(file['id'], self.fake.files)
         
     def test_download(self):
-        ...
+        content = os.urandom(1000)
+        file = self.fake.add_file('default_db.dump', content, parents=['F'])
+        status, path = self.drive.download(file['id'], file_name='downloaded.dump')
+        self.assertTrue(status)
+        self.assertEqual(path, os.path.join(self.folder.name, 'downloaded.dump'))
+        with open(path, 'rb') as f:
+            self.assertEqual(f.read(), content)
         
     def test_upload(self):
-        ...
+        content = os.urandom(1000)
+        path = os.path.join(self.folder.name, 'default_db.dump')
+        with open(path, 'wb') as f:
+            f.write(content)
+        response = self.drive.upload(path, folder_id='F')
+        self.assertEqual(response['name'], 'default_db.dump')
+        self.assertEqual(self.fake.files[response['id']]['parents'], ['F'])
+        self.assertEqual(self.fake.contents[response['id']], content)
+    
+    def test_upload_checksum_mismatch(self):
+        path = os.path.join(self.folder.name, 'default_db.dump')
+        with open(path, 'wb') as f:
+            f.write(os.urandom(1000))
+        create = FakeDrive._FakeDrive__create
+        
+        def corrupt(fake, metadata, content):
+            # drive stored other bytes than the ones which were sent
+            file = create(fake, metadata, content)
+            file['md5Checksum'] = '0' * 32
+            return file
+        
+        with mock.patch.object(FakeDrive, '_FakeDrive__create', corrupt), \
+             self.assertRaises(ChecksumError):
+            self.drive.upload(path, folder_id='F')
+        # the corrupt copy is not kept as a backup
+        self.assertEqual(self.fake.files, {})
+    
+    def test_download_checksum_mismatch(self):
+        file = self.fake.add_file('default_db.dump', os.urandom(1000), parents=['F'])
+        file['md5Checksum'] = '0' * 32
+        with self.assertRaises(ChecksumError):
+            self.drive.download(file['id'], file_name='downloaded.dump')
+        self.assertFalse(os.path.exists(os.path.join(self.folder.name, 'downloaded.dump')))
+        
+
+def _drive(service=None, http=None) -> GCDrive:
+    """GCDrive without credentials whose requests go to service, or to http"""
+    if service is None:
+        from googleapiclient.discovery import build
+        service = build('drive', 'v3', http=http)
+    with mock.patch.object(GCDrive, 'execute_credentials'):
+        drive = GCDrive()
+    drive.get_service = lambda: service
+    return drive
+
+
+class _Http:
+    """
+    httplib2.Http stand-in which serves ranged downloads of one file and
+    resumable uploads, thread-safe and recording every request
+    """
+    def __init__(self, content: bytes=b'') -> None:
+        self.content = content
+        self.requests = []
+        self.uploads = {}   # session uri -> metadata and received content
+        self.files = {}     # id -> metadata and content of finished uploads
+        self._lock = threading.Lock()
+    
+    def request(self, uri, method='GET', body=None, headers=None, **kwargs):
+        with self._lock:
+            self.requests.append((method, uri))
+            if method == 'POST':
+                return self.__start_upload(body)
+            if method == 'PUT':
+                return self.__upload_chunk(uri, body, headers)
+            if 'range' not in headers:
+                return self.__metadata()
+            return self.__media(headers)
+    
+    def __metadata(self) -> tuple:
+        import httplib2
+        file = {'id': 'file', 'md5Checksum': hashlib.md5(self.content).hexdigest()}
+        return httplib2.Response({'status': 200}), json.dumps(file).encode()
+    
+    def __media(self, headers) -> tuple:
+        import httplib2
+        start, end = map(int, headers['range'].split('=')[1].split('-'))
+        end = min(end, len(self.content) - 1)
+        return httplib2.Response({'status': 206,
+                                  'content-range': f'bytes {start}-{end}/{len(self.content)}'}), \
+               self.content[start:end + 1]
+    
+    def __start_upload(self, body) -> tuple:
+        import httplib2
+        uri = f'http://upload/{len(self.uploads)}'
+        self.uploads[uri] = dict(json.loads(body), content=b'')
+        return httplib2.Response({'status': 200, 'location': uri}), b''
+    
+    def __upload_chunk(self, uri, body, headers) -> tuple:
+        import httplib2
+        upload = self.uploads[uri]
+        data = body.read() if hasattr(body, 'read') else body
+        start, total = headers['Content-Range'].split(' ')[1].split('/')
+        upload['content'] = upload['content'][:int(start.split('-')[0])] + data
+        if total == '*' or len(upload['content']) < int(total):
+            return httplib2.Response({'status': 308, 
+                                      'range': f"bytes=0-{len(upload['content']) - 1}"}), b''
+        file = {'id': uri.rsplit('/', 1)[1], 'name': upload['name'],
+                'md5Checksum': hashlib.md5(upload['content']).hexdigest()}
+        self.files[file['id']] = upload
+        return httplib2.Response({'status': 200}), json.dumps(file).encode()
+
+
+class TestDownloadStream(unittest.TestCase):
+    
+    def test_slow_consumer_holds_back_download(self):
+        content = os.urandom(20 * 1024)
+        http = _Http(content)
+        drive = _drive(http=http)
+        release = threading.Event()
+        
+        class SlowStream(io.BytesIO):
+            def write(self, data):
+                release.wait()
+                return super().write(data)
+        
+        stream = SlowStream()
+        sizes = []
+        consumer = threading.Thread(target=lambda: sizes.append(
+            drive.download_stream('file', stream, chunk_size=1024, queue_size=2)))
+        consumer.start()
+        for _ in range(100):
+            if len(http.requests) >= 4:
+                break
+            consumer.join(0.05)
+        consumer.join(0.3)
+        # chunk in write, full queue and the chunk waiting for a free place
+        self.assertEqual(len(http.requests), 4)
+        release.set()
+        consumer.join()
+        self.assertEqual(sizes, [len(content)])
+        self.assertEqual(stream.getvalue(), content)
+        
+
+class TestUploadMany(unittest.TestCase):
+    
+    def test_concurrent_uploads_and_progress(self):
+        http = _Http()
+        drive = _drive(http=http)
+        upload = drive.upload
+        # every upload waits until the other worker uploads too
+        barrier = threading.Barrier(2, timeout=10)
+        
+        def concurrent_upload(**kwargs):
+            barrier.wait()
+            return upload(**kwargs)
+        
+        drive.upload = concurrent_upload
+        progress = mock.Mock()
+        with tempfile.TemporaryDirectory() as folder:
+            files = {}
+            for index in range(4):
+                path = os.path.join(folder, f'media_{index}')
+                files[path] = os.urandom(300 * 1024)
+                with open(path, 'wb') as f:
+                    f.write(files[path])
+            result = drive.upload_many(list(files), folder_id='F', max_workers=2, 
+                                       chunk_size=256 * 1024, progress=progress)
+        for path, content in files.items():
+            uploaded = http.files[result[path]['id']]
+            self.assertEqual((uploaded['name'], uploaded['content']), (os.path.basename(path), content))
+            progress.assert_any_call(path, 256 * 1024, len(content))
+            progress.assert_any_call(path, len(content), len(content))
+        
+
+class TestListing(unittest.TestCase):
+    
+    def test_pages_are_requested_lazily(self):
+        service = mock.MagicMock()
+        names = [f'media_{index:02d}' for index in range(25)]
+        execute = service.files().list().execute
+        execute.side_effect = [
+            {'files': [{'name': name} for name in names[0:10]], 'nextPageToken': '10'},
+            {'files': [{'name': name} for name in names[10:20]], 'nextPageToken': '20'},
+            {'files': [{'name': name} for name in names[20:]]},
+        ]
+        files = _drive(service=service).iter_files(query="'F' in parents", fields='id, name', 
+                                                   page_size=10)
+        self.assertEqual(next(files)['name'], 'media_00')
+        self.assertEqual(execute.call_count, 1)
+        self.assertEqual([file['name'] for file in files], names[1:])
+        self.assertEqual(execute.call_count, 3)
+        calls = [call.kwargs for call in service.files().list.call_args_list if call.kwargs]
+        self.assertEqual([call['pageToken'] for call in calls], [None, '10', '20'])
+        self.assertEqual(calls[0]['fields'], 'nextPageToken, files(id, name)')
+        self.assertEqual(calls[0]['pageSize'], 10)
+    
+    def test_latest_backup_is_sorted_by_drive(self):
+        service = mock.MagicMock()
+        execute = service.files().list().execute
+        execute.return_value = {'files': [{'name': 'default_db_2.dump'}], 'nextPageToken': '1'}
+        with mock.patch('gcapi.drive.FOLDER_ID', 'F'):
+            latest = _drive(service=service).get_latest_backup('db')
+        self.assertEqual(latest['name'], 'default_db_2.dump')
+        # one request of one file, the other pages are not asked
+        self.assertEqual(execute.call_count, 1)
+        call = service.files().list.call_args.kwargs
+        self.assertEqual((call['orderBy'], call['pageSize']), ('createdTime desc', 1))
+        self.assertEqual(call['q'], "name contains 'default_db_' and trashed = false and 'F' in parents")
+        
+
+class _Batch:
+    """BatchHttpRequest stand-in which answers every call with answer(request_id)"""
+    def __init__(self, answer, batches: list, callback) -> None:
+        self.answer = answer
+        self.batches = batches
+        self.callback = callback
+        self.request_ids = []
+    
+    def add(self, request, request_id) -> None:
+        self.request_ids.append(request_id)
+    
+    def execute(self) -> None:
+        self.batches.append(self.request_ids)
+        for request_id in self.request_ids:
+            response = self.answer(request_id)
+            if isinstance(response, Exception):
+                self.callback(request_id, None, response)
+            else:
+                self.callback(request_id, response, None)
+
+
+class TestBatch(unittest.TestCase):
+    
+    def setUp(self):
+        import httplib2
+        from googleapiclient.errors import HttpError
+        self.missing = HttpError(httplib2.Response({'status': 404}), b'')
+        self.batches = []
+        service = mock.MagicMock()
+        service.new_batch_http_request.side_effect = lambda callback: \
+            _Batch(self.answer, self.batches, callback)
+        self.drive = _drive(service=service)
+        self.ids = [f'id_{index}' for index in range(150)]
+        
+    def answer(self, request_id):
+        return self.missing if request_id == 'missing' else {'id': request_id}
+    
+    def test_bulk_delete(self):
+        result = self.drive.bulk_delete(self.ids + ['missing'])
+        self.assertEqual(list(result), self.ids + ['missing'])
+        self.assertTrue(all(result[file_id] is True for file_id in self.ids))
+        # a failed file does not stop the others
+        self.assertIs(result['missing'], self.missing)
+        self.assertEqual([len(batch) for batch in self.batches], [100, 51])
+        
+    def test_bulk_get(self):
+        result = self.drive.bulk_get(self.ids + ['missing'], fields='id, name')
+        self.assertEqual(result['id_120'], {'id': 'id_120'})
+        self.assertIs(result['missing'], self.missing)
+        self.assertEqual(len(self.batches), 2)
+        
+
+class TestMediaPipeUpload(unittest.TestCase):
+    
+    def test_short_last_chunk(self):
+        media = MediaPipeUpload(io.BytesIO(b'a' * 10), chunksize=4)
+        self.assertEqual(media.getbytes(0, 4), b'aaaa')
+        self.assertEqual(media.getbytes(4, 4), b'aaaa')
+        self.assertEqual(media.getbytes(8, 4), b'aa')
+        
+    def test_resend_uncommitted_bytes(self):
+        media = MediaPipeUpload(io.BytesIO(b'0123456789'), chunksize=4)
+        media.getbytes(0, 4)
+        # server committed only 2 bytes of the chunk
+        self.assertEqual(media.getbytes(2, 4), b'2345')
+        with self.assertRaises(ValueError):
+            media.getbytes(0, 4)
+        
+    def test_end_on_chunk_boundary(self):
+        media = MediaPipeUpload(io.BytesIO(b'a' * 8), chunksize=4)
+        media.getbytes(0, 4)
+        self.assertEqual(media.chunksize(), 4)
+        # last full chunk must look like a short read
+        data = media.getbytes(4, 4)
+        self.assertLess(len(data), media.chunksize())
+        
+
+class TestChecksums(unittest.TestCase):
+    
+    def test_pipe_upload_hashes_once(self):
+        import hashlib
+        media = MediaPipeUpload(io.BytesIO(b'0123456789'), chunksize=4)
+        media.getbytes(0, 4)
+        media.getbytes(2, 4)
+        media.getbytes(6, 4)
+        self.assertEqual(media.checksums.md5.hexdigest(), 
+                         hashlib.md5(b'0123456789').hexdigest())
+        
+    def test_file_upload_resend_and_resume(self):
+        import hashlib
+        content = os.urandom(1000)
+        with tempfile.NamedTemporaryFile() as f:
+            f.write(content)
+            f.flush()
+            media = HashingFileUpload(f.name, chunksize=256 * 1024, resumable=True)
+            # interrupted process sent 300 bytes, 100 of the next chunk are resent
+            media.getbytes(300, 400)
+            media.getbytes(600, 400)
+            media.hash_until(media.size())
+        checksums = Checksums()
+        checksums.update(content)
+        checksums.verify({'md5Checksum': hashlib.md5(content).hexdigest()})
+        self.assertEqual(media.checksums.sha256.hexdigest(), 
+                         hashlib.sha256(content).hexdigest())
+        
+    def test_mismatch(self):
+        checksums = Checksums()
+        checksums.update(b'backup')
+        # google docs have no checksums
+        checksums.verify({'id': 'doc'})
+        with self.assertRaises(ChecksumError):
+            checksums.verify({'id': 'file', 'md5Checksum': '0' * 32})
+        
+
+class TestUploadSession(unittest.TestCase):
+    
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.file = os.path.join(self.folder, 'default_db.dump')
+        with open(self.file, 'wb') as f:
+            f.write(b'dump' * 1024)
+    
+    def test_resume_same_file(self):
+        UploadSession(self.file, state_folder=self.folder)\
+            .save(uri='http://upload/1', offset=2048, name='default_db.dump')
+        session = UploadSession(self.file, state_folder=self.folder)
+        self.assertTrue(session.load())
+        self.assertEqual((session.uri, session.offset), ('http://upload/1', 2048))
+        self.assertEqual(len(UploadSession.pending(state_folder=self.folder)), 1)
+        
+    def test_changed_file_is_not_resumed(self):
+        UploadSession(self.file, state_folder=self.folder)\
+            .save(uri='http://upload/1', offset=2048)
+        with open(self.file, 'ab') as f:
+            f.write(b'more')
+        self.assertFalse(UploadSession(self.file, state_folder=self.folder).load())
+        self.assertEqual(UploadSession.pending(state_folder=self.folder), [])
+        
+
+class _Execute:
+    def __init__(self, result):
+        self.result = result
+        
+    def execute(self):
+        return self.result
+
+
+class _FakeChanges:
+    def __init__(self, changes):
+        self.changes = changes
+        
+    def getStartPageToken(self):
+        return _Execute({'startPageToken': '1'})
+    
+    def list(self, pageToken, **kwargs):
+        return _Execute({'changes': self.changes, 'newStartPageToken': '2'})
+
+
+class _FakeDrive:
+    def __init__(self, files, changes=()):
+        self.files = files
+        self.service = type('Service', (), {'changes': lambda _: _FakeChanges(list(changes))})()
+    
+    def iter_files(self, query, fields):
+        return iter(self.files)
+    
+    def get_service(self):
+        return self.service
+
+
+class TestDriveIndex(unittest.TestCase):
+    
+    def setUp(self):
+        self.path = os.path.join(tempfile.mkdtemp(), 'index.sqlite3')
+        
+    def test_latest_by_prefix(self):
+        drive = _FakeDrive(files=[
+            {'id': '1', 'name': 'default_db_2024-01-01.dump', 'createdTime': '2024-01-01T00:00:00Z', 'parents': ['f']},
+            {'id': '2', 'name': 'default_db_2024-02-01.dump', 'createdTime': '2024-02-01T00:00:00Z', 'parents': ['f']},
+            {'id': '3', 'name': 'media_2024-03-01.tar.gz', 'createdTime': '2024-03-01T00:00:00Z', 'parents': ['f']},
+        ])
+        index = DriveIndex(drive, path=self.path, folder_id='f')
+        self.assertEqual(index.get_latest('default_db_')['id'], '2')
+        self.assertEqual(len(index.list('default_db_')), 2)
+        self.assertEqual(index.get_by_name('media_2024-03-01.tar.gz')['parents'], ['f'])
+        
+    def test_changes_are_applied(self):
+        drive = _FakeDrive(files=[
+            {'id': '1', 'name': 'default_db_1.dump', 'createdTime': '1', 'parents': ['f']},
+        ], changes=[
+            {'fileId': '1', 'removed': True},
+            {'fileId': '2', 'file': {'id': '2', 'name': 'default_db_2.dump', 'createdTime': '2', 'parents': ['f']}},
+            {'fileId': '3', 'file': {'id': '3', 'name': 'default_db_3.dump', 'createdTime': '3', 'parents': ['other']}},
+        ])
+        index = DriveIndex(drive, path=self.path, folder_id='f', max_age=0)
+        index.sync()
+        index.sync()
+        self.assertEqual([file['id'] for file in index.list('default_db_')], ['2'])
+        
+    def test_lazy_schema_and_closed_connections(self):
+        import sqlite3
+        index = DriveIndex(_FakeDrive(files=[]), path=self.path)
+        self.assertFalse(os.path.exists(self.path))
+        connections = []
+        original = sqlite3.connect
+        
+        def connect(*args, **kwargs):
+            connections.append(original(*args, **kwargs))
+            return connections[-1]
+        
+        with mock.patch('gcapi.index.sqlite3.connect', connect):
+            self.assertIsNone(index.get_by_name('missing'))
+        self.assertTrue(connections)
+        for conn in connections:
+            with self.assertRaises(sqlite3.ProgrammingError):
+                conn.execute('SELECT 1')
+        
+    def test_duplicate_by_checksum(self):
+        drive = _FakeDrive(files=[
+            {'id': '1', 'name': 'media_1.tar.gz', 'size': '5', 'md5Checksum': 'abc', 'parents': ['f']},
+            {'id': '2', 'name': 'media_2.tar.gz', 'size': '5', 'md5Checksum': 'abc', 'parents': ['other']},
+        ])
+        index = DriveIndex(drive, path=self.path)
+        self.assertEqual(index.get_by_checksum('abc', 5, folder_id='other')['id'], '2')
+        self.assertIsNotNone(index.get_by_checksum('abc', 5))
+        self.assertIsNone(index.get_by_checksum('abc', 6, folder_id='f'))
+    
+    def test_uploads_are_indexed(self):
+        with FakeDrive() as fake, tempfile.TemporaryDirectory() as work, \
+             mock.patch('gcapi.drive.BACKUP_FOLDER', work):
+            drive = GCDrive(pool=fake.pool())
+            # synced once and not again within max_age
+            drive.index = DriveIndex(_FakeDrive(files=[]), path=self.path,
+                                     folder_id='F', max_age=3600)
+            self.assertIsNone(drive.get_by_name('default_db_1.dump'))
+            path = os.path.join(work, 'default_db_1.dump')
+            with open(path, 'wb') as f:
+                f.write(b'dump')
+            uploaded = drive.upload(path, folder_id='F')
+            streamed = drive.upload_stream(io.BytesIO(b'dump'), name='default_db_2.dump', folder_id='F')
+            self.assertEqual(drive.get_by_name('default_db_1.dump')['id'], uploaded['id'])
+            self.assertEqual(drive.index.get_latest('default_db_')['id'], streamed['id'])
+            
+            # shared drives are not in the index, drive is asked
+            shared = fake.add_file('shared.dump', b'dump', parents=['S'])
+            self.assertIsNone(drive.get_by_name('shared.dump'))
+            self.assertEqual(drive.get_by_name('shared.dump', shared_drive=True)['id'], shared['id'])
+        
+
+class TestRetentionPolicy(unittest.TestCase):
+    
+    def backups(self, times):
+        return [{'id': time, 'name': f"default_db_{time}-000000.dump"} for time in times]
+        
+    def test_keep_newest_of_each_period(self):
+        files = self.backups([
+            '2024-05-03_12-00-00', '2024-05-03_06-00-00',
+            '2024-05-02_12-00-00', '2024-05-02_06-00-00',
+            '2024-05-01_12-00-00',
+        ])
+        keep, expire = RetentionPolicy(hourly=0, daily=2, weekly=0, monthly=0).split(files)
+        self.assertEqual([file['id'] for file in keep], ['2024-05-03_12-00-00', '2024-05-02_12-00-00'])
+        self.assertEqual(len(expire), 3)
+        
+    def test_levels_are_combined(self):
+        files = self.backups(['2024-05-03_12-00-00', '2024-04-20_12-00-00', '2024-03-10_12-00-00'])
+        keep, expire = RetentionPolicy(hourly=1, daily=1, weekly=0, monthly=2).split(files)
+        self.assertEqual([file['id'] for file in keep], ['2024-05-03_12-00-00', '2024-04-20_12-00-00'])
+        self.assertEqual([file['id'] for file in expire], ['2024-03-10_12-00-00'])
+        
+    def test_files_without_timestamp_are_kept(self):
+        files = [{'id': '1', 'name': 'default_db_manual.dump'}]
+        keep, expire = RetentionPolicy(0, 0, 0, 0).split(files)
+        self.assertEqual((keep, expire), (files, []))
+        
+
+class _UploadDrive:
+    def __init__(self):
+        self.uploads = {}
+        
+        self.ranges = []
+        
+    def upload_stream(self, stream, name, **kwargs):
+        self.uploads[name] = stream.read()
+        return {'id': name, 'name': name}
+    
+    def iter_files(self, **kwargs):
+        return iter([{'id': name, 'name': name} for name in reversed(list(self.uploads))])
+    
+    def download_stream(self, file_id, stream):
+        stream.write(self.uploads[file_id])
+        
+    def download_range(self, file_id, start, end):
+        self.ranges.append((file_id, start, end))
+        return self.uploads[file_id][start:end + 1]
+
+
+class TestIncrementalMediaBackup(unittest.TestCase):
+    
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.manifest = os.path.join(tempfile.mkdtemp(), 'manifest.json')
+        os.makedirs(os.path.join(self.root, 'images'))
+        for name, content in [('a.txt', b'aaa'), ('images/b.png', b'bbbb'), ('copy.txt', b'aaa')]:
+            with open(os.path.join(self.root, name), 'wb') as f:
+                f.write(content)
+    
+    def test_only_changes_are_uploaded(self):
+        drive = _UploadDrive()
+        result = backup_media(drive, self.root, manifest_path=self.manifest)
+        # same content is packed once
+        self.assertEqual((result['packs'], result['bytes']), (1, 7))
+        
+        with open(os.path.join(self.root, 'c.txt'), 'wb') as f:
+            f.write(b'cc')
+        drive = _UploadDrive()
+        result = backup_media(drive, self.root, manifest_path=self.manifest)
+        self.assertEqual((result['packs'], result['bytes']), (1, 2))
+        
+        name = result['manifest']['name']
+        manifest = MediaManifest.loads(drive.uploads[name])
+        self.assertEqual(len(manifest.files), 4)
+        blob = manifest.blobs[manifest.files['c.txt']['sha256']]
+        pack = drive.uploads[blob['pack']]
+        self.assertEqual(pack[blob['offset']:blob['offset'] + blob['size']], b'cc')
+        
+    def test_restore_only_differences(self):
+        drive = _UploadDrive()
+        backup_media(drive, self.root, manifest_path=self.manifest)
+        os.remove(os.path.join(self.root, 'images/b.png'))
+        with open(os.path.join(self.root, 'a.txt'), 'wb') as f:
+            f.write(b'xyz')
+        
+        result = restore_media(drive, self.root)
+        self.assertEqual(result, {'files': 2, 'bytes': 7})
+        self.assertEqual(len(drive.ranges), 2)
+        for name, content in [('a.txt', b'aaa'), ('images/b.png', b'bbbb'), ('copy.txt', b'aaa')]:
+            with open(os.path.join(self.root, name), 'rb') as f:
+                self.assertEqual(f.read(), content)
+        self.assertEqual(restore_media(drive, self.root), {'files': 0, 'bytes': 0})
+
+    def test_manifest_of_backup_folder(self):
+        with FakeDrive() as fake:
+            fake.add_file('media_2024-01-01_00-00-00-000000.manifest.json.gz', b'', parents=['F'])
+            # newer manifest of another project on the same account
+            fake.add_file('media_2024-02-01_00-00-00-000000.manifest.json.gz', b'', parents=['G'])
+            with mock.patch('gcapi.manifest.FOLDER_ID', 'F'):
+                latest = latest_manifest(GCDrive(pool=fake.pool()))
+        self.assertEqual(latest['name'], 'media_2024-01-01_00-00-00-000000.manifest.json.gz')
+        
+    def test_file_changed_after_scan(self):
+        members = MediaManifest().scan(self.root).plan_packs()[0]
+        self.assertEqual(PackReader(self.root, members).read(), b'aaabbbb')
+        # grows: pack would end before the new bytes
+        with open(os.path.join(self.root, 'images/b.png'), 'ab') as f:
+            f.write(b'b')
+        with self.assertRaises(ValueError):
+            PackReader(self.root, members).read()
+        # same size, other content
+        with open(os.path.join(self.root, 'images/b.png'), 'wb') as f:
+            f.write(b'wxyz')
+        with self.assertRaises(ValueError):
+            PackReader(self.root, members).read()
+        
+
+@unittest.skipUnless(os.path.isdir('/proc'), 'needs /proc')
+class TestOpenFiles(unittest.TestCase):
+    
+    def test_busy_files_are_skipped(self):
+        import subprocess
+        work = tempfile.mkdtemp()
+        # relative and symlinked folder, like a BASE_DIR
+        link = os.path.join(tempfile.mkdtemp(), 'dump')
+        os.symlink(work, link)
+        for name in ('1.dat', 'toc.dat'):
+            with open(os.path.join(work, name), 'wb') as f:
+                f.write(b'done')
+        # child process of the shell keeps 2.dat open, like a pg_dump -j worker
+        process = subprocess.Popen(['sh', '-c', '(exec 3>2.dat; echo ready; sleep 30) & wait'],
+                                   cwd=work, stdout=subprocess.PIPE, start_new_session=True)
+        self.addCleanup(process.stdout.close)
+        self.addCleanup(process.wait)
+        self.addCleanup(os.killpg, process.pid, 9)
+        process.stdout.readline()
+        self.assertIn(os.path.join(work, '2.dat'), open_files(process.pid))
+        folder = os.path.relpath(link)
+        self.assertEqual(closed_files(folder, process.pid, exclude=('toc.dat',)), ['1.dat'])
+        
+    def test_file_created_during_snapshot_is_busy(self):
+        work = tempfile.mkdtemp()
+        with open(os.path.join(work, '1.dat'), 'wb') as f:
+            f.write(b'done')
+        
+        def snapshot(pid):
+            # a pg_dump -j worker starts a table file while open files are read
+            with open(os.path.join(work, '2.dat'), 'wb') as f:
+                f.write(b'half')
+            return set()
+        
+        with mock.patch('gcapi.pipeline.open_files', side_effect=snapshot):
+            self.assertEqual(closed_files(work, pid=1), ['1.dat'])
+        
+
+class TestCompress(unittest.TestCase):
+    
+    data = os.urandom(1024) * 300
+    
+    def roundtrip(self, codec):
+        compressed = io.BytesIO()
+        compress_stream(io.BytesIO(self.data), compressed, codec=codec, 
+                        threads=4, buffer_size=64 * 1024)
+        compressed.seek(0)
+        output = io.BytesIO()
+        uncompress_stream(compressed, output)
+        self.assertEqual(output.getvalue(), self.data)
+        return compressed.getvalue()
+    
+    def test_gzip(self):
+        self.roundtrip('gzip')
+        
+    def test_same_input_same_output(self):
+        # unchanged media gives the same tarball, so upload dedup finds it
+        import time
+        for codec in ('gzip', 'pgzip'):
+            first = self.roundtrip(codec)
+            with mock.patch.object(time, 'time', return_value=time.time() + 60):
+                self.assertEqual(self.roundtrip(codec), first)
+        
+    def test_parallel_gzip_is_readable_by_gzip(self):
+        import gzip
+        self.assertEqual(gzip.decompress(self.roundtrip('pgzip')), self.data)
+    
+    @unittest.skipIf(zstandard is None, 'zstandard is not installed')
+    def test_zstd(self):
+        self.roundtrip('zstd')
+        
+    def test_uncompress_file_needs_extension(self):
+        with tempfile.TemporaryDirectory() as work:
+            path = os.path.join(work, 'default_db.dump')
+            with open(path, 'wb') as f:
+                f.write(self.data)
+            compressed = compress_file(path, codec='gzip')
+            os.rename(compressed, path)
+            # would be written over default_db
+            with self.assertRaises(ValueError):
+                uncompress_file(path)
+            os.rename(path, compressed)
+            self.assertEqual(uncompress_file(compressed), path)
+            with open(path, 'rb') as f:
+                self.assertEqual(f.read(), self.data)
+
+
+class TestParallelArchive(unittest.TestCase):
+    
+    def test_roundtrip(self):
+        with tempfile.TemporaryDirectory() as work:
+            source = os.path.join(work, 'media')
+            files = {
+                'a.txt': b'a' * 10,
+                'empty': b'',
+                'sub/b.bin': os.urandom(300 * 1024),  # bigger than prefetch limit
+                'sub/deep/c.txt': b'c',
+            }
+            for name, content in files.items():
+                path = os.path.join(source, name)
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                with open(path, 'wb') as f:
+                    f.write(content)
+            os.utime(os.path.join(source, 'a.txt'), (1000000000, 1000000000))
+            
+            archive = io.BytesIO()
+            # 2 folders + 4 files, root folder is not archived without arcroot
+            self.assertEqual(write_tar(source, archive, workers=3), 6)
+            archive.seek(0)
+            target = os.path.join(work, 'restore')
+            self.assertEqual(extract_tar(archive, target, workers=3), 6)
+            
+            for name, content in files.items():
+                with open(os.path.join(target, name), 'rb') as f:
+                    self.assertEqual(f.read(), content)
+            self.assertEqual(os.stat(os.path.join(target, 'a.txt')).st_mtime, 1000000000)
+            
+    def test_big_files_are_streamed(self):
+        from gcapi import archive as archive_module
+        content = os.urandom(3 * 1024 * 1024)
+        stream = io.BytesIO()
+        with tarfile.open(fileobj=stream, mode='w') as tar:
+            info = tarfile.TarInfo('video.mp4')
+            info.size = len(content)
+            tar.addfile(info, io.BytesIO(content))
+        stream.seek(0)
+        with tempfile.TemporaryDirectory() as target, \
+             mock.patch.object(archive_module._WriteLimiter, 'acquire') as acquire:
+            self.assertEqual(extract_tar(stream, target), 1)
+            with open(os.path.join(target, 'video.mp4'), 'rb') as f:
+                self.assertEqual(f.read(), content)
+        # not queued for the workers as one bytes object
+        acquire.assert_not_called()
+    
+    def test_members_out_of_extract_dir(self):
+        def member(name, type=tarfile.REGTYPE, linkname=''):
+            stream = io.BytesIO()
+            with tarfile.open(fileobj=stream, mode='w') as tar:
+                info = tarfile.TarInfo(name)
+                info.type = type
+                info.linkname = linkname
+                info.size = 4 if type == tarfile.REGTYPE else 0
+                tar.addfile(info, io.BytesIO(b'evil') if type == tarfile.REGTYPE else None)
+            stream.seek(0)
+            return stream
+        
+        with tempfile.TemporaryDirectory() as work:
+            target = os.path.join(work, 'restore')
+            os.makedirs(target)
+            outside = os.path.join(work, 'evil')
+            # checked by extract_tar itself on pythons without data_filter
+            with mock.patch.dict(tarfile.__dict__):
+                tarfile.__dict__.pop('data_filter', None)
+                for stream in (member('../evil'), member(outside), 
+                               member('link', tarfile.SYMTYPE, '../evil')):
+                    with self.assertRaises(tarfile.ExtractError):
+                        extract_tar(stream, target)
+            self.assertFalse(os.path.lexists(outside))
+            self.assertFalse(os.path.lexists(os.path.join(target, 'link')))
+            # python rejects them by its own filter
+            if hasattr(tarfile, 'data_filter'):
+                with self.assertRaises(tarfile.TarError):
+                    extract_tar(member('../evil'), target)
+                self.assertFalse(os.path.lexists(outside))
+
+
+
+class TestProcessStream(unittest.TestCase):
+    # command which writes more warnings than a pipe buffer holds, like a chatty gpg
+    command = ['sh', '-c', 'head -c 200000 /dev/zero | tr "\\0" w >&2; cat']
+    
+    def test_lots_of_stderr(self):
+        import threading
+        output = io.BytesIO()
+        
+        def run():
+            with ProcessWriter(output, self.command) as writer:
+                writer.write(b'backup')
+            with ProcessReader(io.BytesIO(b'dump'), self.command) as reader:
+                self.assertEqual(reader.read(), b'dump')
+        
+        thread = threading.Thread(target=run, daemon=True)
+        thread.start()
+        thread.join(10)
+        self.assertFalse(thread.is_alive())
+        self.assertEqual(output.getvalue(), b'backup')
+        
+    def test_original_error_is_raised(self):
+        with self.assertRaises(RuntimeError) as error:
+            with ProcessWriter(io.BytesIO(), ['sh', '-c', 'echo bad key >&2; exit 2']) as writer:
+                writer.write(b'backup')
+        self.assertIn('bad key', str(error.exception))
+        with self.assertRaises(KeyError):
+            with ProcessWriter(io.BytesIO(), ['sh', '-c', 'exit 2']):
+                raise KeyError('upload failed')
+        
+
+class _PlainKeyCryption(Cryption):
+    """AEAD cryption whose data key is not wrapped with gpg"""
+    def wrap_key(self, key):
+        return key
+    
+    def unwrap_key(self, wrapped_key):
+        return wrapped_key
+
+
+class TestAEADCryption(unittest.TestCase):
+    
+    key = os.urandom(32)
+    
+    def encrypt(self, data, cipher='aes-gcm', chunk_size=1024):
+        output = io.BytesIO()
+        with AEADWriter(output, key=self.key, wrapped_key=self.key, 
+                        cipher=cipher, chunk_size=chunk_size, threads=2) as writer:
+            writer.write(data)
+        return output.getvalue()
+    
+    def decrypt(self, data):
+        with AEADReader(io.BytesIO(data), unwrap_key=lambda key: key, threads=2) as reader:
+            return reader.read()
+    
+    def test_roundtrip(self):
+        for cipher in ('aes-gcm', 'chacha20'):
+            # empty, shorter than, equal to and multiple of chunk size
+            for size in (0, 100, 1024, 4096, 5000):
+                data = os.urandom(size)
+                self.assertEqual(self.decrypt(self.encrypt(data, cipher)), data)
+    
+    def test_truncated_stream_fails(self):
+        sealed = self.encrypt(os.urandom(5000))
+        header = len(sealed) - (4 * (1024 + 16) + 904 + 16) - 32
+        # cut at chunk boundaries, in the middle of a chunk and in the index
+        for end in (header, header + 1024 + 16, len(sealed) - 100, len(sealed) - 10):
+            with self.assertRaises(Exception):
+                self.decrypt(sealed[:end])
+    
+    def test_random_access(self):
+        data = os.urandom(5000)
+        sealed = self.encrypt(data)
+        reads = []
+        
+        def read_at(offset, size):
+            reads.append(size)
+            return sealed[offset:offset + size]
+        
+        envelope = EnvelopeFile(read_at, len(sealed), unwrap_key=lambda key: key)
+        self.assertEqual(envelope.size, 5000)
+        for start, end in ((0, 1), (1000, 1100), (1020, 3000), (4990, 6000)):
+            reads.clear()
+            self.assertEqual(envelope.read_range(start, end), data[start:end])
+            # only chunks of the range are fetched
+            self.assertLessEqual(sum(reads), (end - start) + 2 * (1024 + 16))
+    
+    def test_parallel_file_roundtrip(self):
+        with tempfile.TemporaryDirectory() as work:
+            source, sealed, output = (os.path.join(work, name) for name in ('in', 'in.gpg', 'out'))
+            data = os.urandom(100 * 1024 + 5)
+            with open(source, 'wb') as f:
+                f.write(data)
+            seal_file(source, sealed, key=self.key, wrapped_key=self.key,
+                      chunk_size=1024, processes=2)
+            # file envelope is readable as a stream too
+            with open(sealed, 'rb') as f:
+                self.assertEqual(self.decrypt(f.read()), data)
+            open_file(sealed, output, unwrap_key=lambda key: key, processes=2)
+            with open(output, 'rb') as f:
+                self.assertEqual(f.read(), data)
+    
+    def test_stream_wrappers(self):
+        cryption = _PlainKeyCryption(mode='aead')
+        data = os.urandom(3 * 1024 * 1024 + 7)
+        with cryption.encrypt_reader(io.BytesIO(data)) as encrypted:
+            sealed = encrypted.read()
+        output = io.BytesIO()
+        with cryption.decrypt_writer(output) as writer:
+            writer.write(sealed)
+        self.assertEqual(output.getvalue(), data)
+
+
+
+class TestStartup(unittest.TestCase):
+    
+    # modules which must not be imported before a command runs
+    HEAVY_MODULES = ('googleapiclient', 'google.auth', 'cryptography', 'httplib2')
+    
+    def import_times(self, module: str) -> dict:
+        """Cumulative import time (us) of every module, from python -X importtime"""
+        import sys
+        import subprocess
+        result = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+                                capture_output=True, text=True, check=True,
+                                cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+        times = {}
+        for line in result.stderr.splitlines():
+            if line.startswith('import time:') and '|' in line:
+                _, cumulative, name = line.split('|')
+                if cumulative.strip().isdigit():
+                    times[name.strip()] = int(cumulative)
+        return times
+    
+    def test_cli_imports_lazily(self):
+        times = self.import_times('gcapi.cli')
+        heavy = [name for name in times if name.startswith(self.HEAVY_MODULES)]
+        self.assertEqual(heavy, [], f"gcapi.cli imports {heavy}, "
+                                    f"total {times['gcapi.cli'] / 1000:.1f} ms")
+
+
+class TestServicePool(unittest.TestCase):
+    
+    def test_service_per_thread(self):
+        import threading
+        from google.oauth2.credentials import Credentials
+        pool = ServicePool(credentials=Credentials(token='token'))
+        service = pool.service()
+        self.assertIs(pool.service(), service)
+        
+        other = []
+        thread = threading.Thread(target=lambda: other.append(pool.service()))
+        thread.start()
+        thread.join()
+        self.assertIsNot(other[0], service)
+        # rebuild gives a new service, credentials stay shared
+        self.assertIsNot(pool.service(rebuild=True), service)
+        self.assertIs(pool.http().credentials, pool.credentials())
+
+
+class TestThrottle(unittest.TestCase):
+    
+    def test_profile(self):
+        import datetime
+        profile = BandwidthProfile.parse("08:00-20:00=1M,22:00-06:00=512K", default='off')
+        self.assertEqual(parse_rate('2MB/s'), 2 * 1024 * 1024)
+        self.assertEqual(profile.rate(datetime.datetime(2024, 1, 1, 12)), 1024 * 1024)
+        # period passes midnight
+        self.assertEqual(profile.rate(datetime.datetime(2024, 1, 1, 23)), 512 * 1024)
+        self.assertEqual(profile.rate(datetime.datetime(2024, 1, 1, 21)), 0)
+        
+    def test_token_bucket(self):
+        bucket = TokenBucket(BandwidthProfile(default=1000))
+        self.assertAlmostEqual(bucket.reserve(500), 0.5, places=1)
+        # next request waits for the debt of the previous one
+        self.assertAlmostEqual(bucket.reserve(500), 1.0, places=1)
+        self.assertEqual(TokenBucket(BandwidthProfile()).reserve(10 ** 9), 0)
+        
+    def test_backoff_on_rate_limit(self):
+        import httplib2
+        from googleapiclient.errors import HttpError
+        content = b'{"error": {"errors": [{"reason": "userRateLimitExceeded"}]}}'
+        responses = [HttpError(httplib2.Response({'status': 403}), content),
+                     HttpError(httplib2.Response({'status': 429}), b''),
+                     'done']
+        
+        def request():
+            response = responses.pop(0)
+            if isinstance(response, Exception):
+                raise response
+            return response
+        
+        limiter = AdaptiveConcurrency(max_limit=8)
+        with mock.patch('gcapi.retry.time.sleep') as sleep:
+            self.assertEqual(retry(limiter.call, request), 'done')
+        self.assertEqual(limiter.limit, 2)
+        # full jitter: random pause up to 1s, then up to 2s
+        delays = [call.args[0] for call in sleep.call_args_list]
+        self.assertEqual(len(delays), 2)
+        self.assertTrue(0 <= delays[0] <= 1 and 0 <= delays[1] <= 2)
+        # other errors are not retried
+        with self.assertRaises(HttpError):
+            retry(limiter.call, mock.Mock(side_effect=HttpError(httplib2.Response({'status': 404}), b'')))
+        
+
+class TestAsyncConcurrency(unittest.IsolatedAsyncioTestCase):
+    
+    async def test_rate_limit_halves_slots(self):
+        import asyncio
+        import httplib2
+        from googleapiclient.errors import HttpError
+        limiter = AsyncAdaptiveConcurrency(max_limit=4)
+        for _ in range(2):
+            with self.assertRaises(HttpError):
+                async with limiter.slot():
+                    raise HttpError(httplib2.Response({'status': 429}), b'')
+        self.assertEqual(limiter.limit, 1)
+        
+        entered = []
+        release = asyncio.Event()
+        
+        async def request(index):
+            async with limiter.slot():
+                entered.append(index)
+                await release.wait()
+        
+        tasks = [asyncio.create_task(request(index)) for index in range(3)]
+        await asyncio.sleep(0.01)
+        # one request in flight, the others wait for its slot
+        self.assertEqual(entered, [0])
+        release.set()
+        await asyncio.gather(*tasks)
+        self.assertEqual(entered, [0, 1, 2])
+        self.assertEqual(limiter.limit, 3)
+        
+
+class TestRetry(unittest.TestCase):
+    
+    def setUp(self):
+        self.fake = FakeDrive().start()
+        self.addCleanup(self.fake.stop)
+        self.drive = GCDrive(pool=self.fake.pool())
+        sleep = mock.patch('gcapi.retry.time.sleep')
+        self.sleep = sleep.start()
+        self.addCleanup(sleep.stop)
+        
+    def test_upload_resumes_after_failed_chunk(self):
+        content = os.urandom(600 * 1024)
+        with tempfile.NamedTemporaryFile() as f:
+            f.write(content)
+            f.flush()
+            # second chunk is stored but its response is lost
+            self.fake.fail(status=503, method='PUT', path='/upload', commit=True)
+            self.fake.fail(status=429, method='POST', retry_after=7)
+            response = self.drive.upload(f.name, folder_id='F', chunk_size=256 * 1024)
+        self.assertEqual(self.fake.contents[response['id']], content)
+        self.assertEqual(self.sleep.call_args_list[0].args[0], 7)
+        
+    def test_upload_without_verify(self):
+        # plain MediaFileUpload sends chunks as stream slices, not bytes
+        content = os.urandom(300 * 1024)
+        with tempfile.NamedTemporaryFile() as f:
+            f.write(content)
+            f.flush()
+            response = self.drive.upload(f.name, folder_id='F', chunk_size=256 * 1024, verify=False)
+        self.assertEqual(self.fake.contents[response['id']], content)
+        
+    def test_download_and_delete(self):
+        file = self.fake.add_file('dump', b'x' * 1000, parents=['F'])
+        self.fake.fail(status=500, times=2, path=f"/drive/v3/files/{file['id']}")
+        with tempfile.TemporaryDirectory() as folder, \
+             mock.patch('gcapi.drive.BACKUP_FOLDER', folder):
+            status, path = self.drive.download(file['id'])
+            with open(path, 'rb') as f:
+                self.assertEqual(f.read(), b'x' * 1000)
+        # delete succeeds on drive, its response fails
+        self.fake.fail(status=503, method='DELETE', commit=True)
+        self.assertTrue(self.drive.delete(file['id']))
+        
+    def test_dedup_upload_is_a_copy(self):
+        with tempfile.NamedTemporaryFile(suffix='.tar.gz') as f:
+            f.write(os.urandom(300 * 1024))
+            f.flush()
+            first = self.drive.upload(f.name, folder_id='F', dedup=True)
+            self.assertNotIn('duplicateOf', first)
+            self.fake.reset_stats()
+            # copy is made but its response is lost, it is not copied twice
+            self.fake.fail(status=503, method='POST', path=f"/drive/v3/files/{first['id']}/copy",
+                           commit=True)
+            second = self.drive.upload(f.name, folder_id='F', dedup=True)
+        self.assertEqual(second['duplicateOf'], first['id'])
+        self.assertEqual(len(self.fake.files), 2)
+        self.assertEqual(self.fake.contents[second['id']], self.fake.contents[first['id']])
+        # no media bytes are sent
+        self.assertFalse([path for _, path in self.fake.requests if path.startswith('/upload')])
+        self.assertLess(self.fake.bytes_received, 10 * 1024)
+        
+    def test_download_ranges_resume(self):
+        old, new = os.urandom(1000), os.urandom(1000)
+        file = self.fake.add_file('dump', old)
+        with tempfile.TemporaryDirectory() as folder, \
+             mock.patch('gcapi.drive.BACKUP_FOLDER', folder):
+            # metadata and 4 ranges succeed, 5th range connection drops until retries are over
+            # (httplib2 sends a dropped request once more itself)
+            self.fake.fail(drop=True, times=2 * (RETRIES + 1), method='GET', 
+                           path=f"/drive/v3/files/{file['id']}", after=5)
+            with self.assertRaises(Exception):
+                self.drive.download_ranges(file['id'], file_name='dump', range_size=100, max_workers=1)
+            self.assertTrue(os.path.exists(os.path.join(folder, 'dump.ranges')))
+            self.fake.reset_stats()
+            status, path = self.drive.download_ranges(file['id'], file_name='dump', 
+                                                      range_size=100, max_workers=3)
+            with open(path, 'rb') as f:
+                self.assertEqual(f.read(), old)
+            # metadata and the failed range, the other workers finished theirs
+            self.assertEqual(len(self.fake.requests), 2)
+            self.assertFalse(os.path.exists(f"{path}.ranges"))
+            
+            # same name, other content: ranges of the interrupted download are not reused
+            self.fake.fail(drop=True, times=2 * (RETRIES + 1), method='GET', 
+                           path=f"/drive/v3/files/{file['id']}", after=5)
+            with self.assertRaises(Exception):
+                self.drive.download_ranges(file['id'], file_name='dump', range_size=100, max_workers=1)
+            replaced = self.fake.add_file('dump', new)
+            status, path = self.drive.download_ranges(replaced['id'], file_name='dump', range_size=100)
+            with open(path, 'rb') as f:
+                self.assertEqual(f.read(), new)
+        
+    def test_deadline(self):
+        self.fake.fail(status=503, times=10, retry_after=30)
+        with self.assertRaises(DeadlineExceeded), deadline(10):
+            self.drive.get('missing')
+        # not transient
+        from googleapiclient.errors import HttpError
+        with self.assertRaises(HttpError):
+            self.drive.get('missing')
+
+    def test_batch_and_stats(self):
+        from googleapiclient.errors import HttpError
+        ids = [self.fake.add_file(f'media_{index}', b'', parents=['F'])['id'] for index in range(120)]
+        self.fake.fail(status=503, method='DELETE', path=f"/drive/v3/files/{ids[5]}")
+        self.fake.reset_stats()
+        result = self.drive.bulk_delete(ids + ['missing'])
+        self.assertTrue(all(result[file_id] for file_id in ids))
+        self.assertIsInstance(result['missing'], HttpError)
+        self.assertEqual(self.fake.files, {})
+        # two batches of 100 and one for the failed item
+        self.assertEqual([path for _, path in self.fake.requests].count('/batch/drive/v3'), 3)
+        self.assertGreater(self.fake.bytes_received, 0)
+        
+    def test_batch_applied_but_failed(self):
+        ids = [self.fake.add_file(f'media_{index}', b'', parents=['F'])['id'] for index in range(3)]
+        # drive deletes the files, the response of the batch is lost
+        self.fake.fail(status=503, method='POST', path='/batch', commit=True)
+        self.assertEqual(self.drive.bulk_delete(ids), {file_id: True for file_id in ids})
+        self.assertEqual(self.fake.files, {})
+        
+    def test_not_idempotent_calls(self):
+        # folder is made but its response is lost, it is not made twice
+        self.fake.fail(status=503, method='POST', path='/drive/v3/files', commit=True)
+        folder = self.drive.create_folder('2024-01-01', folder_id='F')
+        self.assertEqual([file['id'] for file in self.fake.files.values()], [folder['id']])
+        # retried delete in a batch which answers 404 was done by the failed attempt
+        file = self.fake.add_file('media', b'', parents=['F'])
+        self.fake.fail(status=503, method='DELETE', commit=True)
+        self.assertEqual(self.drive.bulk_delete([file['id']]), {file['id']: True})
+        self.assertNotIn(file['id'], self.fake.files)
+
+
+def _configure_django() -> None:
+    """Settings of management command tests, database NAME is db"""
+    from django.conf import settings
+    if not settings.configured:
+        settings.configure(BASE_DIR=tempfile.gettempdir(),
+                           DATABASES={'default': {'ENGINE': 'django.db.backends.sqlite3',
+                                                  'NAME': 'db'}})
+
+
+@unittest.skipIf(importlib.util.find_spec('django') is None, 'django is not installed')
+class TestStreamCommands(unittest.TestCase):
+    """pybackup --stream and pyrestore --stream on FakeDrive, pg_dump and pg_restore are scripts"""
+    
+    def setUp(self):
+        _configure_django()
+        self.fake = FakeDrive().start()
+        self.addCleanup(self.fake.stop)
+        drive = GCDrive(pool=self.fake.pool())
+        # several chunks per upload
+        drive.upload_stream = functools.partial(drive.upload_stream, chunk_size=256 * 1024)
+        
+        work = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, work)
+        self.dump = os.urandom(600 * 1024) + bytes(600 * 1024)
+        with open(os.path.join(work, 'dump'), 'wb') as f:
+            f.write(self.dump)
+        self.restored = os.path.join(work, 'restored')
+        for name, script in [('pg_dump', 'cat "$GCAPI_TEST_DUMP"'),
+                             ('pg_restore', 'cat > "$GCAPI_TEST_RESTORED"')]:
+            with open(os.path.join(work, name), 'w') as f:
+                f.write(f'#!/bin/sh\n{script}\n')
+            os.chmod(os.path.join(work, name), 0o755)
+        
+        commands = 'gcapi.dbhandler.management.commands'
+        patches = [
+            mock.patch.dict(os.environ, {'PATH': work + os.pathsep + os.environ['PATH'],
+                                         'GCAPI_TEST_DUMP': os.path.join(work, 'dump'),
+                                         'GCAPI_TEST_RESTORED': self.restored}),
+            mock.patch(f'{commands}.pybackup.GCDrive', return_value=drive),
+            mock.patch(f'{commands}.pyrestore.GCDrive', return_value=drive),
+            mock.patch(f'{commands}.pybackup.Cryption', lambda: _PlainKeyCryption(mode='aead')),
+            mock.patch(f'{commands}.pyrestore.Cryption', lambda: _PlainKeyCryption(mode='aead')),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+    
+    def test_backup_and_restore(self):
+        from gcapi.dbhandler.management.commands import pybackup, pyrestore
+        output = io.StringIO()
+        pybackup.Command(stdout=output).handle(stream=True, compress=True, encrypt=True, jobs=None)
+        self.assertIn('Backup file streamed to Google drive', output.getvalue())
+        [(file_id, file)] = self.fake.files.items()
+        self.assertRegex(file['name'], r'^default_db_.*\.dump\.gz\.gpg$')
+        # uploaded bytes are the compressed and encrypted dump
+        decrypted = io.BytesIO()
+        with _PlainKeyCryption(mode='aead').decrypt_writer(decrypted) as writer:
+            writer.write(self.fake.contents[file_id])
+        self.assertEqual(gzip.decompress(decrypted.getvalue()), self.dump)
+        
+        pyrestore.Command(stdout=output).handle(stream=True, decrypt=True, jobs=None)
+        self.assertIn('successfully streamed from backup file', output.getvalue())
+        with open(self.restored, 'rb') as f:
+            self.assertEqual(f.read(), self.dump)
+        
+
+class TestApplyRetention(unittest.TestCase):
+    
+    DAYS = ['2024-01-01', '2024-01-02', '2024-01-03']
+    
+    def setUp(self):
+        self.fake = FakeDrive().start()
+        self.addCleanup(self.fake.stop)
+        self.drive = GCDrive(pool=self.fake.pool())
+        self.policy = RetentionPolicy(hourly=0, daily=2, weekly=0, monthly=0)
+        
+    def names(self) -> set:
+        return {file['name'] for file in self.fake.files.values()}
+    
+    def add_media(self) -> None:
+        old_pack = self.fake.add_file('mediapack_old', b'old')
+        shared_pack = self.fake.add_file('mediapack_shared', b'shared')
+        for day, packs in zip(self.DAYS, [[old_pack, shared_pack], [shared_pack], [shared_pack]]):
+            manifest = MediaManifest(packs={pack['name']: {'id': pack['id'], 'encrypted': False}
+                                            for pack in packs})
+            self.fake.add_file(f'media_{day}_00-00-00-000000.manifest.json.gz', manifest.dumps())
+            # full tarball of the same day is newer than the manifest
+            self.fake.add_file(f'media_{day}_12-00-00-000000.tar.gz', b'')
+        # pack of a backup whose manifest is not uploaded yet
+        self.fake.add_file('mediapack_running', b'running')
+    
+    def test_database_backups(self):
+        for day in self.DAYS:
+            self.fake.add_file(f'default_db_{day}_00-00-00-000000.dump', b'')
+        self.fake.add_file('default_other_2023-01-01_00-00-00-000000.dump', b'')
+        before = self.names()
+        result = self.drive.apply_retention(self.policy, prefix='default_db_', dry_run=True)
+        self.assertEqual([file['name'] for file in result['delete']], 
+                         ['default_db_2024-01-01_00-00-00-000000.dump'])
+        self.assertEqual(self.names(), before)
+        
+        result = self.drive.apply_retention(self.policy, prefix='default_db_')
+        self.assertEqual(list(result['results'].values()), [True])
+        self.assertEqual(self.names(), before - {'default_db_2024-01-01_00-00-00-000000.dump'})
+    
+    def test_media_backups(self):
+        self.add_media()
+        before = self.names()
+        result = self.drive.apply_retention(self.policy, prefix='media_')
+        deleted = {'media_2024-01-01_00-00-00-000000.manifest.json.gz', 
+                   'media_2024-01-01_12-00-00-000000.tar.gz', 'mediapack_old'}
+        self.assertEqual({file['name'] for file in result['delete']}, deleted)
+        self.assertEqual(self.names(), before - deleted)
+    
+    @unittest.skipIf(importlib.util.find_spec('django') is None, 'django is not installed')
+    def test_pyprune(self):
+        from gcapi.dbhandler.management.commands import pyprune
+        _configure_django()
+        self.add_media()
+        before = self.names()
+        output = io.StringIO()
+        options = {'hourly': 0, 'daily': 2, 'weekly': 0, 'monthly': 0, 'media': True}
+        with mock.patch('gcapi.dbhandler.management.commands.pyprune.GCDrive', return_value=self.drive):
+            pyprune.Command(stdout=output).handle(dry_run=True, **options)
+            self.assertIn('would delete mediapack_old', output.getvalue())
+            self.assertEqual(self.names(), before)
+            
+            pyprune.Command(stdout=output).handle(dry_run=False, **options)
+        self.assertIn('deleted mediapack_old', output.getvalue())
+        self.assertIn('Success: 4 backups kept, 3 deleted', output.getvalue())
+        self.assertEqual(len(self.names()), len(before) - 3)
+
+
+@unittest.skipIf(aiohttp is None, 'aiohttp is not installed')
+class TestAsyncGCDrive(unittest.IsolatedAsyncioTestCase):
+    
+    async def asyncSetUp(self):
+        from aiohttp import web
+        from google.oauth2.credentials import Credentials
+        self.files = [{'id': str(index), 'name': f'file{index}'} for index in range(5)]
+        self.uploaded = bytearray()
+        
+        async def list_files(request):
+            start = int(request.query.get('pageToken', 0))
+            end = start + int(request.query['pageSize'])
+            result = {'files': self.files[start:end]}
+            if end < len(self.files):
+                result['nextPageToken'] = str(end)
+            return web.json_response(result)
+        
+        async def get_file(request):
+            if request.query.get('alt') == 'media':
+                return web.Response(body=b'content of ' + request.match_info['id'].encode())
+            return web.json_response(self.files[int(request.match_info['id'])])
+        
+        async def delete_file(request):
+            return web.Response(status=204)
+        
+        async def create_upload(request):
+            self.total = int(request.headers['X-Upload-Content-Length'])
+            return web.Response(headers={'Location': str(request.url.with_path('/session'))})
+        
+        async def upload_chunk(request):
+            self.uploaded += await request.read()
+            if len(self.uploaded) < self.total:
+                return web.Response(status=308, headers={'Range': f'bytes=0-{len(self.uploaded) - 1}'})
+            return web.json_response({'id': 'new', 'name': 'upload.bin'})
+        
+        app = web.Application()
+        app.router.add_get('/drive/v3/files', list_files)
+        app.router.add_get('/drive/v3/files/{id}', get_file)
+        app.router.add_delete('/drive/v3/files/{id}', delete_file)
+        app.router.add_post('/upload/drive/v3/files', create_upload)
+        app.router.add_put('/session', upload_chunk)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, '127.0.0.1', 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        self.drive = AsyncGCDrive(credentials=Credentials(token='token'), max_connections=2,
+                                  root_url=f'http://127.0.0.1:{port}')
+    
+    async def asyncTearDown(self):
+        await self.drive.close()
+        await self.runner.cleanup()
+    
+    async def test_metadata(self):
+        self.assertEqual((await self.drive.get('3'))['name'], 'file3')
+        names = [file['name'] async for file in self.drive.iter_files(page_size=2)]
+        self.assertEqual(names, [file['name'] for file in self.files])
+        self.assertTrue(await self.drive.delete('1'))
+    
+    async def test_upload_and_download(self):
+        with tempfile.TemporaryDirectory() as work:
+            path = os.path.join(work, 'upload.bin')
+            data = os.urandom(600 * 1024)
+            with open(path, 'wb') as f:
+                f.write(data)
+            with mock.patch('gcapi.aiodrive.BACKUP_FOLDER', work):
+                response = await self.drive.upload(path, folder_id='folder', chunk_size=256 * 1024)
+                self.assertEqual(response['id'], 'new')
+                self.assertEqual(bytes(self.uploaded), data)
+                
+                status, file = await self.drive.download('2', file_name='downloaded')
+                with open(file, 'rb') as f:
+                    self.assertEqual(f.read(), b'content of 2')
+    
+    async def test_retried_delete(self):
+        from google.oauth2.credentials import Credentials
+        with FakeDrive() as fake, mock.patch('gcapi.aiodrive.backoff', return_value=0):
+            drive = AsyncGCDrive(credentials=Credentials(token='fake'),
+                                 root_url=fake.root_url.rstrip('/'))
+            self.addAsyncCleanup(drive.close)
+            file = fake.add_file('dump', b'dump')
+            # delete succeeds on drive, its response fails
+            fake.fail(status=503, method='DELETE', commit=True)
+            self.assertTrue(await drive.delete(file['id']))
+            self.assertEqual(fake.files, {})
+            # not retried, the file was not there
+            from googleapiclient.errors import HttpError
+            with self.assertRaises(HttpError):
+                await drive.delete('missing')
+    
+    async def test_retry_and_checksums(self):
+        from google.oauth2.credentials import Credentials
+        from gcapi.checksum import ChecksumError
+        with FakeDrive() as fake, tempfile.TemporaryDirectory() as work, \
+             mock.patch('gcapi.aiodrive.BACKUP_FOLDER', work), \
+             mock.patch('gcapi.aiodrive.backoff', return_value=0):
+            drive = AsyncGCDrive(credentials=Credentials(token='fake'),
+                                 root_url=fake.root_url.rstrip('/'))
+            self.addAsyncCleanup(drive.close)
+            path = os.path.join(work, 'upload.bin')
+            data = os.urandom(600 * 1024)
+            with open(path, 'wb') as f:
+                f.write(data)
+            # chunk is stored but its response is lost, then a rate limit
+            fake.fail(status=503, method='PUT', path='/upload', commit=True)
+            fake.fail(status=429, method='POST')
+            response = await drive.upload(path, folder_id='F', chunk_size=256 * 1024)
+            self.assertEqual(fake.contents[response['id']], data)
+            self.assertTrue(response['md5Checksum'])
+            
+            fake.fail(status=500, method='GET', path=f"/drive/v3/files/{response['id']}")
+            status, file = await drive.download(response['id'], file_name='downloaded')
+            with open(file, 'rb') as f:
+                self.assertEqual(f.read(), data)
+            
+            # drive has other content than what was written
+            fake.files[response['id']]['md5Checksum'] = '0' * 32
+            with self.assertRaises(ChecksumError):
+                await drive.download(response['id'], file_name='corrupt')
+            self.assertFalse(os.path.exists(os.path.join(work, 'corrupt')))
         
 
 if __name__ == '__main__':
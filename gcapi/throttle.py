@@ -0,0 +1,281 @@
+"""
+Bandwidth shaping and adaptive concurrency
+
+Backups of production hosts must not saturate the shared uplink during
+the day. Two controls are shared by every GCDrive of the process:
+
+    - upload_limit / download_limit -> token buckets in bytes per second.
+      Every request of the pooled http connections (gcapi.service) takes
+      tokens for its body before it is sent, and for its content after it
+      is received. So the burst is at most one chunk or range, set a smaller
+      GCAPI_CHUNK_SIZE / GCAPI_RANGE_SIZE for smoother traffic.
+    - concurrency -> limit of transfer requests in flight. It is halved when
+      Drive answers 429 or 403 userRateLimitExceeded and grows by one after
+      enough successful requests. gcapi.retry sends the request again.
+      AsyncGCDrive has its own limit of the same kind (AsyncAdaptiveConcurrency).
+
+Rate is GCAPI_BANDWIDTH_LIMIT (e.g. 2M, 512K, 0 for unlimited) and it can be
+changed by time of day with GCAPI_BANDWIDTH_PROFILE, local time ranges:
+
+    GCAPI_BANDWIDTH_PROFILE="08:00-20:00=1M,20:00-08:00=0"
+"""
+import os
+import re
+import asyncio
+import contextlib
+import json
+import time
+import datetime
+import threading
+import httplib2
+from googleapiclient.errors import HttpError
+
+
+# bytes per second of each direction, 0 is unlimited
+BANDWIDTH_LIMIT = os.environ.get('GCAPI_BANDWIDTH_LIMIT', '0')
+# time of day ranges with their own limit, "HH:MM-HH:MM=RATE,..."
+BANDWIDTH_PROFILE = os.environ.get('GCAPI_BANDWIDTH_PROFILE', '')
+# max transfer requests in flight in the process
+MAX_CONCURRENCY = int(os.environ.get('GCAPI_MAX_CONCURRENCY', 8))
+RATE_LIMIT_REASONS = ('userRateLimitExceeded', 'rateLimitExceeded')
+UNITS = {'': 1, 'k': 1024, 'm': 1024 ** 2, 'g': 1024 ** 3}
+
+
+def parse_rate(value) -> float:
+    """
+    Parse a bandwidth
+
+    Params:
+        value: str -> bytes per second with optional K, M, G suffix.
+                      '', 0 or off is unlimited
+
+    Return:
+        bytes per second (0 for unlimited)
+    """
+    text = str(value).strip().lower().removesuffix('/s').removesuffix('b')
+    if text in ('', 'off', 'none'):
+        return 0
+    match = re.fullmatch(r'([\d.]+)\s*([kmg]?)', text)
+    if not match:
+        raise ValueError(f"Invalid bandwidth: {value}")
+    return float(match[1]) * UNITS[match[2]]
+
+
+def _minute(text: str) -> int:
+    hour, minute = text.strip().split(':')
+    return int(hour) * 60 + int(minute)
+
+
+class BandwidthProfile:
+    """Bandwidth limit by local time of day"""
+    def __init__(self, default: float=0, periods: list=None) -> None:
+        """
+        Params:
+            default:    float -> bytes per second out of all periods (0 is unlimited)
+            periods:    list  -> (start minute, end minute, bytes per second),
+                                 a period which ends before it starts passes midnight
+        """
+        self.default = default
+        self.periods = periods or []
+
+    @classmethod
+    def parse(cls, profile: str=BANDWIDTH_PROFILE, default=BANDWIDTH_LIMIT):
+        """
+        Params:
+            profile: str -> "08:00-20:00=1M,20:00-08:00=0"
+            default: str -> limit out of all periods
+        """
+        periods = []
+        for item in filter(None, (part.strip() for part in profile.split(','))):
+            span, rate = item.split('=')
+            start, end = span.split('-')
+            periods.append((_minute(start), _minute(end), parse_rate(rate)))
+        return cls(default=parse_rate(default), periods=periods)
+
+    def rate(self, now: datetime.datetime=None) -> float:
+        """Bytes per second at now (0 is unlimited)"""
+        now = now or datetime.datetime.now()
+        minute = now.hour * 60 + now.minute
+        for start, end, rate in self.periods:
+            if start <= end:
+                inside = start <= minute < end
+            else:
+                inside = minute >= start or minute < end
+            if inside:
+                return rate
+        return self.default
+
+
+class TokenBucket:
+    """Thread-safe token bucket, one token is one byte"""
+    def __init__(self, profile: BandwidthProfile, burst: float=1.0) -> None:
+        """
+        Params:
+            profile:    BandwidthProfile -> rate by time of day
+            burst:      float            -> seconds of rate which can be saved up
+        """
+        self.profile = profile
+        self.burst = burst
+        self._tokens = 0.0
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self, size: int) -> float:
+        """
+        Take size tokens, the bucket goes into debt if there are not enough
+
+        Return:
+            seconds to wait before size bytes may be transferred
+        """
+        rate = self.profile.rate()
+        with self._lock:
+            now = time.monotonic()
+            if not rate:
+                self._tokens = 0.0
+                self._updated = now
+                return 0.0
+            self._tokens = min(rate * self.burst,
+                               self._tokens + (now - self._updated) * rate)
+            self._updated = now
+            self._tokens -= size
+            return max(0.0, -self._tokens / rate)
+
+    def consume(self, size: int) -> None:
+        """Block until size bytes may be transferred"""
+        delay = self.reserve(size)
+        if delay:
+            time.sleep(delay)
+
+
+def is_rate_limited(error: HttpError) -> bool:
+    """Drive answered 429 or 403 with a rate limit reason"""
+    status = int(error.resp.status)
+    if status == 429:
+        return True
+    if status != 403:
+        return False
+    try:
+        errors = json.loads(error.content).get('error', {}).get('errors', [])
+    except (ValueError, AttributeError):
+        return False
+    return any(item.get('reason') in RATE_LIMIT_REASONS for item in errors)
+
+
+class AdaptiveConcurrency:
+    """
+    Limit of requests in flight which adapts to Drive rate limits (AIMD)
+
+    The limit is halved on a rate limit error and grows by one after
+    limit successful requests, up to max_limit.
+    """
+    def __init__(self, max_limit: int=MAX_CONCURRENCY) -> None:
+        self.max_limit = max_limit
+        self.limit = max_limit
+        self._active = 0
+        self._successes = 0
+        self._condition = threading.Condition()
+
+    def acquire(self) -> None:
+        with self._condition:
+            while self._active >= self.limit:
+                self._condition.wait()
+            self._active += 1
+
+    def release(self, rate_limited: bool=False) -> None:
+        with self._condition:
+            self._active -= 1
+            self._adapt(rate_limited)
+            self._condition.notify_all()
+
+    def _adapt(self, rate_limited: bool) -> None:
+        """Halve the limit on a rate limit, grow it by one after limit successes"""
+        if rate_limited:
+            self.limit = max(1, self.limit // 2)
+            self._successes = 0
+        else:
+            self._successes += 1
+            if self._successes >= self.limit and self.limit < self.max_limit:
+                self.limit += 1
+                self._successes = 0
+
+    def call(self, func, *args, **kwargs):
+        """
+        Run a request in a slot, a rate limit error shrinks the limit
+
+        Params:
+            func:   callable -> request, e.g. request.next_chunk or request.execute
+        """
+        self.acquire()
+        try:
+            result = func(*args, **kwargs)
+        except HttpError as error:
+            self.release(rate_limited=is_rate_limited(error))
+            raise
+        except BaseException:
+            self.release()
+            raise
+        self.release()
+        return result
+
+
+class AsyncAdaptiveConcurrency(AdaptiveConcurrency):
+    """
+    AdaptiveConcurrency for coroutines, e.g. of AsyncGCDrive
+
+    Slots are awaited instead of blocking the thread, so it must be
+    created and used in one event loop.
+    """
+    def __init__(self, max_limit: int=MAX_CONCURRENCY) -> None:
+        super().__init__(max_limit)
+        self._condition = asyncio.Condition()
+
+    @contextlib.asynccontextmanager
+    async def slot(self):
+        """Run a request in a slot, a rate limit error shrinks the limit"""
+        async with self._condition:
+            await self._condition.wait_for(lambda: self._active < self.limit)
+            self._active += 1
+        rate_limited = False
+        try:
+            yield
+        except HttpError as error:
+            rate_limited = is_rate_limited(error)
+            raise
+        finally:
+            async with self._condition:
+                self._active -= 1
+                self._adapt(rate_limited)
+                self._condition.notify_all()
+
+
+def _body_size(body, headers: dict) -> int:
+    """Bytes of a request body, stream bodies (chunks of MediaFileUpload) have no len()"""
+    if isinstance(body, (bytes, bytearray, str)):
+        return len(body)
+    for key, value in (headers or {}).items():
+        if key.lower() == 'content-length':
+            return int(value)
+    return 0
+
+
+class ThrottledHttp(httplib2.Http):
+    """httplib2.Http whose request bodies and contents are shaped by token buckets"""
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        # 308 is "resume incomplete" of resumable uploads, not a redirect
+        # (googleapiclient.http.build_http does the same)
+        self.redirect_codes = self.redirect_codes - {308}
+
+    def request(self, uri, method='GET', body=None, headers=None, *args, **kwargs):
+        if body:
+            upload_limit.consume(_body_size(body, headers))
+        response, content = super().request(uri, method, body, headers, *args, **kwargs)
+        if content:
+            download_limit.consume(len(content))
+        return response, content
+
+
+# shared by every client of the process
+upload_limit = TokenBucket(BandwidthProfile.parse())
+download_limit = TokenBucket(BandwidthProfile.parse())
+concurrency = AdaptiveConcurrency()
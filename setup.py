@@ -39,6 +39,16 @@ setup(
     extras_require={
         'django': [
             'django>=4.2'
+        ],
+        'zstd': [
+            'zstandard>=0.22'
+        ],
+        'async': [
+            'aiohttp>=3.9'
+        ],
+        'bench': [
+            'pytest',
+            'pytest-benchmark>=4.0'
         ]
     },
     entry_points={